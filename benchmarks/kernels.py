@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+from itertools import cycle
+from time import perf_counter
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libs.CRP import CRP, TMIN, TMAX
+import libs.utils as ut
+from benchmarks.simulate import simulate_data
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baselines.json'
+)
+
+
+# ------------------------------------------------------------------------------
+# KERNEL SETUP
+# ------------------------------------------------------------------------------
+
+def get_model(cells, muts, clusters, seed=1):
+    data, _, assignment, _ = simulate_data(cells, muts, clusters, seed=seed)
+    data = data.astype(float)
+    data[data == 3] = np.nan
+
+    np.random.seed(seed)
+    model = CRP(data, DP_alpha=[-1, -1], param_beta=[.1, .1], FN_error=0.1,
+        FP_error=0.001)
+    model.init(assign=assignment.tolist())
+    return model
+
+
+def get_assignments(model, steps):
+    # Posterior-like samples: true assignment with 5% of the cells moved
+    assignments = np.tile(model.assignment, (steps, 1))
+    moved = np.random.random(assignments.shape) < 0.05
+    assignments[moved] = np.random.randint(
+        0, len(model.cells_per_cluster), size=moved.sum()
+    )
+    return assignments
+
+
+def kernel_calc_ll(model, steps):
+    theta = model.parameters[model.assignment]
+    return lambda: model._calc_ll(model.data, theta, True)
+
+
+def kernel_get_log_A(model, steps):
+    cl_id = max(model.cells_per_cluster, key=model.cells_per_cluster.get)
+    cells = np.argwhere(model.assignment == cl_id).flatten()
+    old_params = model.parameters[cl_id]
+    std = np.random.choice(model.param_proposal_sd, size=model.muts_total)
+    new_params = np.clip(
+        old_params + np.random.normal(0, std), TMIN, TMAX
+    ).astype(np.float32)
+    a = (TMIN - old_params) / std
+    b = (TMAX - old_params) / std
+    return lambda: model._get_log_A(new_params, old_params, cells, a, b, std)
+
+
+def kernel_get_lpost_single(model, steps):
+    cl_ids = np.fromiter(model.cells_per_cluster.keys(), dtype=int)
+    cell_ids = np.random.randint(0, model.cells_total, size=1000)
+    calls = cycle(cell_ids)
+    return lambda: model.get_lpost_single(next(calls), cl_ids)
+
+
+def kernel_rg_scan_assign(model, steps):
+    cl_id = max(model.cells_per_cluster, key=model.cells_per_cluster.get)
+    cells = np.random.permutation(np.argwhere(model.assignment == cl_id).flatten())
+    model._rg_init_split(cells)
+
+    def scan():
+        # The launch parameters change between scans
+        model.rg_ll = None
+        model._rg_scan_assign(cells)
+    return scan
+
+
+def kernel_get_dist(model, steps):
+    assignments = get_assignments(model, steps)
+    return lambda: ut.get_dist(assignments)
+
+
+def kernel_get_MPEAR(model, steps):
+    assignments = get_assignments(model, steps)
+    return lambda: ut._get_MPEAR(assignments)
+
+
+KERNELS = {
+    'CRP._calc_ll': kernel_calc_ll,
+    'CRP._get_log_A': kernel_get_log_A,
+    'CRP.get_lpost_single': kernel_get_lpost_single,
+    'CRP._rg_scan_assign': kernel_rg_scan_assign,
+    'utils.get_dist': kernel_get_dist,
+    'utils._get_MPEAR': kernel_get_MPEAR,
+}
+
+
+# ------------------------------------------------------------------------------
+# TIMING
+# ------------------------------------------------------------------------------
+
+def time_kernel(fct, min_time=0.2, repeat=3):
+    """ Time a kernel
+
+    Returns:
+        float: Best calls per second over all repeats
+        float: Peak memory allocated during a single call (KiB)
+    """
+    tracemalloc.start()
+    fct()
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+
+    ops = []
+    for rep in range(repeat):
+        calls = 0
+        start = perf_counter()
+        while True:
+            fct()
+            calls += 1
+            elapsed = perf_counter() - start
+            if elapsed >= min_time:
+                break
+        ops.append(calls / elapsed)
+    return max(ops), peak
+
+
+def run_kernels(args):
+    """ Time the selected kernels
+
+    Returns:
+        str: Benchmark size
+        dict: Calls per second and peak memory of the timed kernels
+        list: Kernels that raised an error
+    """
+    size = f'{args.cells}x{args.muts}x{args.clusters}x{args.steps}'
+    model = get_model(args.cells, args.muts, args.clusters, args.seed)
+
+    results = {}
+    failures = []
+    for name in args.kernels:
+        np.random.seed(args.seed)
+        try:
+            fct = KERNELS[name](model, args.steps)
+            ops, peak = time_kernel(fct, args.min_time, args.repeat)
+        except Exception as err:
+            print(f'{name: <24}\tfailed: {err!r}')
+            failures.append(name)
+            continue
+        results[name] = {'ops_per_sec': ops, 'peak_kib': peak}
+    return size, results, failures
+
+
+# ------------------------------------------------------------------------------
+# BASELINES
+# ------------------------------------------------------------------------------
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_baselines(path, size, results):
+    baselines = load_baselines(path)
+    baselines.setdefault(size, {}).update(results)
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def compare(size, results, baselines, tolerance=0.2):
+    """ Print kernel results next to the stored baselines
+
+    Returns:
+        list: Kernels slower than (1 - tolerance) x baseline
+    """
+    base_size = baselines.get(size, {})
+    regressions = []
+    print(f'\nKernel benchmarks ({size}: cells x muts x clusters x steps)')
+    print(f'{"kernel": <24}\t{"ops/sec": >12}\t{"peak KiB": >10}\t'
+        f'{"baseline": >12}\t{"ratio": >6}')
+    for name, res in results.items():
+        line = f'{name: <24}\t{res["ops_per_sec"]: >12.2f}\t' \
+            f'{res["peak_kib"]: >10.1f}'
+        if name in base_size:
+            ratio = res['ops_per_sec'] / base_size[name]['ops_per_sec']
+            line += f'\t{base_size[name]["ops_per_sec"]: >12.2f}\t{ratio: >6.2f}'
+            if ratio < 1 - tolerance:
+                regressions.append(name)
+                line += '\tREGRESSION'
+        print(line)
+    return regressions
+
+
+# ------------------------------------------------------------------------------
+# ARGPARSER
+# ------------------------------------------------------------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='kernels', usage='python3 -m benchmarks.kernels [options]',
+        description='*** Microbenchmarks of the likelihood and sampling '
+            'kernels. ***'
+    )
+    parser.add_argument('-c', '--cells', type=int, default=200,
+        help='Number of cells. Default = 200.')
+    parser.add_argument('-m', '--muts', type=int, default=200,
+        help='Number of mutations. Default = 200.')
+    parser.add_argument('-k', '--clusters', type=int, default=5,
+        help='Number of clusters. Default = 5.')
+    parser.add_argument('-s', '--steps', type=int, default=200,
+        help='Number of posterior samples for the estimator kernels. '
+            'Default = 200.')
+    parser.add_argument('--kernels', type=str, nargs='+',
+        default=list(KERNELS.keys()), choices=list(KERNELS.keys()),
+        help='Kernels to benchmark. Default = all.')
+    parser.add_argument('-t', '--min_time', type=float, default=0.2,
+        help='Minimum time per repeat in secs. Default = 0.2.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='Number of repeats, the best one is reported. Default = 3.')
+    parser.add_argument('-b', '--baseline', type=str, default=BASELINE_FILE,
+        help='Baseline file (json). Default = benchmarks/baselines.json.')
+    parser.add_argument('--save', action='store_true', default=False,
+        help='Store the results as new baseline. Default = False.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='Allowed relative slowdown before reporting a regression. '
+            'Default = 0.2.')
+    parser.add_argument('--seed', type=int, default=1,
+        help='Seed used for random number generation. Default = 1.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    size, results, failures = run_kernels(args)
+    regressions = compare(
+        size, results, load_baselines(args.baseline), args.tolerance
+    )
+    if args.save:
+        save_baselines(args.baseline, size, results)
+        print(f'\nBaseline written to: {args.baseline}')
+    elif regressions:
+        print(f'\nRegressions in: {", ".join(regressions)}')
+    if failures:
+        print(f'\nFailed kernels: {", ".join(failures)}')
+    if failures or (regressions and not args.save):
+        sys.exit(1)
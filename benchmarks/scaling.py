@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+import resource
+import subprocess
+import tempfile
+import multiprocessing as mp
+from itertools import product
+from time import perf_counter
+from datetime import datetime
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run_BnpC
+import libs.dpmmIO as io
+import libs.utils as ut
+from benchmarks.simulate import generate
+
+
+# ------------------------------------------------------------------------------
+# SINGLE RUN
+# ------------------------------------------------------------------------------
+
+def run_phases(data_dir, out_dir, chains, steps, seed, estimator, plots):
+    """ Run run_BnpC.main phase by phase and time each phase
+
+    Returns:
+        dict: Wall time (secs) per phase and throughput of the sampling
+    """
+    argv = [data_dir, '-n', str(chains), '-s', str(steps), '--seed', str(seed),
+        '-v', '0', '-o', out_dir, '--profile', '-e'] + estimator
+    if not plots:
+        argv.append('-np')
+    args = run_BnpC.parse_args(argv)
+
+    times = {}
+    start = perf_counter()
+    data, data_names = run_BnpC.load_input(args)
+    times['load'] = perf_counter() - start
+
+    start = perf_counter()
+    BnpC = run_BnpC.get_model(args, data)
+    times['model'] = perf_counter() - start
+
+    start = perf_counter()
+    results = run_BnpC.run_MCMC(args, BnpC)
+    times['sampling'] = perf_counter() - start
+
+    start = perf_counter()
+    data = ut.sparse_to_dense(data)
+    out_dir = io._get_out_dir(args)
+    inferred = io._infer_results(args, results, data)
+    times['inference'] = perf_counter() - start
+
+    start = perf_counter()
+    data_true = run_BnpC.save_output(args, results, inferred, out_dir, data_names)
+    times['output'] = perf_counter() - start
+
+    start = perf_counter()
+    if plots:
+        run_BnpC.generate_plots(
+            args, results, inferred, data, data_true, out_dir, data_names
+        )
+    times['plotting'] = perf_counter() - start
+
+    row = {f'{i}_s': j for i, j in times.items()}
+    row['total_s'] = sum(times.values())
+    samples = sum([i['ML'].size for i in results])
+    row['samples_per_s'] = samples / times['sampling']
+    row['ESS_ML_per_s'] = sum([i['ESS']['ML'] for i in results]) \
+        / times['sampling']
+    # Sampling time per move type, summed over chains
+    for move in results[0]['timing']:
+        row[f'move_{move}_s'] = sum([i['timing'][move][1] for i in results])
+        row[f'move_{move}_calls'] = \
+            int(sum([i['timing'][move][0] for i in results]))
+    return row
+
+
+def _run_config(queue, *args):
+    try:
+        row = run_phases(*args)
+    except Exception as err:
+        queue.put(err)
+        raise
+    # Peak resident memory (MB) of this process and of the chain workers
+    row['peak_rss_main_mb'] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    row['peak_rss_chains_mb'] = \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    queue.put(row)
+
+
+def run_config(*args):
+    # Fresh process per configuration: memory high-water marks do not leak
+    queue = mp.Queue()
+    proc = mp.Process(target=_run_config, args=(queue, *args))
+    proc.start()
+    row = queue.get()
+    proc.join()
+    if isinstance(row, Exception):
+        raise row
+    return row
+
+
+# ------------------------------------------------------------------------------
+# GRID
+# ------------------------------------------------------------------------------
+
+def get_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return ''
+
+
+def run_grid(args):
+    version = get_version()
+    timestamp = f'{datetime.now():%Y%m%d_%H:%M:%S}'
+    if args.data_dir:
+        data_root = args.data_dir
+    else:
+        data_root = tempfile.mkdtemp(prefix='BnpC_benchmark_')
+
+    rows = []
+    for cells, muts, chains in product(args.cells, args.muts, args.chains):
+        data_dir = os.path.join(data_root, f'{cells}x{muts}')
+        if not os.path.exists(os.path.join(data_dir, 'data.csv')):
+            generate(
+                data_dir, cells=cells, muts=muts, clusters=args.clusters,
+                seed=args.seed
+            )
+
+        for rep in range(args.repeats):
+            out_dir = os.path.join(data_dir, f'out_{chains}_{rep}')
+            row = {'version': version, 'time': timestamp, 'cells': cells,
+                'muts': muts, 'chains': chains, 'steps': args.steps,
+                'repeat': rep}
+            row.update(run_config(
+                data_dir, out_dir, chains, args.steps, args.seed + rep,
+                args.estimator, args.plots
+            ))
+            rows.append(row)
+            if args.verbosity > 0:
+                print(f'{cells: >6} cells x {muts: >6} muts, {chains} chains:'
+                    f'\t{row["total_s"]:.2f} secs. '
+                    f'({row["samples_per_s"]:.1f} samples/sec.)')
+
+    df = pd.DataFrame(rows)
+    if os.path.exists(args.output):
+        df = pd.concat([pd.read_csv(args.output), df], ignore_index=True)
+    df.to_csv(args.output, index=False)
+    return df
+
+
+# ------------------------------------------------------------------------------
+# ARGPARSER
+# ------------------------------------------------------------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='scaling', usage='python3 -m benchmarks.scaling [options]',
+        description='*** Time BnpC phases on simulated data of varying size. ***'
+    )
+    parser.add_argument('-c', '--cells', type=int, nargs='+', default=[100, 500],
+        help='Number(s) of cells. Default = 100 500.')
+    parser.add_argument('-m', '--muts', type=int, nargs='+', default=[100, 500],
+        help='Number(s) of mutations. Default = 100 500.')
+    parser.add_argument('-n', '--chains', type=int, nargs='+', default=[1],
+        help='Number(s) of chains. Default = 1.')
+    parser.add_argument('-k', '--clusters', type=int, default=5,
+        help='Number of simulated clusters. Default = 5.')
+    parser.add_argument('-s', '--steps', type=int, default=200,
+        help='Number of MCMC steps. Default = 200.')
+    parser.add_argument('-r', '--repeats', type=int, default=1,
+        help='Repeats per configuration. Default = 1.')
+    parser.add_argument('-e', '--estimator', type=str, nargs='+',
+        default=['posterior'], choices=['posterior', 'ML', 'MAP'],
+        help='Estimator(s) used for inferrence. Default = posterior.')
+    parser.add_argument('-p', '--plots', action='store_true', default=False,
+        help='Time plotting as well. Default = False.')
+    parser.add_argument('--seed', type=int, default=1,
+        help='Seed used for data simulation and sampling. Default = 1.')
+    parser.add_argument('-d', '--data_dir', type=str, default='',
+        help='Directory for simulated data and run output. Default = tmp dir.')
+    parser.add_argument('-o', '--output', type=str, default='scaling.csv',
+        help='CSV file the results are appended to. Default = scaling.csv.')
+    parser.add_argument('-v', '--verbosity', type=int, default=1,
+        choices=[0, 1], help='Print status massages to stdout. Default = 1.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run_grid(parse_args())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+# DATA SIMULATION
+# ------------------------------------------------------------------------------
+
+def simulate_data(cells=100, muts=100, clusters=5, FP=0.001, FN=0.1,
+            missing=0.1, trunk=0.1, branching=0.33, seed=1):
+    """ Simulate noisy single cell mutation data from a random clone tree
+
+    Arguments:
+        cells (int): Number of cells
+        muts (int): Number of mutations
+        clusters (int): Number of clones
+        FP (float): False positive rate
+        FN (float): False negative rate
+        missing (float): Rate of missing values
+        trunk (float): Ratio of mutations present in all clones
+        branching (float): Probability of attaching a new clone to a random
+            clone instead of its predecessor
+        seed (int): Seed used for random number generation
+
+    Returns:
+        np.array: n x m noisy data matrix with 0|1|3 (3 = missing)
+        np.array: n x m true genotype matrix with 0|1
+        np.array: True cluster assignment of the cells
+        np.array: Parent clone of each clone (-1 for the root)
+    """
+    rs = np.random.RandomState(seed)
+
+    # Clone tree: clone 0 carries the trunk
+    parents = np.full(clusters, -1, dtype=int)
+    for cl in range(1, clusters):
+        if cl > 1 and rs.random_sample() < branching:
+            parents[cl] = rs.randint(0, cl)
+        else:
+            parents[cl] = cl - 1
+
+    # Mutations: trunk on clone 0, remaining distributed over the other clones
+    trunk_no = max(1, int(round(muts * trunk)))
+    mut_clone = np.zeros(muts, dtype=int)
+    if clusters > 1:
+        branch_muts = np.arange(trunk_no, muts)
+        mut_clone[branch_muts] = np.append(
+            np.arange(1, clusters),
+            rs.randint(1, clusters, size=max(0, branch_muts.size - clusters + 1))
+        )[:branch_muts.size]
+        mut_clone = mut_clone[rs.permutation(muts)]
+
+    clone_geno = np.zeros((clusters, muts), dtype=np.int8)
+    for cl in range(clusters):
+        node = cl
+        while node != -1:
+            clone_geno[cl, mut_clone == node] = 1
+            node = parents[node]
+
+    # Cells: every clone is populated at least once
+    assignment = np.append(
+        np.arange(min(clusters, cells)),
+        rs.randint(0, clusters, size=max(0, cells - clusters))
+    )
+    assignment = assignment[rs.permutation(cells)]
+    data_raw = clone_geno[assignment]
+
+    # Errors and missing values
+    data = data_raw.copy()
+    noise = rs.random_sample(data.shape)
+    data[(data_raw == 1) & (noise < FN)] = 0
+    data[(data_raw == 0) & (noise < FP)] = 1
+    data[rs.random_sample(data.shape) < missing] = 3
+
+    return data, data_raw, assignment, parents
+
+
+def save_data(out_dir, data, data_raw, assignment, params):
+    """ Save simulated data in the layout expected by run_BnpC.py, i.e. with
+    mutations as rows and cells as columns.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    np.savetxt(os.path.join(out_dir, 'data.csv'), data.T, fmt='%d')
+    np.savetxt(os.path.join(out_dir, 'data_raw.csv'), data_raw.T, fmt='%d')
+
+    with open(os.path.join(out_dir, 'attachments.txt'), 'w') as f:
+        f.write('Assignment\n' + ' '.join([str(i) for i in assignment]))
+
+    with open(os.path.join(out_dir, 'data_params.txt'), 'w') as f:
+        f.write('Parameters employed to generate the data file (data.csv): \n\n'
+            f'Cells: {params["cells"]}\nMutations: {params["muts"]}\n'
+            f'Clusters: {params["clusters"]}\n\n'
+            f'False Positives: {params["FP"] * 100:g} %\n'
+            f'False Negatives: {params["FN"] * 100:g} % \n'
+            f'Missing Values: {params["missing"] * 100:g} % \n\n'
+            f'Trunk size: {params["trunk"]}\nBranching: {params["branching"]}\n'
+            f'Seed: {params["seed"]}\n')
+
+
+def generate(out_dir, cells=100, muts=100, clusters=5, FP=0.001, FN=0.1,
+            missing=0.1, trunk=0.1, branching=0.33, seed=1):
+    params = {'cells': cells, 'muts': muts, 'clusters': clusters, 'FP': FP,
+        'FN': FN, 'missing': missing, 'trunk': trunk, 'branching': branching,
+        'seed': seed}
+    data, data_raw, assignment, _ = simulate_data(**params)
+    save_data(out_dir, data, data_raw, assignment, params)
+    return os.path.join(out_dir, 'data.csv')
+
+
+# ------------------------------------------------------------------------------
+# ARGPARSER
+# ------------------------------------------------------------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='simulate', usage='python3 -m benchmarks.simulate <OUT_DIR> [options]',
+        description='*** Simulate single cell mutation data from a clone tree. ***'
+    )
+    parser.add_argument('out_dir', help='Output directory.')
+    parser.add_argument('-c', '--cells', type=int, default=100,
+        help='Number of cells. Default = 100.')
+    parser.add_argument('-m', '--muts', type=int, default=100,
+        help='Number of mutations. Default = 100.')
+    parser.add_argument('-k', '--clusters', type=int, default=5,
+        help='Number of clusters. Default = 5.')
+    parser.add_argument('-FP', '--falsePositive', type=float, default=0.001,
+        help='False positive rate. Default = 0.001.')
+    parser.add_argument('-FN', '--falseNegative', type=float, default=0.1,
+        help='False negative rate. Default = 0.1.')
+    parser.add_argument('-mr', '--missing', type=float, default=0.1,
+        help='Rate of missing values. Default = 0.1.')
+    parser.add_argument('-ts', '--trunk', type=float, default=0.1,
+        help='Ratio of mutations on the trunk. Default = 0.1.')
+    parser.add_argument('-br', '--branching', type=float, default=0.33,
+        help='Branching probability of the clone tree. Default = 0.33.')
+    parser.add_argument('--seed', type=int, default=1,
+        help='Seed used for random number generation. Default = 1.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    out_file = generate(
+        args.out_dir, cells=args.cells, muts=args.muts, clusters=args.clusters,
+        FP=args.falsePositive, FN=args.falseNegative, missing=args.missing,
+        trunk=args.trunk, branching=args.branching, seed=args.seed
+    )
+    print(f'Data written to: {out_file}')
@@ -1,35 +1,93 @@
 #!/usr/bin/env python3
 
+import math
 import numpy as np
 import bottleneck as bn
-from scipy.special import gamma, gammaln
+import scipy.sparse as sp
+from scipy.special import gamma, gammaln, logsumexp
 from scipy.stats import beta, truncnorm
 from scipy.stats import gamma as gamma_fct
 
+try:
+    from libs import utils as ut
+except ImportError:
+    import utils as ut
+
 
 np.seterr(all='raise')
 EPSILON = np.finfo(np.float64).resolution
 TMIN = 1e-5
 TMAX = 1 - TMIN
 log_EPSILON = np.log(EPSILON)
+# Split anchor weight of the cell fitting the cluster parameters best
+ANCHOR_DELTA = 0.01
+# Decay of the merge partner probability with the parameter distance
+PARTNER_LAMBDA = 20
+# Proposal adaptation: target acceptance rate, step size decay, scale bounds
+# (lower bound: the truncated normal proposals stay well-conditioned)
+ADAPT_TARGET = 0.44
+ADAPT_DECAY = 0.6
+ADAPT_SCALE = (0.1, 10)
+# Maximum entries of the grid-collapsed marginal likelihood table
+GRID_TABLE_MAX = 2 ** 24
+# Number of set bits of each byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int32)
+# MH Gibbs: weight of the uniform proposal over all clusters
+GIBBS_MH_UNIFORM = 0.05
+# MH Gibbs: clusters cached per cell and sweep, per candidate
+GIBBS_MH_CACHE = 2
 
 
 class CRP:
     """
     Arguments:
         data (np.array): n x m matrix with n cells and m mutations
-            containing 0|1|np.nan
+            containing 0|1|np.nan, or a scipy sparse matrix containing only the
+            observed entries (0|1), or a (memory-mapped) int8 matrix containing
+            0|1|3 (3 = missing) if block_size is set
         alpha (float): Concentration Parameter for the CRP
         param_beta ((float, float)): Beta dist parameters used as parameter prior
         FN_error (float): Fixed false negative rate
         FP_error (float): Fixed false positive rate
+        weights (np.array): Number of cells represented by each row (n x 1) or
+            by each entry (n x m) of the data, if duplicate cells are collapsed
+        cell_rows (np.array): Data row of each input cell, if collapsed
+        mut_cols (np.array): Data column of each input mutation (-1 if
+            dropped), if mutations are compressed
+        block_size (int): Out-of-core data: number of matrix entries converted
+            and processed at once
     """
+    # Split-merge moves keep the target invariant (label-free assignments)
+    split_merge = True
+
     def __init__(self, data, DP_alpha=-1, param_beta=[1, 1], FN_error=EPSILON,
-                FP_error=EPSILON):
+                FP_error=EPSILON, weights=None, cell_rows=None, mut_cols=None,
+                block_size=None):
         # Fixed data
         self.data = data
         self.cells_total, self.muts_total = self.data.shape
 
+        # Collapsed cells: rows are moved as units of cell_weights cells
+        self.cell_rows = cell_rows
+        if cell_rows is None:
+            self.cell_weights = np.ones(self.cells_total, dtype=int)
+        else:
+            self.cell_weights = np.bincount(cell_rows, minlength=self.cells_total)
+        if weights is None:
+            weights = self.cell_weights[:, np.newaxis]
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.cells_all = int(self.cell_weights.sum())
+        self._lgamma_weights = gammaln(self.cell_weights)
+        # Compressed mutations: merged mutations share one parameter
+        self.mut_cols = mut_cols
+
+        # Sparse data: weighted CSR matrices of the observed 1s and 0s
+        self.sparse = sp.issparse(data)
+        if self.sparse:
+            self._init_sparse_data()
+        # Out-of-core data: compact data processed in blocks of cells
+        self.block_size = block_size
+
         # Cluster parameter prior (beta function) parameters
         self.p, self.q = param_beta
         self.param_prior = beta(self.p, self.q)
@@ -49,11 +107,11 @@ class CRP:
 
         # DP alpha
         if DP_alpha[0] < 0 or DP_alpha[1] < 0:
-            self.DP_a_gamma = (np.sqrt(self.cells_total), 1)
+            self.DP_a_gamma = (np.sqrt(self.cells_all), 1)
         else:
             self.DP_a_gamma = DP_alpha
         self.DP_a_prior = gamma_fct(*self.DP_a_gamma)
-        self.DP_a = np.sqrt(self.cells_total)
+        self.DP_a = np.sqrt(self.cells_all)
 
         # Flexible data - Initialization
         self.CRP_prior = None
@@ -61,13 +119,28 @@ class CRP:
         self.parameters = None
         self.cells_per_cluster = None
 
-        # MH proposal stDev's
+        # MH proposal stDev's, scaled per mutation if adapted during burn-in
         self.param_proposal_sd = np.array([0.1, 0.25, 0.5])
+        self.param_proposal_scale = np.ones(self.muts_total)
+        self.param_adapt_steps = 0
+        # Inverse temperature of the likelihood (< 1 for tempered replicas)
+        self.inv_temp = 1.0
+        # Latent genotype counts of the last augmented parameter update
+        self.latent_counts = None
+        # Grid-collapsed Gibbs: weighted count rows and marginal ll table
+        self.grid_counts = None
+        self.grid_table = None
+        self.grid_key = None
+        # Minibatch Gibbs: remaining batches of the current pass over the rows
+        self.gibbs_queue = []
+        # MH Gibbs: bit-packed observations and rounded cluster genotypes
+        self.bit_data = None
+        self.geno_bits = None
 
 
     def __str__(self):
         out_str = '\nDPMM with:\n' \
-            f'\t{self.cells_total} cells\n\t{self.muts_total} mutations\n' \
+            f'\t{self.get_cells_str()}\n\t{self.get_muts_str()}\n' \
             f'\tFixed FN rate: {self.FP}\n\tFixed FP rate: {self.FN}\n' \
             '\n\tPriors:\n' \
             f'\tParams.:\tBeta({self.p},{self.q})\n' \
@@ -75,6 +148,130 @@ class CRP:
         return out_str
 
 
+    def _init_sparse_data(self):
+        data = sp.csr_matrix(self.data)
+        data.sort_indices()
+        rows = np.repeat(np.arange(self.cells_total), np.diff(data.indptr))
+        w = np.broadcast_to(self.weights, data.shape)[rows, data.indices]
+        is_one = data.data == 1
+
+        self.data = data
+        self.data_ones = sp.csr_matrix(
+            (w * is_one, data.indices.copy(),
+                data.indptr.copy()), shape=data.shape
+        )
+        self.data_ones.eliminate_zeros()
+        self.data_zeros = sp.csr_matrix(
+            (w * ~is_one, data.indices.copy(),
+                data.indptr.copy()), shape=data.shape
+        )
+        self.data_zeros.eliminate_zeros()
+
+
+    def __getstate__(self):
+        # Memory-mapped data is reopened instead of copied (e.g. per chain)
+        state = self.__dict__.copy()
+        if isinstance(self.data, np.memmap):
+            state['data'] = (self.data.filename, self.data.strides)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.data, tuple):
+            data = np.load(self.data[0], mmap_mode='r')
+            if data.strides != self.data[1]:
+                data = data.T
+            self.data = data
+
+
+    def _iter_blocks(self, rows=slice(None)):
+        """ Out-of-core data: iterate over blocks of the given rows, yielding
+        the row indices and the float data (missing: np.nan)
+        """
+        rows = np.arange(self.cells_total)[rows]
+        step = max(1, self.block_size // self.muts_total)
+        for i in range(0, rows.size, step):
+            block = rows[i:i + step]
+            yield block, ut.compact_to_float(self.data[block])
+
+
+    def get_data_attrs(self):
+        # Fixed input data: not stored in checkpoints
+        if self.sparse:
+            names = ['data', 'data_ones', 'data_zeros']
+        else:
+            names = ['data']
+        # Derived from the data: recalculated if needed
+        names.extend(['grid_counts', 'grid_table', 'bit_data', 'geno_bits'])
+        return {i: getattr(self, i, None) for i in names}
+
+
+    def detach_data(self):
+        data = self.get_data_attrs()
+        for i in data:
+            setattr(self, i, None)
+        return data
+
+
+    def attach_data(self, data):
+        for i, j in data.items():
+            setattr(self, i, j)
+
+
+    def get_dense_data(self):
+        # Compact out-of-core data is used as it is (missing: 3)
+        if self.block_size:
+            return self.data
+        return ut.sparse_to_dense(self.data)
+
+
+    def get_state(self):
+        """ Sampled variables, exchanged between tempered replicas
+        """
+        return {
+            'assignment': self.assignment.copy(),
+            'cells_per_cluster': dict(self.cells_per_cluster),
+            'parameters': self.parameters.copy(),
+            'DP_a': self.DP_a, 'FP': self.FP, 'FN': self.FN
+        }
+
+
+    def set_state(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.init_DP_prior()
+
+
+    def get_cells_str(self):
+        if self.cells_all == self.cells_total:
+            return f'{self.cells_total} cells'
+        return f'{self.cells_all} cells (collapsed to {self.cells_total})'
+
+
+    def get_muts_str(self):
+        if self.mut_cols is None:
+            return f'{self.muts_total} mutations'
+        return f'{self.mut_cols.size} mutations (compressed to ' \
+            f'{self.muts_total})'
+
+
+    def expand_params(self, params):
+        # Parameters of the input mutations, prior mean for dropped mutations
+        if self.mut_cols is None:
+            return params
+        params_full = params[..., self.mut_cols]
+        params_full[..., self.mut_cols == -1] = self.p / (self.p + self.q)
+        return params_full
+
+
+    def expand_assignment(self, assignment):
+        # Assignment(s) of the input cells from the assignment(s) of the rows
+        if self.cell_rows is None:
+            return assignment
+        return assignment[..., self.cell_rows]
+
+
     @staticmethod
     def beta_fct(p, q):
         return gamma(p) * gamma(q) / gamma(p + q)
@@ -88,46 +285,40 @@ class CRP:
     @staticmethod
     def _normalize_log_probs(probs):
         max_i = bn.nanargmax(probs)
-        probs_norm = probs - probs[max_i] - np.log1p(bn.nansum(
-            np.exp(probs[np.arange(probs.size) != max_i] - probs[max_i])
-        ))
-        return np.exp(probs_norm)
-
-
-    @staticmethod
-    def _normalize_log(probs):
-        max_i = bn.nanargmax(probs, axis=0)
-        try:
-            log_probs_norm = probs - probs[max_i] - np.log1p(bn.nansum(
+        # Weighted cells: differences can exceed the float range
+        with np.errstate(under='ignore'):
+            probs_norm = probs - probs[max_i] - np.log1p(bn.nansum(
                 np.exp(probs[np.arange(probs.size) != max_i] - probs[max_i])
             ))
-        except FloatingPointError:
-            if probs[0] > probs[1]:
-                log_probs_norm = np.array([0, log_EPSILON])
-            else:
-                log_probs_norm = np.array([log_EPSILON, 0])
+            return np.exp(probs_norm)
 
-        return log_probs_norm
 
-      
-    def init(self, mode='random', assign=False):
+    def init(self, mode='random', assign=False, k=None):
         # Predefined assignment vector
         if assign:
-            self.assignment = np.array(assign)
-            self.cells_per_cluster = {}
-            cl, cl_size = np.unique(assign, return_counts=True)
-            for i in range(cl.size):
-                bn.replace(self.assignment, cl[i], i)
-                self.cells_per_cluster[i] = cl_size[i]
-            self.parameters = self._init_cl_params('assign')
+            self._init_assign(assign)
+        # Clustering of the data into k clusters
+        elif mode in ['kmedoids', 'hierarchical']:
+            if not k:
+                k = self.get_expected_clusters()
+            if mode == 'kmedoids':
+                self._init_assign(
+                    ut.get_kmedoids_assignment(self.get_dense_data(), k)
+                )
+            else:
+                self._init_assign(
+                    ut.get_hierarchical_assignment(self.get_dense_data(), k)
+                )
         elif mode == 'separate':
             self.assignment = np.arange(self.cells_total, dtype=int)
-            self.cells_per_cluster = {i: 1 for i in range(self.cells_total)}
+            self.cells_per_cluster = {
+                i: self.cell_weights[i] for i in range(self.cells_total)
+            }
             self.parameters = self._init_cl_params(mode)
         # All cells in one cluster
         elif mode == 'together':
             self.assignment = np.zeros(self.cells_total, dtype=int)
-            self.cells_per_cluster = {0: self.cells_total}
+            self.cells_per_cluster = {0: self.cells_all}
             self.parameters = self._init_cl_params(mode)
         # Complete random
         elif mode == 'random':
@@ -135,10 +326,11 @@ class CRP:
                 0, high=self.cells_total, size=self.cells_total
             )
             self.cells_per_cluster = {}
-            cl, cl_size = np.unique(self.assignment, return_counts=True)
+            cl = np.unique(self.assignment)
             for i in range(cl.size):
                 bn.replace(self.assignment, cl[i], i)
-                self.cells_per_cluster[i] = cl_size[i]
+                self.cells_per_cluster[i] = \
+                    self.cell_weights[self.assignment == i].sum()
             self.parameters = self._init_cl_params(mode)
         else:
             raise TypeError(f'Unsupported Initialization: {mode}')
@@ -146,27 +338,94 @@ class CRP:
         self.init_DP_prior()
 
 
+    def get_expected_clusters(self):
+        # Expected number of clusters under the CRP prior
+        k = self.DP_a * np.log1p(self.cells_all / self.DP_a)
+        return int(np.clip(np.round(k), 1, self.cells_total))
+
+
+    def _init_assign(self, assign):
+        # Cells without (-1) or beyond the given assignment are added later
+        assign = np.array(assign, dtype=int)
+        # Assignment of the input cells: use one cell per collapsed row
+        if self.cell_rows is not None and assign.size == self.cell_rows.size:
+            assign_rows = np.full(self.cells_total, -1, dtype=int)
+            assign_rows[self.cell_rows] = assign
+            assign = assign_rows
+        if assign.size > self.cells_total:
+            raise ValueError(f'Assignment of {assign.size} cells given for '
+                f'{self.cells_total} cells')
+
+        self.assignment = np.full(self.cells_total, -1, dtype=int)
+        self.assignment[:assign.size] = assign
+        assigned = self.assignment >= 0
+        cl = np.unique(self.assignment[assigned])
+        for i in range(cl.size):
+            self.assignment[self.assignment == cl[i]] = i
+
+        # Unassigned cells: assign to the most likely cluster
+        if not assigned.all():
+            self._assign_unassigned(cl.size, np.flatnonzero(~assigned))
+
+        self.cells_per_cluster = {}
+        for i in range(cl.size):
+            self.cells_per_cluster[i] = \
+                self.cell_weights[self.assignment == i].sum()
+        # Parameters are drawn given all cells of the clusters
+        self.parameters = self._init_cl_params('assign')
+
+
+    def _assign_unassigned(self, k, rows):
+        """ Assign the rows at once to the cluster with the most likely
+        posterior mean parameters given the already assigned cells
+        """
+        theta = np.empty((k, self.muts_total))
+        for cl in range(k):
+            ones, zeros = self._get_counts(np.where(self.assignment == cl)[0])
+            theta[cl] = (self.p + ones) / (self.p + self.q + ones + zeros)
+        l1, l0 = self._log_Bernoulli(theta)
+        step = max(1, (self.block_size or 2 ** 22) // self.muts_total)
+        for i in range(0, rows.size, step):
+            ones, zeros = self._get_count_rows(rows[i:i + step])
+            ll = np.asarray(ones @ l1.T + zeros @ l0.T)
+            self.assignment[rows[i:i + step]] = np.argmax(ll, axis=1)
+
+
     def _init_cl_params(self, mode='random', fkt=1):
-        params = np.zeros(self.data.shape)
-        if mode == 'separate':
+        # One row per cluster id, further rows are added on demand
+        params = np.zeros((max(self.cells_per_cluster) + 1, self.muts_total))
+        if mode == 'separate' and self.sparse:
+            a = np.full(self.data.shape, self._beta_mix_const[0])
+            b = np.full(self.data.shape, self._beta_mix_const[1])
+            for x, mat in [(1, self.data_ones), (0, self.data_zeros)]:
+                coo = mat.tocoo()
+                a[coo.row, coo.col] = self.p + x * coo.data * fkt
+                b[coo.row, coo.col] = self.q + (1 - x) * coo.data * fkt
+            params = np.random.beta(a, b)
+        elif mode == 'separate' and self.block_size:
+            for i, x in self._iter_blocks():
+                w = self.weights[i] * fkt
+                params[i] = np.random.beta(
+                    np.nan_to_num(self.p + x * w, nan=self._beta_mix_const[0]),
+                    np.nan_to_num(self.q + (1 - x) * w,
+                        nan=self._beta_mix_const[1])
+                )
+        elif mode == 'separate':
             params = np.random.beta(
-                np.nan_to_num(self.p + self.data * fkt, \
+                np.nan_to_num(self.p + self.data * self.weights * fkt, \
                     nan=self._beta_mix_const[0]),
-                np.nan_to_num(self.q + (1 - self.data) * fkt, \
+                np.nan_to_num(self.q + (1 - self.data) * self.weights * fkt, \
                     nan=self._beta_mix_const[1])
             )
         elif mode == 'together':
-            params[0] = np.random.beta(
-                self.p + bn.nansum(self.data * fkt, axis=0),
-                self.q + bn.nansum((1 - self.data) * fkt, axis=0)
-            )
+            ones, zeros = self._get_counts(slice(None), fkt)
+            params[0] = np.random.beta(self.p + ones, self.q + zeros)
         elif mode == 'assign':
             for cl in self.cells_per_cluster:
-                cl_data = self.data[np.where(self.assignment == cl)]
-                params[cl] = np.random.beta(
-                    self.p + bn.nansum(cl_data * fkt, axis=0),
-                    self.q + bn.nansum((1 - cl_data)  * fkt, axis=0)
+                ones, zeros = self._get_counts(
+                    np.where(self.assignment == cl)[0], fkt
                 )
+                params[cl] = np.random.beta(self.p + ones, self.q + zeros)
         elif mode == 'random':
             k = np.unique(self.assignment)
             params[k] = np.random.uniform(size=(k.size, self.muts_total))
@@ -175,29 +434,149 @@ class CRP:
 
 
     def _init_cl_params_new(self, i, fkt=1):
-        params = np.random.beta(
-            self.p + bn.nansum(self.data[i] * fkt, axis=0),
-            self.q + bn.nansum((1 - self.data[i]) * fkt, axis=0)
-        )
+        return self._draw_cl_params(*self._get_counts(i, fkt))
+
+
+    def _draw_cl_params(self, ones, zeros):
+        params = np.random.beta(self.p + ones, self.q + zeros)
         return np.clip(params, TMIN, TMAX).astype(np.float32)
 
 
     def init_DP_prior(self):
-        cl_vals = np.append(np.arange(1, self.cells_total + 1), self.DP_a)
-        CRP_prior = self.log_CRP_prior(cl_vals, self.cells_total, self.DP_a)
+        cl_vals = np.append(np.arange(1, self.cells_all + 1), self.DP_a)
+        CRP_prior = self.log_CRP_prior(cl_vals, self.cells_all, self.DP_a)
         self.CRP_prior = np.append(0, CRP_prior)
 
 
-    def _calc_ll(self, x, theta, flat=False):
+    def _calc_ll(self, x, theta, flat=False, w=1):
         ll_FN = theta * self._Bernoulli_FN(x)
         ll_FP = (1 - theta) * self._Bernoulli_FP(x)
-        ll_full = np.log(ll_FN + ll_FP)
+        ll_full = np.log(ll_FN + ll_FP) * w
         if flat:
             return bn.nansum(ll_full)
         else:
             return bn.nansum(ll_full, axis=1)
 
 
+    def _calc_ll_rows(self, rows, theta, flat=False):
+        """ Log likelihood of the data rows given theta (m: one parameter
+        vector, K x m: one cell and K clusters)
+        """
+        if self.block_size:
+            ll = [self._calc_ll(x, theta, flat, self.weights[i]) \
+                for i, x in self._iter_blocks(rows)]
+            return np.sum(ll) if flat else np.concatenate(ll)
+        elif not self.sparse:
+            return self._calc_ll(self.data[rows], theta, flat, self.weights[rows])
+
+        l1, l0 = self._log_Bernoulli(np.asarray(theta, dtype=np.float64))
+        ll = self.data_ones[rows] @ l1.T + self.data_zeros[rows] @ l0.T
+        if flat:
+            return ll.sum()
+        elif ll.ndim == 2:
+            return ll[0]
+        return ll
+
+
+    def _calc_ll_assigned(self, FP=None, FN=None):
+        # Sparse or out-of-core data: log likelihood of all cells given their
+        # cluster
+        if self.block_size:
+            ll = 0
+            for i, x in self._iter_blocks():
+                l1, l0 = self._log_Bernoulli(
+                    self.parameters[self.assignment[i]].astype(np.float64),
+                    FP, FN
+                )
+                ll += bn.nansum((x * l1 + (1 - x) * l0) * self.weights[i])
+            return ll
+
+        cl, cl_idx = np.unique(self.assignment, return_inverse=True)
+        l1, l0 = self._log_Bernoulli(
+            self.parameters[cl].astype(np.float64), FP, FN
+        )
+        ll = 0
+        for mat, l in [(self.data_ones, l1), (self.data_zeros, l0)]:
+            rows = np.repeat(cl_idx, np.diff(mat.indptr))
+            ll += np.sum(mat.data * l[rows, mat.indices])
+        return ll
+
+
+    def _get_counts(self, rows, fkt=1):
+        # Weighted number of observed 1s and 0s per mutation
+        if self.sparse:
+            ones = np.asarray(self.data_ones[rows].sum(axis=0)).ravel()
+            zeros = np.asarray(self.data_zeros[rows].sum(axis=0)).ravel()
+            return ones * fkt, zeros * fkt
+        elif self.block_size:
+            ones, zeros = 0, 0
+            for i, x in self._iter_blocks(rows):
+                w = self.weights[i] * fkt
+                ones = ones + bn.nansum(x * w, axis=0)
+                zeros = zeros + bn.nansum((1 - x) * w, axis=0)
+            return ones, zeros
+        x = self.data[rows]
+        w = self.weights[rows]
+        return bn.nansum(x * w * fkt, axis=0), \
+            bn.nansum((1 - x) * w * fkt, axis=0)
+
+
+    def _get_count_rows(self, rows):
+        # Weighted 1s and 0s of each row (rows x m)
+        if self.sparse:
+            return self.data_ones[rows], self.data_zeros[rows]
+
+        rows = np.arange(self.cells_total)[rows]
+        ones = np.empty((rows.size, self.muts_total), dtype=np.float32)
+        zeros = np.empty((rows.size, self.muts_total), dtype=np.float32)
+        if self.block_size:
+            blocks = self._iter_blocks(rows)
+        else:
+            blocks = [(rows, self.data[rows])]
+        start = 0
+        for i, x in blocks:
+            w = self.weights[i]
+            ones[start:start + i.size] = np.nan_to_num(x * w)
+            zeros[start:start + i.size] = np.nan_to_num((1 - x) * w)
+            start += i.size
+        return ones, zeros
+
+
+    def _calc_ll_counts(self, theta, counts, flat=True):
+        # Log likelihood given the weighted number of 1s and 0s per mutation
+        l1, l0 = self._log_Bernoulli(np.asarray(theta, dtype=np.float64))
+        ll = counts[0] * l1 + counts[1] * l0
+        if flat:
+            return ll.sum()
+        return ll
+
+
+    def _get_row_params(self, i):
+        # Parameters given by the observations of a single cell
+        if self.block_size:
+            return np.nan_to_num(
+                ut.compact_to_float(self.data[i]), nan=self._beta_mix_const[0]
+            )
+        elif not self.sparse:
+            return np.nan_to_num(self.data[i], nan=self._beta_mix_const[0])
+        theta = np.full(self.muts_total, self._beta_mix_const[0])
+        theta[self.data_ones.indices[
+            self.data_ones.indptr[i]:self.data_ones.indptr[i + 1]]] = 1
+        theta[self.data_zeros.indices[
+            self.data_zeros.indptr[i]:self.data_zeros.indptr[i + 1]]] = 0
+        return theta
+
+
+    def _log_Bernoulli(self, theta, FP=None, FN=None):
+        # Log probabilities of observing a 1 and a 0 given theta
+        if FP is None:
+            FP = self.FP
+        if FN is None:
+            FN = self.FN
+        return np.log(theta * (1 - FN) + (1 - theta) * FP), \
+            np.log(theta * FN + (1 - theta) * (1 - FP))
+
+
     def _Bernoulli_FN(self, x):
         return (1 - self.FN) ** x * self.FN ** (1 - x)
 
@@ -214,22 +593,47 @@ class CRP:
         return (1 - x) * (theta * self.FN + (1 - theta) * (1 - self.FP))
 
 
+    def get_lprior_weighted(self, cl_size, w, n):
+        """ Log CRP prior of adding a unit of w cells to clusters of size
+        cl_size, given n cells in total.
+        """
+        if w == 1:
+            return self.log_CRP_prior(cl_size, n, self.DP_a)
+        cl_size = np.asarray(cl_size)
+        return gammaln(cl_size + w) - gammaln(cl_size) \
+            - np.log(n - 1 + self.DP_a)
+
+
     def get_lpost_single(self, cell_id, cl_ids):
-        ll_single = self._calc_ll(self.data[[cell_id]], self.parameters[cl_ids])
+        ll_single = self._calc_ll_rows([cell_id], self.parameters[cl_ids])
         cl_size = np.fromiter(self.cells_per_cluster.values(), dtype=int)
-        lprior = self.CRP_prior[cl_size]
-        return ll_single + lprior
+        w = self.cell_weights[cell_id]
+        if w == 1:
+            lprior = self.CRP_prior[cl_size]
+        else:
+            lprior = self.get_lprior_weighted(cl_size, w, self.cells_all)
+        return ll_single * self.inv_temp + lprior
+
 
+    def get_lpost_single_new_cluster(self, rows=slice(None)):
+        if self.sparse or self.block_size:
+            theta = np.full(self.muts_total, self._beta_mix_const[1])
+            return self._calc_ll_rows(rows, theta) * self.inv_temp \
+                + self.CRP_prior[-1] + self._lgamma_weights[rows]
 
-    def get_lpost_single_new_cluster(self):
-        ll_FP = self._beta_mix_const[0] * self._Bernoulli_FP(self.data)
-        ll_FN = self._beta_mix_const[1] * self._Bernoulli_FN(self.data)
-        ll_full = np.log(ll_FN + ll_FP)
-        return bn.nansum(ll_full, axis=1) + self.CRP_prior[-1]
+        x = self.data[rows]
+        ll_FP = self._beta_mix_const[0] * self._Bernoulli_FP(x)
+        ll_FN = self._beta_mix_const[1] * self._Bernoulli_FN(x)
+        ll_full = np.log(ll_FN + ll_FP) * self.weights[rows]
+        return bn.nansum(ll_full, axis=1) * self.inv_temp + self.CRP_prior[-1] \
+            + self._lgamma_weights[rows]
 
 
     def get_ll_full(self):
-        return self._calc_ll(self.data, self.parameters[self.assignment], True)
+        if self.sparse or self.block_size:
+            return self._calc_ll_assigned()
+        return self._calc_ll(self.data, self.parameters[self.assignment], True,
+            self.weights)
 
 
     def get_lprior_full(self):
@@ -245,29 +649,57 @@ class CRP:
         return lprior
 
 
-    def update_assignments_Gibbs(self):
-        """ Update the assignmen of cells to clusters by Gipps sampling
+    def _get_minibatch(self, fraction):
+        """ Next batch of a systematic scan: each pass over a random
+        permutation of the rows is split into ceil(1 / fraction) batches, so
+        every row is updated once per pass
+        """
+        if not self.gibbs_queue:
+            self.gibbs_queue = np.array_split(
+                np.random.permutation(self.cells_total),
+                int(np.ceil(1 / fraction))
+            )
+        return self.gibbs_queue.pop()
+
+
+    def update_assignments_Gibbs(self, fraction=1):
+        """ Update the assignmen of cells to clusters by Gipps sampling. If
+        fraction < 1, only a minibatch of the cells is updated. Tempered
+        replicas (inv_temp < 1) neither open nor close clusters.
 
         """
-        new_cl_post = self.get_lpost_single_new_cluster()
+        births = self.has_births()
+        if fraction < 1:
+            cells = self._get_minibatch(fraction)
+            new_cl_post = np.empty(self.cells_total)
+            if births:
+                new_cl_post[cells] = self.get_lpost_single_new_cluster(cells)
+        else:
+            if births:
+                new_cl_post = self.get_lpost_single_new_cluster()
+            cells = np.random.permutation(self.cells_total)
         test = np.zeros(self.cells_total)
-        for cell_id in np.random.permutation(self.cells_total):
+        for cell_id in cells:
             # Remove cell from cluster
             old_cluster = self.assignment[cell_id]
-            if self.cells_per_cluster[old_cluster] == 1:
+            w = self.cell_weights[cell_id]
+            if self.cells_per_cluster[old_cluster] == w:
+                if not births:
+                    continue
                 del self.cells_per_cluster[old_cluster]
             else:
-                self.cells_per_cluster[old_cluster] -= 1
+                self.cells_per_cluster[old_cluster] -= w
 
             cl_ids = np.fromiter(self.cells_per_cluster.keys(), dtype=int)
             # Probability of joining an existing cluster
-            post_old = self.get_lpost_single(cell_id, cl_ids)
+            lpost = self.get_lpost_single(cell_id, cl_ids)
             # Probability of starting a new cluster
-            post_new = new_cl_post[cell_id]
+            if births:
+                lpost = np.append(lpost, new_cl_post[cell_id])
+                cl_ids = np.append(cl_ids, -1)
             # Sample new cluster assignment from posterior
-            probs_norm = self._normalize_log_probs(np.append(post_old, post_new))
+            probs_norm = self._normalize_log_probs(lpost)
 
-            cl_ids = np.append(cl_ids, -1)
             new_cluster_id = np.random.choice(cl_ids, p=probs_norm)
 
             # Start a new cluster
@@ -277,9 +709,16 @@ class CRP:
             # Assign to cluster
             self.assignment[cell_id] = new_cluster_id
             try:
-                self.cells_per_cluster[new_cluster_id] += 1
+                self.cells_per_cluster[new_cluster_id] += w
             except KeyError:
-                self.cells_per_cluster[new_cluster_id] = 1
+                self.cells_per_cluster[new_cluster_id] = w
+
+
+    def has_births(self):
+        """ The new cluster marginal and the parameters of a new cluster are
+        untempered: Gibbs moves of tempered replicas keep the clusters.
+        """
+        return self.inv_temp == 1
 
 
     def init_new_cluster(self, cell_id):
@@ -289,43 +728,120 @@ class CRP:
 
 
     def get_empty_cluster(self):
-        return next(i for i in range(self.cells_total) 
+        cl_id = next(i for i in range(self.cells_total) 
             if i not in self.cells_per_cluster)
+        self._reserve_clusters(cl_id + 1)
+        return cl_id
+
 
+    def _reserve_clusters(self, k):
+        # Parameter rows for cluster ids < k, grown by doubling
+        rows = self.parameters.shape[0]
+        if k <= rows:
+            return
+        add = min(max(k, 2 * rows), self.cells_total) - rows
+        self.parameters = np.append(self.parameters,
+            np.full((add, self.muts_total), TMIN, dtype=np.float32), axis=0)
 
-    def update_parameters(self, step_no=None):
+
+    def update_parameters(self, step_no=None, adapt=False, augment=False):
+        # Tempered likelihoods are not augmented: MH updates instead
+        if augment and self.inv_temp == 1:
+            return self._update_parameters_augmented()
         # Iterate over all populated clusters
         declined_t = np.zeros(len(self.cells_per_cluster), dtype= int)
+        declined_muts = np.zeros(self.muts_total)
         for i, cl_id in enumerate(self.cells_per_cluster):
             self.parameters[cl_id], _, declined = self.MH_cluster_params(
                 self.parameters[cl_id],
                 np.argwhere(self.assignment == cl_id).flatten()
             )
-            declined_t[i] = declined
+            declined_t[i] = declined.sum()
+            declined_muts += declined
+
+        if adapt:
+            self.param_adapt_steps += 1
+            self.param_proposal_scale = self._adapt_scale(
+                self.param_proposal_scale,
+                1 - declined_muts / declined_t.size, self.param_adapt_steps
+            )
         return bn.nansum(declined_t), bn.nansum(self.muts_total - declined_t)
 
 
-    def MH_cluster_params(self, old_params, cells, trans_prob=False):
+    def _update_parameters_augmented(self):
+        """ Gibbs update of the cluster parameters by data augmentation: the
+        latent genotypes of the observed entries are drawn given the current
+        parameters and error rates, the parameters from their Beta posterior
+        given the genotype counts. Missing entries do not contribute.
+        """
+        # Latent genotype counts: true pos., false neg., false pos., true neg.
+        self.latent_counts = np.zeros(4)
+        for cl_id in self.cells_per_cluster:
+            ones, zeros = self._get_counts(
+                np.argwhere(self.assignment == cl_id).flatten()
+            )
+            ones = np.rint(ones).astype(int)
+            zeros = np.rint(zeros).astype(int)
+
+            theta = self.parameters[cl_id]
+            p_ones = theta * (1 - self.FN) \
+                / (theta * (1 - self.FN) + (1 - theta) * self.FP)
+            p_zeros = theta * self.FN \
+                / (theta * self.FN + (1 - theta) * (1 - self.FP))
+            true_pos = np.random.binomial(ones, p_ones)
+            false_neg = np.random.binomial(zeros, p_zeros)
+
+            self.parameters[cl_id] = np.clip(np.random.beta(
+                self.p + true_pos + false_neg,
+                self.q + ones - true_pos + zeros - false_neg
+            ), TMIN, TMAX)
+            self.latent_counts += [true_pos.sum(), false_neg.sum(),
+                (ones - true_pos).sum(), (zeros - false_neg).sum()]
+
+        return 0, len(self.cells_per_cluster) * self.muts_total
+
+
+    @staticmethod
+    def _adapt_scale(scale, accept_rate, step):
+        """ Robbins-Monro update of a proposal scale toward the target
+        acceptance rate, with decreasing step size
+        """
+        scale = scale * np.exp(step ** -ADAPT_DECAY * (accept_rate - ADAPT_TARGET))
+        return np.clip(scale, *ADAPT_SCALE)
+
+
+    def _get_param_proposal_sd(self, size):
+        return np.random.choice(self.param_proposal_sd, size=size) \
+            * self.param_proposal_scale
+
+
+    def MH_cluster_params(self, old_params, cells, trans_prob=False,
+                counts=None):
         """ Update cluster parameters
 
         Arguments:
             old_parameter (float): old val of cluster parameter
             data (np.array): data for cells in the cluster
+            counts ((np.array, np.array)): Weighted 1s and 0s per mutation of
+                the cells, used instead of their data if given
 
         Return:
             np.array: New cluster parameter
             float: Sum of MH decision paramters A
-            int: Number of declined MH updates
+            np.array: Declined MH updates (per mutation)
         """
 
         # Propose new parameter from normal distribution
-        std = np.random.choice(self.param_proposal_sd, size=self.muts_total)
+        std = self._get_param_proposal_sd(self.muts_total)
         a = (TMIN - old_params) / std 
         b = (TMAX - old_params) / std
-        new_params = truncnorm.rvs(a, b, loc=old_params, scale=std) \
-            .astype(np.float32)
+        with np.errstate(under='ignore'):
+            new_params = truncnorm.rvs(a, b, loc=old_params, scale=std) \
+                .astype(np.float32)
 
-        A = self._get_log_A(new_params, old_params, cells, a, b, std, trans_prob)
+        A = self._get_log_A(
+            new_params, old_params, cells, a, b, std, trans_prob, counts
+        )
         u = np.log(np.random.random(self.muts_total))
 
         decline = u >= A
@@ -333,33 +849,43 @@ class CRP:
 
         if trans_prob:
             A[decline] = np.log(-1 * np.expm1(A[decline]))
-            return new_params, bn.nansum(A), bn.nansum(decline)
+            return new_params, bn.nansum(A), decline
         else:
-            return new_params, np.nan, bn.nansum(decline)
+            return new_params, np.nan, decline
 
 
-    def _get_log_A(self, new_params, old_params, cells, a, b, std, clip=False):
+    def _get_log_A(self, new_params, old_params, cells, a, b, std, clip=False,
+                counts=None):
         """ Calculate the MH acceptance paramter A
         """
         # Calculate the transition probabilitites
-        new_p_target = truncnorm \
-            .logpdf(new_params, a, b, loc=old_params, scale=std)
-
         a_rev = (TMIN - new_params) / std
         b_rev = (TMAX - new_params) / std
-        old_p_target = truncnorm \
-            .logpdf(old_params, a_rev, b_rev, loc=new_params, scale=std)
+        with np.errstate(under='ignore'):
+            new_p_target = truncnorm \
+                .logpdf(new_params, a, b, loc=old_params, scale=std)
+            old_p_target = truncnorm \
+                .logpdf(old_params, a_rev, b_rev, loc=new_params, scale=std)
 
         # Calculate the log likelihoods
-        x = self.data[cells]
-        ll_FN = self._Bernoulli_FN(x)
-        ll_FP = self._Bernoulli_FP(x)
-        new_ll = bn.nansum(
-            np.log(new_params * ll_FN + (1 - new_params) * ll_FP), axis=0
-        )
-        old_ll = bn.nansum(
-            np.log(old_params * ll_FN + (1 - old_params) * ll_FP), axis=0
-        )
+        if counts is None and (self.sparse or self.block_size):
+            counts = self._get_counts(cells)
+        if counts is not None:
+            new_ll = self._calc_ll_counts(new_params, counts, False)
+            old_ll = self._calc_ll_counts(old_params, counts, False)
+        else:
+            x = self.data[cells]
+            w = self.weights[cells]
+            ll_FN = self._Bernoulli_FN(x)
+            ll_FP = self._Bernoulli_FP(x)
+            new_ll = bn.nansum(
+                np.log(new_params * ll_FN + (1 - new_params) * ll_FP) * w,
+                axis=0
+            )
+            old_ll = bn.nansum(
+                np.log(old_params * ll_FN + (1 - old_params) * ll_FP) * w,
+                axis=0
+            )
 
         # Calculate the priors
         if self.beta_prior_uniform:
@@ -369,7 +895,8 @@ class CRP:
             new_prior = self.param_prior.logpdf(new_params)
             old_prior = self.param_prior.logpdf(old_params)
 
-        A = new_ll + new_prior - old_ll - old_prior + old_p_target - new_p_target
+        A = new_ll * self.inv_temp + new_prior - old_ll * self.inv_temp \
+            - old_prior + old_p_target - new_p_target
 
         if clip:
             return np.clip(A, a_min=None, a_max=0)
@@ -385,9 +912,9 @@ class CRP:
         """
         k = len(self.cells_per_cluster)
         # Escobar, D., West, M. (1995) - Eq. 14
-        eta = np.random.beta(self.DP_a + 1, self.cells_total)
+        eta = np.random.beta(self.DP_a + 1, self.cells_all)
         w = (self.DP_a_gamma[0] + k - 1) \
-            / (self.cells_total * (self.DP_a_gamma[1] - np.log(eta)))
+            / (self.cells_all * (self.DP_a_gamma[1] - np.log(eta)))
         pi_eta = w / (1 + w)
 
         # Escobar, D., West, M. (1995) - Eq. 13
@@ -404,28 +931,441 @@ class CRP:
         self.init_DP_prior()
 
 
+# ------------------------------------------------------------------------------
+# GRID-COLLAPSED GIBBS
+# ------------------------------------------------------------------------------
+
+    def _init_grid(self, size):
+        """ Grid over the cluster parameters and the table of the marginal
+        log likelihood of n1 1s and n0 0s per mutation, integrated over the
+        grid: T[n1, n0] = log sum_g prior_g * P(1|g)^n1 * P(0|g)^n0
+        """
+        if self.grid_counts is None:
+            if self.sparse:
+                ones, zeros = self.data_ones, self.data_zeros
+            else:
+                if self.block_size:
+                    blocks = self._iter_blocks()
+                else:
+                    blocks = [(np.arange(self.cells_total), self.data)]
+                ones, zeros = [], []
+                for i, x in blocks:
+                    w = self.weights[i]
+                    ones.append(sp.csr_matrix(np.nan_to_num(x * w)))
+                    zeros.append(sp.csr_matrix(np.nan_to_num((1 - x) * w)))
+                ones, zeros = sp.vstack(ones, 'csr'), sp.vstack(zeros, 'csr')
+            self.grid_counts = []
+            for mat in [ones, zeros]:
+                mat = sp.csr_matrix(mat, dtype=np.int64, copy=True)
+                mat.data = np.rint(mat.data).astype(np.int64)
+                self.grid_counts.append(mat)
+
+        key = (size, self.FP, self.FN, self.inv_temp)
+        if key == self.grid_key:
+            return
+        self.grid_key = key
+
+        self.grid = (np.arange(size) + 0.5) / size
+        lprior = self.param_prior.logpdf(self.grid)
+        self.grid_lprior = lprior - logsumexp(lprior)
+        l1, l0 = self._log_Bernoulli(self.grid)
+        self.grid_l1 = l1 * self.inv_temp
+        self.grid_l0 = l0 * self.inv_temp
+
+        max_ones, max_zeros = [int(i.sum(axis=0).max()) for i in self.grid_counts]
+        if (max_ones + 1) * (max_zeros + 1) > GRID_TABLE_MAX:
+            self.grid_table = None
+            return
+        n0 = np.arange(max_zeros + 1)[:, np.newaxis] * self.grid_l0
+        self.grid_table = np.empty((max_ones + 1, max_zeros + 1))
+        with np.errstate(under='ignore'):
+            for n1 in range(max_ones + 1):
+                self.grid_table[n1] = logsumexp(
+                    self.grid_lprior + n1 * self.grid_l1 + n0, axis=1
+                )
+
+
+    def _grid_ml(self, ones, zeros):
+        # Marginal log likelihood per count: table lookup if available
+        if self.grid_table is not None:
+            return self.grid_table[ones, zeros]
+        with np.errstate(under='ignore'):
+            return logsumexp(self.grid_lprior
+                + ones[..., np.newaxis] * self.grid_l1
+                + zeros[..., np.newaxis] * self.grid_l0, axis=-1)
+
+
+    def update_assignments_Gibbs_collapsed(self, grid_size=100):
+        """ Update the assignment of cells to clusters by collapsed Gibbs
+        sampling: the cluster parameters are integrated out over a grid, such
+        that only the count arrays of the clusters are needed. Afterwards,
+        the parameters are drawn from their grid posterior.
+        """
+        self._init_grid(grid_size)
+        ones, zeros = self.grid_counts
+
+        # Count arrays of the clusters (rows: cluster ids in cl_ids). The
+        # first k rows are used, the rest are preallocated free rows (size 0,
+        # all counts 0) for new clusters.
+        k = len(self.cells_per_cluster)
+        cap = min(self.cells_total, 2 * k)
+        cl_ids = np.full(cap, -1, dtype=int)
+        cl_ids[:k] = list(self.cells_per_cluster)
+        slots = np.zeros(self.cells_total, dtype=int)
+        slots[cl_ids[:k]] = np.arange(k)
+        slots = slots[self.assignment]
+        members = sp.csr_matrix(
+            (np.ones(self.cells_total), (slots, np.arange(self.cells_total))),
+            shape=(cap, self.cells_total)
+        )
+        counts = [np.rint((members @ i).toarray()).astype(np.int64) \
+            for i in [ones, zeros]]
+        cl_size = np.zeros(cap, dtype=int)
+        cl_size[:k] = [self.cells_per_cluster[i] for i in cl_ids[:k]]
+
+        for cell_id in np.random.permutation(self.cells_total):
+            idx1 = ones.indices[ones.indptr[cell_id]:ones.indptr[cell_id + 1]]
+            w1 = ones.data[ones.indptr[cell_id]:ones.indptr[cell_id + 1]]
+            idx0 = zeros.indices[zeros.indptr[cell_id]:zeros.indptr[cell_id + 1]]
+            w0 = zeros.data[zeros.indptr[cell_id]:zeros.indptr[cell_id + 1]]
+            w = self.cell_weights[cell_id]
+
+            # Remove cell from cluster
+            old = slots[cell_id]
+            counts[0][old, idx1] -= w1
+            counts[1][old, idx0] -= w0
+            cl_size[old] -= w
+            if cl_size[old] == 0:
+                del self.cells_per_cluster[cl_ids[old]]
+                # Move the last used row into the freed one
+                k -= 1
+                if old != k:
+                    for i in counts:
+                        i[old] = i[k]
+                        i[k] = 0
+                    cl_size[old], cl_size[k] = cl_size[k], 0
+                    cl_ids[old] = cl_ids[k]
+                    slots[slots == k] = old
+                cl_ids[k] = -1
+            else:
+                self.cells_per_cluster[cl_ids[old]] = cl_size[old]
+
+            # Marginal likelihood ratio of joining the existing clusters
+            c1, c0 = counts[0][:k, idx1], counts[1][:k, idx1]
+            ll_old = bn.nansum(
+                self._grid_ml(c1 + w1, c0) - self._grid_ml(c1, c0), axis=1)
+            c1, c0 = counts[0][:k, idx0], counts[1][:k, idx0]
+            ll_old += bn.nansum(
+                self._grid_ml(c1, c0 + w0) - self._grid_ml(c1, c0), axis=1)
+            ll_new = bn.nansum(self._grid_ml(w1, np.zeros_like(w1))) \
+                + bn.nansum(self._grid_ml(np.zeros_like(w0), w0))
+
+            if w == 1:
+                lprior = self.CRP_prior[cl_size[:k]]
+            else:
+                lprior = self.get_lprior_weighted(cl_size[:k], w,
+                    self.cells_all)
+            probs_norm = self._normalize_log_probs(np.append(
+                ll_old + lprior,
+                ll_new + self.CRP_prior[-1] + self._lgamma_weights[cell_id]
+            ))
+            new = np.random.choice(probs_norm.size, p=probs_norm)
+
+            # Start a new cluster in the first free row, grow if full
+            if new == k:
+                if k == cap:
+                    add = min(cap, self.cells_total - cap)
+                    counts = [np.append(i, np.zeros((add, self.muts_total),
+                        dtype=np.int64), axis=0) for i in counts]
+                    cl_size = np.append(cl_size, np.zeros(add, dtype=int))
+                    cl_ids = np.append(cl_ids, np.full(add, -1, dtype=int))
+                    cap += add
+                cl_ids[k] = self.get_empty_cluster()
+                k += 1
+            # Assign to cluster
+            slots[cell_id] = new
+            counts[0][new, idx1] += w1
+            counts[1][new, idx0] += w0
+            cl_size[new] += w
+            self.cells_per_cluster[cl_ids[new]] = cl_size[new]
+            self.assignment[cell_id] = cl_ids[new]
+
+        # Draw the cluster parameters from their grid posterior
+        lpost = self.grid_lprior \
+            + counts[0][:k, :, np.newaxis] * self.grid_l1 \
+            + counts[1][:k, :, np.newaxis] * self.grid_l0
+        with np.errstate(under='ignore'):
+            cdf = np.cumsum(np.exp(
+                lpost - lpost.max(axis=-1, keepdims=True)), axis=-1)
+        u = np.random.random(cdf.shape[:2]) * cdf[..., -1]
+        g = (cdf < u[..., np.newaxis]).sum(axis=-1)
+        theta = (g + np.random.random(g.shape)) / grid_size
+        self.parameters[cl_ids[:k]] = np.clip(theta, TMIN, TMAX)
+
+
+# ------------------------------------------------------------------------------
+# GIBBS WITH APPROXIMATE PROPOSALS
+# ------------------------------------------------------------------------------
+
+    def _init_bit_data(self):
+        # Bit-packed observed 1s and 0s of each row and their numbers
+        if self.bit_data is not None:
+            return
+        n_bytes = int(np.ceil(self.muts_total / 8))
+        ones = np.empty((self.cells_total, n_bytes), dtype=np.uint8)
+        zeros = np.empty((self.cells_total, n_bytes), dtype=np.uint8)
+        step = max(1, (self.block_size or 2 ** 22) // self.muts_total)
+        for i in range(0, self.cells_total, step):
+            c1, c0 = self._get_count_rows(slice(i, i + step))
+            if self.sparse:
+                c1, c0 = c1.toarray(), c0.toarray()
+            ones[i:i + step] = np.packbits(c1 > 0, axis=1)
+            zeros[i:i + step] = np.packbits(c0 > 0, axis=1)
+        self.bit_data = (ones, zeros, POPCOUNT[ones].sum(axis=1),
+            POPCOUNT[zeros].sum(axis=1))
+
+
+    def _set_geno_bits(self, cl_ids):
+        # Bit-packed rounded genotypes of the clusters
+        if self.geno_bits is None:
+            self.geno_bits = np.zeros_like(self.bit_data[0])
+        self.geno_bits[cl_ids] = np.packbits(
+            self.parameters[cl_ids] >= 0.5, axis=1
+        )
+
+
+    def _calc_ll_bits(self, rows, cl_ids):
+        # Approximate log likelihoods (rows x clusters): agreements of the
+        # bit-packed observations with the rounded cluster genotypes, counted
+        # by products of the unpacked bits
+        def unpack(x):
+            return np.unpackbits(x, axis=1, count=self.muts_total) \
+                .astype(np.float32)
+
+        ones, zeros, n1, n0 = self.bit_data
+        # Log likelihood of an observed 1 and 0 given genotype 1 (mut) or 0
+        l1_mut, l1_wt = np.log(1 - self.FN), np.log(self.FP)
+        l0_mut, l0_wt = np.log(self.FN), np.log(1 - self.FP)
+        geno = unpack(self.geno_bits[cl_ids]).T
+        mut1 = unpack(ones[rows]) @ geno
+        mut0 = unpack(zeros[rows]) @ geno
+        return mut1 * l1_mut + (n1[rows, None] - mut1) * l1_wt \
+            + mut0 * l0_mut + (n0[rows, None] - mut0) * l0_wt
+
+
+    def _get_candidate_cache(self, cells, cl_ids, size):
+        """ Per cell: the <size> clusters with the highest approximate
+        likelihoods (ties: lower cluster id first) and these likelihoods
+        """
+        cl_ids = np.sort(cl_ids)
+        size = min(size, cl_ids.size)
+        ids = np.empty((cells.size, size), dtype=int)
+        ll = np.empty((cells.size, size))
+        step = max(1, (self.block_size or 2 ** 22) // self.muts_total)
+        for i in range(0, cells.size, step):
+            ll_bits = self._calc_ll_bits(cells[i:i + step], cl_ids)
+            order = np.argsort(-ll_bits, axis=1, kind='stable')[:, :size]
+            ids[i:i + step] = cl_ids[order]
+            ll[i:i + step] = np.take_along_axis(ll_bits, order, axis=1)
+        return ids, ll
+
+
+    def _get_candidates(self, cell_id, cl_ids, cached, cached_ll, survivors,
+                born, n):
+        """ The <n> alive clusters (cl_ids) with the highest approximate
+        likelihoods: the cached clusters alive since the sweep start and the
+        clusters born during the sweep are ranked. If fewer than <n> cached
+        clusters survived, all clusters are ranked. Either way, the candidates
+        equal the top <n> of all alive clusters.
+        """
+        keep = survivors[cached]
+        if keep.sum() < n:
+            ids = cl_ids
+            ll = self._calc_ll_bits([cell_id], ids)[0]
+        else:
+            ids, ll = cached[keep][:n], cached_ll[keep][:n]
+            new = [i for i in born if i in self.cells_per_cluster]
+            if new:
+                ids = np.append(ids, new)
+                ll = np.append(ll, self._calc_ll_bits([cell_id], new)[0])
+        return ids[np.lexsort((ids, -ll))[:n]]
+
+
+    @staticmethod
+    def _get_candidate_proposal(lpost_cand, cand, n):
+        """ Proposal over all n options: the posterior restricted to the
+        candidates, mixed with a uniform distribution over all options
+        """
+        probs = np.full(n, GIBBS_MH_UNIFORM / n)
+        with np.errstate(under='ignore'):
+            probs[cand] += (1 - GIBBS_MH_UNIFORM) \
+                * CRP._normalize_log_probs(lpost_cand)
+        return probs
+
+
+    @staticmethod
+    def _accept_MH(lpost, probs, new, cur):
+        # Independence MH acceptance of option new, given the current option
+        log_A = lpost[new] - lpost[cur] + np.log(probs[cur]) \
+            - np.log(probs[new])
+        return np.log(np.random.random()) < log_A
+
+
+    def update_assignments_Gibbs_MH(self, candidates=8, fraction=1):
+        """ Update the assignment of cells to clusters by Metropolis-within-
+        Gibbs. The approximate likelihoods of all clusters count the
+        agreements of the bit-packed observations with the rounded cluster
+        genotypes. The exact posteriors are evaluated only for the
+        <candidates> clusters with the highest approximate likelihoods, the new
+        cluster and, if needed, the current and the proposed cluster. The
+        approximate likelihoods are ranked once per sweep, so each cell scores
+        only its cached clusters and the clusters born during the sweep.
+        Tempered replicas (inv_temp < 1) neither open nor close clusters.
+        """
+        births = self.has_births()
+        self._init_bit_data()
+        self._set_geno_bits(list(self.cells_per_cluster))
+
+        if fraction < 1:
+            cells = self._get_minibatch(fraction)
+            new_cl_post = np.empty(self.cells_total)
+            if births:
+                new_cl_post[cells] = self.get_lpost_single_new_cluster(cells)
+        else:
+            if births:
+                new_cl_post = self.get_lpost_single_new_cluster()
+            cells = np.random.permutation(self.cells_total)
+
+        # Clusters with the highest approximate likelihoods, per cell
+        cells = np.asarray(cells)
+        cached, cached_ll = self._get_candidate_cache(cells,
+            np.fromiter(self.cells_per_cluster.keys(), dtype=int),
+            GIBBS_MH_CACHE * candidates)
+        # Clusters alive since the sweep start and clusters born since
+        survivors = np.zeros(self.cells_total, dtype=bool)
+        survivors[list(self.cells_per_cluster)] = True
+        born = set()
+        cl_idx = np.empty(self.cells_total, dtype=int)
+
+        for i, cell_id in enumerate(cells):
+            # Remove cell from cluster
+            old_cluster = self.assignment[cell_id]
+            w = self.cell_weights[cell_id]
+            if self.cells_per_cluster[old_cluster] == w:
+                if not births:
+                    continue
+                del self.cells_per_cluster[old_cluster]
+                survivors[old_cluster] = False
+            else:
+                self.cells_per_cluster[old_cluster] -= w
+
+            cl_ids = np.fromiter(self.cells_per_cluster.keys(), dtype=int)
+            cl_size = np.fromiter(self.cells_per_cluster.values(), dtype=int)
+            if w == 1:
+                lprior = self.CRP_prior[cl_size]
+            else:
+                lprior = self.get_lprior_weighted(cl_size, w, self.cells_all)
+
+            # Candidates (independent of the current cluster) and new cluster
+            if cl_ids.size > candidates:
+                cl_idx[cl_ids] = np.arange(cl_ids.size)
+                cand = cl_idx[self._get_candidates(cell_id, cl_ids,
+                    cached[i], cached_ll[i], survivors, born, candidates)]
+            else:
+                cand = np.arange(cl_ids.size)
+            # Exact log posteriors, evaluated on demand
+            lpost = np.full(cl_ids.size + births, np.nan)
+            if births:
+                cand = np.append(cand, cl_ids.size)
+                lpost[-1] = new_cl_post[cell_id]
+
+            def set_exact(idx):
+                idx = idx[(idx < cl_ids.size) & np.isnan(lpost[idx])]
+                if idx.size:
+                    lpost[idx] = self._calc_ll_rows(
+                            [cell_id], self.parameters[cl_ids[idx]]
+                        ) * self.inv_temp + lprior[idx]
+
+            set_exact(cand)
+            probs = self._get_candidate_proposal(lpost[cand], cand, lpost.size)
+
+            # Current state: old cluster, or a new cluster if it was emptied
+            cur = np.flatnonzero(cl_ids == old_cluster)
+            cur = cur[0] if cur.size else cl_ids.size
+            new = np.random.choice(probs.size, p=probs)
+            if new != cur:
+                set_exact(np.array([new, cur]))
+                if not self._accept_MH(lpost, probs, new, cur):
+                    new = cur
+
+            # Start a new cluster
+            if new == cl_ids.size:
+                new_cluster_id = self.init_new_cluster(cell_id)
+                self._set_geno_bits([new_cluster_id])
+                born.add(new_cluster_id)
+            else:
+                new_cluster_id = cl_ids[new]
+            # Assign to cluster
+            self.assignment[cell_id] = new_cluster_id
+            try:
+                self.cells_per_cluster[new_cluster_id] += w
+            except KeyError:
+                self.cells_per_cluster[new_cluster_id] = w
+
+
 # ------------------------------------------------------------------------------
 # SPLIT MERGE MOVE FOR NON CONJUGATES
 # ------------------------------------------------------------------------------
 
-    def update_assignments_split_merge(self, ratios=[.75, .25], step_no=5):
+    def update_assignments_split_merge(self, ratios=[.75, .25], step_no=5,
+                anchors='random', partners='size'):
         """ Update the assignmen of cells to clusters by a split-merge move
 
+        Arguments:
+            anchors (str): Choice of the two split anchor cells: uniformly
+                (random) or by disagreement with the cluster parameters
+                (disagreement)
+            partners (str): Choice of the second merge cluster: by inverse
+                size (size) or by similarity of the cluster parameters
+                (similarity)
         """
         cluster_no = len(self.cells_per_cluster)
         if cluster_no == 1:
-            return (self.do_split_move(step_no), 0)
+            return (self.do_split_move(step_no, anchors, partners), 0)
         elif cluster_no == self.cells_total:
-            return (self.do_merge_move(step_no), 1)
+            return (self.do_merge_move(step_no, anchors, partners), 1)
         else:
             move = np.random.choice([0, 1], p=ratios)
             if move == 0:
-                return (self.do_split_move(step_no), move)
+                return (self.do_split_move(step_no, anchors, partners), move)
             else:
-                return (self.do_merge_move(step_no), move)
+                return (self.do_merge_move(step_no, anchors, partners), move)
+
+
+    @staticmethod
+    def _get_partner_lprobs(params, params_other):
+        # Log probs of the merge partners: decaying with the mean parameter
+        # distance
+        lprobs = -PARTNER_LAMBDA * np.mean(
+            np.abs(params_other - params), axis=1, dtype=np.float64
+        )
+        with np.errstate(under='ignore'):
+            return lprobs - logsumexp(lprobs)
 
 
-    def do_split_move(self, step_no=5):
+    def _get_anchor_weights(self, cells, params):
+        """ Weights of the cells as split anchor: mean absolute difference to
+        the cluster parameters over the observed mutations, relative to the
+        best fitting cell
+        """
+        ones, zeros = self._get_count_rows(cells)
+        params = params.astype(np.float64)
+        obs = np.asarray((ones + zeros).sum(axis=1)).ravel()
+        dis = (ones @ (1 - params) + zeros @ params) / np.maximum(obs, 1)
+        return dis - dis.min() + ANCHOR_DELTA
+
+
+    def do_split_move(self, step_no=5, anchors='random', partners='size'):
         clusters = np.fromiter(self.cells_per_cluster.keys(), dtype=int)
         cluster_size = np.fromiter(self.cells_per_cluster.values(), dtype=int)
         # Chose larger clusters more often for split move
@@ -438,19 +1378,41 @@ class CRP:
             if cells.size != 1:
                 break
 
-        # Get two random items from the cluster
-        obs_i_idx, obs_j_idx = np.random.choice(cells.size, size=2, replace=False)
+        if anchors == 'disagreement':
+            # Get a random item and one disagreeing with the cluster parameters
+            anchor_w = self._get_anchor_weights(cells, self.parameters[clust_i])
+            obs_i_idx = np.random.choice(cells.size)
+            anchor_w_j = anchor_w.copy()
+            anchor_w_j[obs_i_idx] = 0
+            obs_j_idx = np.random.choice(
+                cells.size, p=anchor_w_j / anchor_w_j.sum()
+            )
+            lanchor_prob = np.log(anchor_w[obs_j_idx]) \
+                - np.log(anchor_w.sum() - anchor_w[obs_i_idx])
+        else:
+            # Get two random items from the cluster
+            obs_i_idx, obs_j_idx = np.random.choice(
+                cells.size, size=2, replace=False
+            )
+            lanchor_prob = -np.log(cells.size - 1)
+        # Anchor j is moved by the first swap if it is the first cell
+        if obs_j_idx == 0:
+            obs_j_idx = obs_i_idx
         cells[0], cells[obs_i_idx] = cells[obs_i_idx], cells[0]
         cells[-1], cells[obs_j_idx] = cells[obs_j_idx], cells[-1]
 
         # Eq. 3 in paper, second term
         cluster_idx = np.argwhere(clusters == clust_i).flatten()
         ltrans_prob_size = np.log(cluster_probs[cluster_idx]) \
-            - np.log(self.cells_per_cluster[clust_i]) \
-            - np.log(self.cells_per_cluster[clust_i] - 1)
+            - np.log(cells.size) + lanchor_prob
 
         cluster_size_red = np.delete(cluster_size, cluster_idx)
-        cluster_size_data = (ltrans_prob_size, cluster_size_red)
+        if partners == 'similarity':
+            cluster_params_red = self.parameters[np.delete(clusters, cluster_idx)]
+        else:
+            cluster_params_red = None
+        cluster_size_data = (ltrans_prob_size, cluster_size_red, partners,
+            cluster_params_red)
 
         accept, new_assignment, new_params = self.run_rg_nc(
             'split', cells, cluster_size_data, step_no
@@ -467,23 +1429,41 @@ class CRP:
             )
             self.assignment[clust_new_cells] = clust_new
             # Update cell-number per cluster
-            self.cells_per_cluster[clust_i] -= clust_new_cells.size
-            self.cells_per_cluster[clust_new] = clust_new_cells.size
+            clust_new_size = self.cell_weights[clust_new_cells].sum()
+            self.cells_per_cluster[clust_i] -= clust_new_size
+            self.cells_per_cluster[clust_new] = clust_new_size
 
             return [1, 0]
         else:
             return [0, 1]
 
 
-    def do_merge_move(self, step_no=5):
+    def do_merge_move(self, step_no=5, anchors='random', partners='size'):
         clusters = np.fromiter(self.cells_per_cluster.keys(), dtype=int)
         cluster_size = np.fromiter(self.cells_per_cluster.values(), dtype=int)
         # Chose smaller clusters more often for split move
         cluster_size_inv = 1 / cluster_size
         cluster_probs = cluster_size_inv / cluster_size_inv.sum()
-        cl_i, cl_j = np.random.choice(
-            clusters, p=cluster_probs, size=2, replace=False
-        )
+        if partners == 'similarity':
+            # Chose a partner with similar parameters for the second cluster
+            i_idx = np.random.choice(clusters.size, p=cluster_probs)
+            cl_i = clusters[i_idx]
+            clusters_other = np.delete(clusters, i_idx)
+            partner_lprobs = self._get_partner_lprobs(
+                self.parameters[cl_i], self.parameters[clusters_other]
+            )
+            j_idx = np.random.choice(
+                clusters_other.size, p=np.exp(partner_lprobs)
+            )
+            cl_j = clusters_other[j_idx]
+            lcluster_prob = np.log(cluster_probs[i_idx]) + partner_lprobs[j_idx]
+        else:
+            cl_i, cl_j = np.random.choice(
+                clusters, p=cluster_probs, size=2, replace=False
+            )
+            ij_idx = np.argwhere((clusters == cl_j) | (clusters == cl_i)) \
+                .flatten()
+            lcluster_prob = bn.nansum(np.log(cluster_probs[ij_idx]))
 
         cells_i = np.argwhere(self.assignment == cl_i).flatten()
         obs_i_idx = np.random.choice(cells_i.size)
@@ -496,9 +1476,8 @@ class CRP:
         cells = np.concatenate((cells_i, cells_j)).flatten()
 
         # Eq. 6 in paper, second term
-        ij_idx = np.argwhere((clusters == cl_j) | (clusters == cl_i)).flatten()
-        cluster_size_data = bn.nansum(np.log(cluster_probs[ij_idx])) \
-            - bn.nansum(np.log(cluster_size[ij_idx]))
+        cluster_size_data = (lcluster_prob - np.log(cells_i.size) \
+            - np.log(cells_j.size), anchors)
 
         accept, new_params = self.run_rg_nc(
             'merge', cells, cluster_size_data, step_no
@@ -510,7 +1489,7 @@ class CRP:
             # Update Assignment
             self.assignment[cells_j] = cl_i
             # Update cells per cluster
-            self.cells_per_cluster[cl_i] += cells_j.size
+            self.cells_per_cluster[cl_i] += self.cell_weights[cells_j].sum()
             del self.cells_per_cluster[cl_j]
 
             return [1, 0]
@@ -522,7 +1501,7 @@ class CRP:
         # Jain, S., Neal, R. (2007) - Section 4.2: 3,1,1
         self._rg_init_split(cells)
         # Jain, S., Neal, R. (2007) - Section 4.2: 3,2,1
-        self.rg_params_merge = self._init_cl_params_new(cells)
+        self.rg_params_merge = self._draw_cl_params(*self.rg_counts_all)
 
         # Jain, S., Neal, R. (2007) - Section 4.2: 3,1,2 / 3,2,2
         # Do restricted Gibbs scans to reach y^{L_{split}} and y^{L_{merge}}
@@ -542,23 +1521,61 @@ class CRP:
         i = cells[0]
         j = cells[-1]
         S = cells[1:-1]
+        # Data of the cells is gathered once per move: counts of 1s and 0s
+        self.rg_rows = self._get_count_rows(S)
+        self.rg_anchor_counts = np.array(
+            [self._get_counts([i]), self._get_counts([j])], dtype=np.float64
+        )
+        self.rg_counts_all = self.rg_anchor_counts.sum(axis=0) + np.stack(
+            [np.asarray(k.sum(axis=0, dtype=np.float64)).ravel() \
+                for k in self.rg_rows]
+        )
+
         if S.size == 0:
-            self.rg_assignment = np.array([])
+            self.rg_assignment = np.array([], dtype=int)
         elif random:
             # assign cells to clusters i and j randomly
             self.rg_assignment = np.random.choice([0, 1], size=(S.size))
         else:
-            ll_i = self._calc_ll(self.data[S],
-                np.nan_to_num(self.data[i], nan=self._beta_mix_const[0]))
-            ll_j = self._calc_ll(self.data[S],
-                np.nan_to_num(self.data[j], nan=self._beta_mix_const[0]))
-            self.rg_assignment = np.where(ll_j > ll_i, 1, 0)
+            ll = self._rg_calc_ll(
+                np.stack([self._get_row_params(i), self._get_row_params(j)])
+            )
+            self.rg_assignment = np.where(ll[:, 1] > ll[:, 0], 1, 0)
+        self._rg_set_counts()
         #initialize cluster parameters
-        cells_i = np.append(S[np.argwhere(self.rg_assignment == 0)], i)
-        cells_j = np.append(S[np.argwhere(self.rg_assignment == 1)], j)
-        cl_i_params = self._init_cl_params_new(cells_i)
-        cl_j_params = self._init_cl_params_new(cells_j)
-        self.rg_params_split = np.stack([cl_i_params, cl_j_params])
+        self.rg_params_split = np.stack(
+            [self._draw_cl_params(*self._rg_get_counts(cl)) for cl in range(2)]
+        )
+        self.rg_ll = None
+
+
+    def _rg_set_counts(self, old_assignment=None):
+        """ Set the weighted 1s and 0s per mutation of launch cluster j, or
+        update them by the cells moved since old_assignment
+        """
+        if old_assignment is None:
+            self.rg_counts_j = self.rg_anchor_counts[1].copy()
+            moved = np.flatnonzero(self.rg_assignment == 1)
+            sign = np.ones(moved.size)
+        else:
+            moved = np.flatnonzero(self.rg_assignment != old_assignment)
+            sign = np.where(self.rg_assignment[moved] == 1, 1., -1.)
+        if moved.size > 0:
+            for k in range(2):
+                self.rg_counts_j[k] += self.rg_rows[k][moved].T @ sign
+
+
+    def _rg_get_counts(self, cl):
+        # Weighted 1s and 0s per mutation of launch cluster i (0) or j (1)
+        if cl == 1:
+            return self.rg_counts_j
+        return self.rg_counts_all - self.rg_counts_j
+
+
+    def _rg_calc_ll(self, params):
+        # Log likelihood of the cells in S given cluster i and j (|S| x 2)
+        l1, l0 = self._log_Bernoulli(np.asarray(params, dtype=np.float64))
+        return (self.rg_rows[0] @ l1.T + self.rg_rows[1] @ l0.T) * self.inv_temp
 
 
     def _rg_scan_split(self, cells, trans_prob=False):
@@ -575,7 +1592,7 @@ class CRP:
     def _rg_scan_merge(self, cells, trans_prob=False):
         # Update cluster parameters
         self.rg_params_merge, prob, _ = self.MH_cluster_params(
-            self.rg_params_merge, cells, trans_prob
+            self.rg_params_merge, cells, trans_prob, self.rg_counts_all
         )
         if trans_prob:
             return prob
@@ -583,60 +1600,89 @@ class CRP:
 
     def _rg_scan_params(self, cells, trans_prob=False):
         # Update parameters of cluster i and j
-        i = cells[0]
-        j = cells[-1]
-        S = cells[1:-1]
         prob = np.zeros(2)
         for cl in range(2):
-            if cl == 0:
-                cl_cells = np.append(S[np.argwhere(self.rg_assignment == 0)], i)
-            else:
-                cl_cells = np.append(S[np.argwhere(self.rg_assignment == 1)], j)
             self.rg_params_split[cl], prob[cl], _ = self.MH_cluster_params(
-                self.rg_params_split[cl], cl_cells, trans_prob
+                self.rg_params_split[cl], None, trans_prob,
+                self._rg_get_counts(cl)
             )
+        self.rg_ll = None
 
         if trans_prob:
             return prob.sum()
 
 
+    def _rg_get_cluster_sizes(self, cells, w_cell=0):
+        # Cells in cluster i and j (without a cell of weight w_cell set to -1)
+        w = self.cell_weights[cells]
+        n_j = w[-1] + w[1:-1][self.rg_assignment == 1].sum()
+        return w.sum() - n_j - w_cell, n_j
+
+
     def _rg_scan_assign(self, cells, trans_prob=False):
-        ll = self._rg_get_ll(cells[1:-1], self.rg_params_split)
-        n = cells.size
-        if trans_prob:
-            prob = np.zeros(n - 2)
-        
-        # Iterate over all obersavtions k
-        for cell in np.random.permutation(n - 2):
-            self.rg_assignment[cell] = -1
+        # Log likelihoods are only recalculated if the parameters changed
+        if self.rg_ll is None:
+            self.rg_ll = self._rg_calc_ll(self.rg_params_split)
+        ll_diff = (self.rg_ll[:, 1] - self.rg_ll[:, 0]).tolist()
+        w_S = self.cell_weights[cells[1:-1]].tolist()
+        n_i, n_j = [int(i) for i in self._rg_get_cluster_sizes(cells)]
+        old_assignment = self.rg_assignment
+        assignment = self.rg_assignment.tolist()
+        order = np.random.permutation(len(w_S)).tolist()
+        rand = np.random.random(len(w_S)).tolist()
+        prob = 0
+
+        # Iterate over all obersavtions k, keeping the cluster sizes updated
+        for cell in order:
+            w = w_S[cell]
+            if assignment[cell] == 1:
+                n_j -= w
+            else:
+                n_i -= w
             # Get normalized log probs of assigning an obs. to clusters i or j
-            # +1 to compensate obs = -1; +1 for observation j
-            n_j = bn.nansum(self.rg_assignment) + 2
-            n_i = n - n_j - 1
-            log_post = ll[cell] + self.log_CRP_prior([n_i, n_j], n, self.DP_a)
-            log_probs = self._normalize_log(log_post)
+            lprob_i, lprob_j = self._rg_log_probs(
+                ll_diff[cell] + self._rg_lprior_diff(n_i, n_j, w)
+            )
             # Sample new cluster assignment from posterior
-            new_clust = np.random.choice([0, 1], p=np.exp(log_probs))
-            
-            self.rg_assignment[cell] = new_clust
-            if trans_prob:
-                prob[cell] = log_probs[new_clust]
+            if rand[cell] < math.exp(lprob_j):
+                assignment[cell] = 1
+                n_j += w
+                prob += lprob_j
+            else:
+                assignment[cell] = 0
+                n_i += w
+                prob += lprob_i
 
+        self.rg_assignment = np.array(assignment, dtype=int)
+        self._rg_set_counts(old_assignment)
         if trans_prob:
-            return bn.nansum(prob)
+            return prob
 
 
-    def _rg_get_ll(self, cells, params):
-        ll_i = self._calc_ll(self.data[cells], params[0])
-        ll_j = self._calc_ll(self.data[cells], params[1])
-        return np.stack([ll_i, ll_j], axis=1)
+    @staticmethod
+    def _rg_lprior_diff(n_i, n_j, w):
+        # Log CRP prior ratio of adding w cells to cluster j instead of i
+        if w == 1:
+            return math.log(n_j) - math.log(n_i)
+        return math.lgamma(n_j + w) - math.lgamma(n_j) \
+            - math.lgamma(n_i + w) + math.lgamma(n_i)
+
+
+    @staticmethod
+    def _rg_log_probs(d):
+        # Normalized log probs of cluster i and j, given their log ratio d
+        if d > 0:
+            lprob_j = -math.log1p(math.exp(-d))
+            return lprob_j - d, lprob_j
+        lprob_i = -math.log1p(math.exp(d))
+        return lprob_i, lprob_i + d
 
 
     def _do_rg_split_MH(self, cells, size_data):
         A = self._get_trans_prob_ratio_split(cells) \
             + self._get_lprior_ratio_split(cells) \
             + self._get_ll_ratio(cells, 'split') \
-            + self._get_ltrans_prob_size_ratio_split(*size_data)
+            + self._get_ltrans_prob_size_ratio_split(cells, *size_data)
 
         if np.log(np.random.random()) < A:
             return (True, self.rg_assignment, self.rg_params_split)
@@ -648,7 +1694,7 @@ class CRP:
         A = self._get_trans_prob_ratio_merge(cells) \
             + self._get_lprior_ratio_merge(cells) \
             + self._get_ll_ratio(cells, 'merge') \
-            + self._get_ltrans_prob_size_ratio_merge(size_data)
+            + self._get_ltrans_prob_size_ratio_merge(cells, *size_data)
 
         if np.log(np.random.random()) < A:
             return (True, self.rg_params_merge)
@@ -662,13 +1708,14 @@ class CRP:
         # Do split GS: Launch to proposal state
         GS_split = self._rg_scan_split(cells, trans_prob=True)
         # Do merge GS: Launch to original state
-        std = np.random.choice(self.param_proposal_sd, size=self.muts_total)
+        std = self._get_param_proposal_sd(self.muts_total)
         a = (TMIN - self.rg_params_merge) / std
         b = (TMAX - self.rg_params_merge) / std
 
         GS_merge = bn.nansum(
             self._get_log_A(self.parameters[self.assignment[cells[0]]],
-                self.rg_params_merge, cells, a, b, std, True)
+                self.rg_params_merge, cells, a, b, std, True,
+                self.rg_counts_all)
         )
         return GS_merge - GS_split
 
@@ -686,9 +1733,8 @@ class CRP:
     def _get_lprior_ratio_split(self, cells):
         """ [eq. 7 in Jain and Neal, 2007]
         """
-        n = self.rg_assignment.size + 2
-        n_j = bn.nansum(self.rg_assignment) + 1
-        n_i = n - n_j
+        n_i, n_j = self._rg_get_cluster_sizes(cells)
+        n = n_i + n_j
         # Cluster assignment prior
         lprior_rate = np.log(self.DP_a) - gammaln(n)
         if n_i > 0:
@@ -707,29 +1753,25 @@ class CRP:
     def _get_ll_ratio(self, cells, move):
         """ [eq. 11/eq. 12 in Jain and Neal, 2007]
         """
-        i_ids = np.append(
-            cells[1:-1][np.argwhere(self.rg_assignment == 0)], cells[0]
+        ll_i = self._calc_ll_counts(
+            self.rg_params_split[0], self._rg_get_counts(0)
         )
-        j_ids = np.append(
-            cells[1:-1][np.nonzero(self.rg_assignment)], cells[-1]
+        ll_j = self._calc_ll_counts(
+            self.rg_params_split[1], self._rg_get_counts(1)
         )
-
-        ll_i = self._calc_ll(self.data[i_ids], self.rg_params_split[0], True)
-        ll_j = self._calc_ll(self.data[j_ids], self.rg_params_split[1], True)
-        ll_all = self._calc_ll(self.data[cells], self.rg_params_merge, True)
+        ll_all = self._calc_ll_counts(self.rg_params_merge, self.rg_counts_all)
 
         if move == 'split':
-            return ll_i + ll_j - ll_all
+            return (ll_i + ll_j - ll_all) * self.inv_temp
         else:
-            return ll_all - ll_i - ll_j
+            return (ll_all - ll_i - ll_j) * self.inv_temp
 
 
     def _get_lprior_ratio_merge(self, cells):
         """ [eq. 8 in Jain and Neal, 2007]
         """
-        n = cells.size
-        n_j = bn.nansum(self.rg_assignment) + 1
-        n_i = n - n_j
+        n_i, n_j = self._rg_get_cluster_sizes(cells)
+        n = n_i + n_j
         # Cluster priors
         lprior_rate = gammaln(n) - np.log(self.DP_a)
         if n_i > 0:
@@ -745,17 +1787,33 @@ class CRP:
         return lprior_rate
 
 
-    def _get_ltrans_prob_size_ratio_split(self, ltrans_prob_size, cluster_size):
-        n_j = bn.nansum(self.rg_assignment) + 1
-        n_i = self.rg_assignment.size + 2 - n_j 
+    def _get_ltrans_prob_size_ratio_split(self, cells, ltrans_prob_size,
+                cluster_size, partners='size', cluster_params=None):
+        n_i, n_j = self._rg_get_cluster_sizes(cells)
 
         # Eq. 5 paper, first term
         norm = bn.nansum(1 / np.append(cluster_size, [n_i, n_j]))
-        ltrans_prob_rev = np.log(1 / n_i / norm) + np.log(1 / n_j / norm)
+        if partners == 'similarity':
+            # Merge of cluster i with j among all other clusters
+            partner_lprobs = self._get_partner_lprobs(
+                self.rg_params_split[0],
+                np.vstack([cluster_params, self.rg_params_split[1:]])
+            )
+            ltrans_prob_rev = np.log(1 / n_i / norm) + partner_lprobs[-1]
+        else:
+            ltrans_prob_rev = np.log(1 / n_i / norm) + np.log(1 / n_j / norm)
         return ltrans_prob_rev - ltrans_prob_size[0]
 
 
-    def _get_ltrans_prob_size_ratio_merge(self, trans_prob_size):
+    def _get_ltrans_prob_size_ratio_merge(self, cells, trans_prob_size,
+                anchors='random'):
+        if anchors == 'disagreement':
+            # Split of the merged cluster with anchors i and j
+            anchor_w = self._get_anchor_weights(cells, self.rg_params_merge)
+            ltrans_prob_rev = np.log(self.cell_weights[cells].sum()) \
+                - np.log(self.cells_all) - np.log(cells.size) \
+                + np.log(anchor_w[-1]) - np.log(anchor_w.sum() - anchor_w[0])
+            return ltrans_prob_rev - trans_prob_size
         # Eq. 6, paper
         try:
             ltrans_prob_rev = -np.log(self.cells_total) \
@@ -766,7 +1824,7 @@ class CRP:
 
 
     def _rg_get_split_prob(self, cells):
-        std = np.random.choice(self.param_proposal_sd, size=(2, self.muts_total))
+        std = self._get_param_proposal_sd((2, self.muts_total))
         a = (0 - self.rg_params_split) / std
         b = (1 - self.rg_params_split) / std
 
@@ -777,39 +1835,38 @@ class CRP:
         S = cells[1:-1]
         # Get paramter transition probabilities
         prob_param_i = bn.nansum(self._get_log_A(
-            self.parameters[cl_i], self.rg_params_split[0],
-            np.append(S[np.argwhere(self.rg_assignment == 0)], i),
-            a[0], b[0], std[0], True
+            self.parameters[cl_i], self.rg_params_split[0], None,
+            a[0], b[0], std[0], True, self._rg_get_counts(0)
         ))
         prob_param_j = bn.nansum(self._get_log_A(
-            self.parameters[cl_j], self.rg_params_split[1],
-            np.append(S[np.argwhere(self.rg_assignment == 1)], j),
-            a[1], b[1], std[1], True
+            self.parameters[cl_j], self.rg_params_split[1], None,
+            a[1], b[1], std[1], True, self._rg_get_counts(1)
         ))
 
         # Get assignment transition probabilities
-        ll = self._rg_get_ll(
-            cells[1:-1], (self.parameters[cl_i], self.parameters[cl_j])
-        )
-        n = cells.size
-        prob_assign = np.zeros(S.size)
-
+        ll = self._rg_calc_ll(self.parameters[[cl_i, cl_j]])
+        w_S = self.cell_weights[S]
         assign = np.where(self.assignment[S] == cl_i, 0, 1)
-        # Iterate over all obersavtions k != [i,j]
-        for obs in range(S.size):
-            self.rg_assignment[obs] = -1
-            n_j = bn.nansum(self.rg_assignment) + 2
-            n_i = n - n_j - 1
-
-            # Get normalized log probs of assigning an obs. to clusters i or j
-            log_post = ll[obs] + self.log_CRP_prior([n_i, n_j], n, self.DP_a)
-            log_probs = self._normalize_log(log_post)
-            # assign to original cluster and add probability
-            self.rg_assignment[obs] = assign[obs]
-            prob_assign[obs] = log_probs[assign[obs]]
+        # Obs. k != [i,j] are assigned in order: cluster sizes with the obs.
+        # before k in their original and the ones after k in their launch
+        # cluster
+        w_j_orig = w_S * assign
+        w_j_launch = w_S * self.rg_assignment
+        n_j = self.cell_weights[j] + np.cumsum(w_j_orig) - w_j_orig \
+            + np.cumsum(w_j_launch[::-1])[::-1] - w_j_launch
+        n_i = self.cell_weights[cells].sum() - n_j - w_S
+        log_ratio = ll[:, 1] - ll[:, 0] + gammaln(n_j + w_S) - gammaln(n_j) \
+            - gammaln(n_i + w_S) + gammaln(n_i)
+        # Normalized log prob of the original cluster
+        with np.errstate(under='ignore'):
+            prob_assign = -np.logaddexp(0, np.where(assign == 1, -1, 1) \
+                * log_ratio)
+
+        old_assignment = self.rg_assignment
+        self.rg_assignment = assign
+        self._rg_set_counts(old_assignment)
 
         return prob_param_i + prob_param_j + bn.nansum(prob_assign)
 
-
 if __name__ == '__main__':
     print('Here be dragons....')
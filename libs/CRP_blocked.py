@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from scipy.special import gammaln
+
+try:
+    from libs.CRP import CRP, TMIN, TMAX
+    from libs.CRP_learning_errors import CRP_errors_learning
+except ImportError:
+    from CRP import CRP, TMIN, TMAX
+    from CRP_learning_errors import CRP_errors_learning
+
+
+# ------------------------------------------------------------------------------
+# BLOCKED GIBBS - TRUNCATED STICK-BREAKING
+# ------------------------------------------------------------------------------
+
+class CRP_blocked(CRP):
+    """ DPMM whose Gibbs sweep samples all assignments at once, given the
+    weights of a truncated stick-breaking representation of the DP.
+    Ishwaran, H., James, L. F. (2001). Gibbs Sampling Methods for
+    Stick-Breaking Priors. JASA, 96, 161-173.
+
+    The labelled stick-breaking posterior depends on the cluster labels:
+    split-merge moves, which open clusters at the lowest free label, are not
+    used.
+    """
+    split_merge = False
+
+    def __init__(self, *args, truncation=50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.truncation = int(min(truncation, self.cells_total))
+
+
+    def __str__(self):
+        return super().__str__() \
+            + f'\tblocked Gibbs:\ttruncation {self.truncation}\n'
+
+
+    def _calc_ll_matrix(self, theta):
+        """ Log likelihood of all cells given each of K parameter vectors
+        (cells x K)
+        """
+        l1, l0 = self._log_Bernoulli(np.asarray(theta, dtype=np.float64))
+        if self.sparse:
+            return self.data_ones @ l1.T + self.data_zeros @ l0.T
+
+        ll = np.empty((self.cells_total, theta.shape[0]))
+        step = max(1, (self.block_size or 2 ** 22) // self.muts_total)
+        for i in range(0, self.cells_total, step):
+            ones, zeros = self._get_count_rows(slice(i, i + step))
+            ll[i:i + step] = ones @ l1.T + zeros @ l0.T
+        return ll
+
+
+    def _get_stick_weights(self, sizes):
+        """ Draw the stick-breaking weights given the cluster sizes of the
+        K sticks (last stick: remaining weight)
+        """
+        rest = np.append(np.cumsum(sizes[::-1])[::-1][1:], 0)
+        V = np.random.beta(1 + sizes[:-1], self.DP_a + rest[:-1])
+        with np.errstate(divide='ignore'):
+            lV = np.append(np.log(V), 0)
+            l1_V = np.append(0, np.cumsum(np.log1p(-V)))
+        return lV + l1_V
+
+
+    def _get_lprior_labels(self, sizes):
+        # Log prior of the labelled assignment, stick weights integrated out
+        rest = np.append(np.cumsum(sizes[::-1])[::-1][1:], 0)[:-1]
+        n = sizes[:-1]
+        return np.sum(gammaln(1 + n) + gammaln(self.DP_a + rest)
+            - gammaln(1 + self.DP_a + n + rest))
+
+
+    def _swap_labels(self, sizes):
+        """ Label switching moves: neighbouring sticks swap their clusters,
+        accepted by the ratio of the labelled priors.
+        Hastie, D. I., Liverani, S., Richardson, S. (2015). Sampling from
+        Dirichlet process mixture models with unknown concentration
+        parameter: mixing issues in large data implementations. Statistics
+        and Computing, 25, 1023-1037.
+        """
+        K = sizes.size
+        labels = np.arange(K)
+        lprior = self._get_lprior_labels(sizes)
+        for k in np.random.randint(0, K - 1, size=K):
+            if sizes[k] == sizes[k + 1]:
+                continue
+            new_sizes = sizes.copy()
+            new_sizes[[k, k + 1]] = sizes[[k + 1, k]]
+            new_lprior = self._get_lprior_labels(new_sizes)
+            if np.log(np.random.random()) < new_lprior - lprior:
+                sizes, lprior = new_sizes, new_lprior
+                labels[[k, k + 1]] = labels[[k + 1, k]]
+
+        # Relabel the assignment and cluster parameters
+        new_labels = np.empty(K, dtype=int)
+        new_labels[labels] = np.arange(K)
+        self.assignment = new_labels[self.assignment]
+        self.parameters[:K] = self.parameters[labels]
+        return sizes
+
+
+    def _truncate_clusters(self):
+        """ Relabel the clusters to the first sticks. If there are more
+        clusters than sticks (e.g. after a random init), the largest ones are
+        kept and the cells of the others join their most likely kept cluster.
+        """
+        cl_ids = np.array(sorted(self.cells_per_cluster,
+            key=self.cells_per_cluster.get, reverse=True))
+        keep = cl_ids[:self.truncation]
+        labels = np.full(self.cells_total, -1)
+        labels[keep] = np.arange(keep.size)
+        self.assignment = labels[self.assignment]
+        self.parameters[:keep.size] = self.parameters[keep]
+
+        excess = np.flatnonzero(self.assignment < 0)
+        if excess.size:
+            ll = self._calc_ll_matrix(self.parameters[:keep.size])
+            self.assignment[excess] = np.argmax(ll[excess], axis=1)
+        sizes = np.bincount(self.assignment, weights=self.cell_weights)
+        self.cells_per_cluster = {
+            i: int(sizes[i]) for i in np.flatnonzero(sizes)
+        }
+
+
+    def update_assignments_Gibbs(self):
+        """ Update the assignment of cells to clusters by blocked Gibbs
+        sampling: all cells are assigned at once given the stick weights and
+        the cluster parameters. Cluster ids are the stick labels, empty
+        sticks get parameters drawn from the prior.
+        """
+        K = self.truncation
+        if self.assignment.max() >= K:
+            self._truncate_clusters()
+        self._reserve_clusters(K)
+        sizes = np.bincount(
+            self.assignment, weights=self.cell_weights, minlength=K
+        )
+        sizes = self._swap_labels(sizes)
+
+        empty = np.flatnonzero(sizes == 0)
+        self.parameters[empty] = np.clip(np.random.beta(
+            self.p, self.q, size=(empty.size, self.muts_total)
+        ), TMIN, TMAX)
+
+        # Categorical draw of all assignments (Gumbel-max)
+        lpost = self._calc_ll_matrix(self.parameters[:K]) * self.inv_temp \
+            + self._get_stick_weights(sizes)
+        self.assignment = np.argmax(
+            lpost + np.random.gumbel(size=lpost.shape), axis=1
+        )
+        sizes = np.bincount(
+            self.assignment, weights=self.cell_weights, minlength=K
+        )
+        self.cells_per_cluster = {
+            i: int(sizes[i]) for i in np.flatnonzero(sizes)
+        }
+
+
+# ------------------------------------------------------------------------------
+# BLOCKED GIBBS - LEARNING ERROR RATES
+# ------------------------------------------------------------------------------
+
+class CRP_blocked_errors(CRP_blocked, CRP_errors_learning):
+    pass
+
+
+if __name__ == '__main__':
+    print('Here be dragons...')
@@ -16,8 +16,10 @@ except ImportError:
 
 class CRP_errors_learning(CRP):
     def __init__(self, data, DP_alpha=1, param_beta=[1, 1], \
-                FP_mean=0.001, FP_sd=0.0005, FN_mean=0.25, FN_sd=0.05):
-        super().__init__(data, DP_alpha, param_beta, FN_mean, FP_mean)
+                FP_mean=0.001, FP_sd=0.0005, FN_mean=0.25, FN_sd=0.05,
+                weights=None, cell_rows=None, mut_cols=None, block_size=None):
+        super().__init__(data, DP_alpha, param_beta, FN_mean, FP_mean, weights,
+            cell_rows, mut_cols, block_size)
         # Error rate prior
         FP_trunc_a = (0 - FP_mean) / FP_sd
         FP_trunc_b = (1 - FP_mean) / FP_sd
@@ -30,11 +32,14 @@ class CRP_errors_learning(CRP):
         self.FN_prior = truncnorm(FN_trunc_a, FN_trunc_b, FN_mean, FN_sd)
         # self.FN_prior = beta(1, (1 - FN_mean) / FN_mean)
         self.FN_sd = np.array([FN_sd * 0.5, FN_sd, FN_sd * 1.5])
+        # Error proposal scales (FP, FN), adapted during burn-in
+        self.error_proposal_scale = np.ones(2)
+        self.error_adapt_steps = 0
 
 
     def __str__(self):
         out_str = '\nDPMM with:\n' \
-            f'\t{self.cells_total} cells\n\t{self.muts_total} mutations\n' \
+            f'\t{self.get_cells_str()}\n\t{self.get_muts_str()}\n' \
             f'\tlearning errors\n' \
             '\n\tPriors:\n' \
             f'\tparams.:\tBeta({self.p},{self.q})\n' \
@@ -49,30 +54,67 @@ class CRP_errors_learning(CRP):
             + self.FP_prior.logpdf(self.FP) + self.FN_prior.logpdf(self.FN)
 
 
-    def update_error_rates(self):
+    def update_error_rates(self, adapt=False, augment=False):
+        # Draw from the latent genotype counts of the parameter update
+        if augment and self.inv_temp == 1 and self.latent_counts is not None:
+            self.FP, FP_count = self.augmented_error_rates('FP')
+            self.FN, FN_count = self.augmented_error_rates('FN')
+            return FP_count, FN_count
+
         self.FP, FP_count = self.MH_error_rates('FP')
         self.FN, FN_count = self.MH_error_rates('FN')
+
+        if adapt:
+            self.error_adapt_steps += 1
+            self.error_proposal_scale = self._adapt_scale(
+                self.error_proposal_scale,
+                np.array([FP_count[0], FN_count[0]]), self.error_adapt_steps
+            )
         return FP_count, FN_count
 
 
     def get_ll_full_error(self, FP, FN):
+        if self.sparse or self.block_size:
+            return self._calc_ll_assigned(FP, FN)
         par = self.parameters[self.assignment]
         ll_FN = par * (1 - FN) ** self.data * FN ** (1 - self.data)
         ll_FP = (1 - par) * (1 - FP) ** (1 - self.data) * FP ** self.data
-        ll_full = np.log(ll_FN + ll_FP)
+        ll_full = np.log(ll_FN + ll_FP) * self.weights
         return bn.nansum(ll_full)
 
 
+    def augmented_error_rates(self, error_type):
+        """ Independence MH update of an error rate, proposed from the Beta
+        distribution given by the latent genotype counts. As the proposal is
+        proportional to the likelihood, the acceptance is the prior ratio.
+        """
+        true_pos, false_neg, false_pos, true_neg = self.latent_counts
+        if error_type == 'FP':
+            old_error = self.FP
+            prior = self.FP_prior
+            new_error = np.random.beta(false_pos + 1, true_neg + 1)
+        else:
+            old_error = self.FN
+            prior = self.FN_prior
+            new_error = np.random.beta(false_neg + 1, true_pos + 1)
+
+        A = prior.logpdf(new_error) - prior.logpdf(old_error)
+        if np.log(np.random.random()) < A:
+            return new_error, [1, 0]
+
+        return old_error, [0, 1]
+
+
     def MH_error_rates(self, error_type):
         # Set error specific values
         if error_type == 'FP':
             old_error = self.FP
             prior = self.FP_prior
-            stdevs = self.FP_sd
+            stdevs = self.FP_sd * self.error_proposal_scale[0]
         else:
             old_error = self.FN
             prior = self.FN_prior
-            stdevs = self.FN_sd
+            stdevs = self.FN_sd * self.error_proposal_scale[1]
 
         # Get new error from proposal distribution
         std = np.random.choice(stdevs)
@@ -84,11 +126,12 @@ class CRP_errors_learning(CRP):
             new_error = truncnorm.rvs(a, np.inf, loc=old_error, scale=std)
 
         # Calculate transition probabilitites
-        new_p_target = truncnorm \
-            .logpdf(new_error, a, b, loc=old_error, scale=std)
         a_rev, b_rev = (0 - new_error) / std, (1 - new_error) / std
-        old_p_target = truncnorm \
-            .logpdf(old_error, a_rev, b_rev, loc=new_error, scale=std)
+        with np.errstate(under='ignore'):
+            new_p_target = truncnorm \
+                .logpdf(new_error, a, b, loc=old_error, scale=std)
+            old_p_target = truncnorm \
+                .logpdf(old_error, a_rev, b_rev, loc=new_error, scale=std)
 
         # Calculate likelihood
         if error_type == 'FP':
@@ -103,7 +146,8 @@ class CRP_errors_learning(CRP):
         old_prior = prior.logpdf(old_error)
 
         # Calculate MH decision treshold
-        A = new_ll + new_prior - old_ll - old_prior + old_p_target - new_p_target
+        A = new_ll * self.inv_temp + new_prior - old_ll * self.inv_temp \
+            - old_prior + old_p_target - new_p_target
 
         if np.log(np.random.random()) < A:
             return new_error, [1, 0]
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
+from time import perf_counter
 from copy import deepcopy
+import os
+import queue as queue_mod
+import threading
+import traceback
 import numpy as np
 import multiprocessing as mp
 
@@ -15,34 +20,97 @@ except ImportError:
 
 np.seterr(all='raise')
 
+# Traces monitored by the online convergence diagnostics
+DIAGNOSTIC_TRACES = ['ML', 'DP_alpha', 'FN', 'FP', 'clusters']
+# Moves timed if profiling is enabled
+PROFILED_MOVES = ['Gibbs', 'split', 'merge', 'DP_alpha', 'parameters', 'errors',
+    'results']
+# Assignment moves weighted by the move scheduler, and their minimum probability
+SCHEDULED_MOVES = ['Gibbs', 'split', 'merge']
+SCHEDULE_MIN = 0.05
+# Decay of the scheduler statistics per step (weights recent moves higher)
+SCHEDULE_DECAY = 0.99
+
 # ------------------------------------------------------------------------------
 # MCMC CLASS
 # ------------------------------------------------------------------------------
 
 class MCMC:
     def __init__(self, model, sm_prob=0.33, dpa_prob=0.5, error_prob=0.1,
-                sm_ratios=[0.75, 0.25], sm_steps=5):
+                sm_ratios=[0.75, 0.25], sm_steps=5, sm_anchors='random',
+                sm_partners='size', grid=0, minibatch=1, gibbs_mh=0,
+                param_sampler='MH', adapt=False,
+                schedule=False, tempering=1,
+                tempering_min=0.1, swap_every=10, profile=False, checkpoint_dir='',
+                checkpoint_every=-1, init='random'):
         """
         Arguments
             model (object): Initialized model
             sm_prob (float): Probability of conducting a split merge move
             dpa_prob (float): Probability of updating alpha of the CRP
+            sm_anchors (str): Choice of the split anchor cells. Options:
+                random|disagreement
+            sm_partners (str): Choice of the second merge cluster. Options:
+                size|similarity
+            grid (int): Grid size for the grid-collapsed Gibbs sampler. If 0,
+                the Gibbs sampler conditions on the cluster parameters
+            minibatch (float): Fraction of the cells updated per Gibbs sweep,
+                in batches of a systematic scan (1 = all cells)
+            gibbs_mh (int): Number of candidate clusters per cell, selected
+                by approximate posteriors (bit-packed genotypes), for an MH
+                Gibbs update. If 0, the likelihood of all clusters is evaluated
+            param_sampler (str): Update of the cluster parameters and error
+                rates. Options: MH|augmented
+            adapt (bool): Adapt the parameter and error proposal scales toward
+                the target acceptance rate during burn-in
+            schedule (bool): Weight the assignment moves (Gibbs, split, merge)
+                by their reassigned cells per second during burn-in
+            tempering (int): Number of replicas per chain at decreasing inverse
+                temperatures (1 = no tempering)
+            tempering_min (float): Inverse temperature of the hottest replica
+            swap_every (int): Steps between two replica exchanges
+            profile (bool): Record wall time and calls per move
+            checkpoint_dir (str): Directory for chain checkpoints. If empty,
+                no checkpoints are written
+            checkpoint_every (int): Steps between two checkpoints. If < 1, only
+                the final state of a chain is saved
+            init (str): Initialization of the chains. Options:
+                random|separate|together|kmedoids|hierarchical|dispersed
 
         """
         # Init model and directory for results
         self.model = model
         self.chains = []
         self.seeds = []
+        self.init = init
+        self.init_states = []
         # Move probabilities
+        if not model.split_merge:
+            sm_prob = 0
         self.params = {
             'sm_prob': sm_prob,
             'dpa_prob': dpa_prob,
             'error_prob': error_prob,
-            # stdevs for paramter update
-            'param_proposal_sd': np.array([0.1, 0.25, 0.5]),
+            'grid': grid,
+            'minibatch': minibatch,
+            'gibbs_mh': gibbs_mh,
+            'param_sampler': param_sampler,
+            # Proposal scale adaptation and move scheduling during burn-in
+            'adapt': adapt,
+            'schedule': schedule,
+            # Parallel tempering
+            'tempering': tempering,
+            'tempering_min': tempering_min,
+            'swap_every': swap_every,
             # Split merge variables
             'sm_ratios': sm_ratios,
-            'sm_steps': sm_steps
+            'sm_steps': sm_steps,
+            'sm_anchors': sm_anchors,
+            'sm_partners': sm_partners,
+            'profile': profile,
+            # Checkpointing
+            'checkpoint_dir': checkpoint_dir,
+            'checkpoint_every': checkpoint_every
         }
 
 
@@ -50,14 +118,26 @@ class MCMC:
         out_str = 'Move probabilitites:\n' \
             '\tSplit/merge:\t{sm_prob}\n\t\tsplit/merge ratio:\t{sm_ratios}\n' \
             '\t\tintermediate Gibbs:\t{sm_steps}\n' \
+            '\t\tsplit anchors:\t\t{sm_anchors}\n' \
+            '\t\tmerge partners:\t\t{sm_partners}\n' \
             '\tCRP a_0 update:\t{dpa_prob}\n' \
             '\tErrors update:\t{error_prob}\n' \
-                .format(**self.params)
+            'Collapsed Gibbs grid:\t{grid}\n' \
+            'Gibbs minibatch:\t{minibatch}\n' \
+            'Gibbs MH candidates:\t{gibbs_mh}\n' \
+            'Parameter sampler:\t{param_sampler}\n' \
+            'Proposal adaptation:\t{adapt}\n' \
+            'Move scheduling:\t{schedule}\n' \
+            'Tempered replicas:\t{tempering}\n' \
+                .format(**self.params) \
+            + f'Initialization:\t{self.init}\n'
 
         return out_str
 
 
     def get_results(self):
+        if not self.chains:
+            raise RuntimeError('No MCMC chain returned a result')
         results = []
         for chain in self.chains:
             results.append(chain.get_result())
@@ -72,10 +152,14 @@ class MCMC:
         return self.seeds
 
 
-    def run(self, run_var, seed, n=1, verbosity=1, assign_file='', debug=False):
+    def run(self, run_var, seed, n=1, verbosity=1, assign_file='', debug=False,
+                resume_dir='', init_file=''):
         cutoff = None
+        # Run until the target effective sample size is reached
+        if len(run_var) == 3:
+            Chain_type = Chain_ess
         # Run with steps
-        if isinstance(run_var[0], int):
+        elif isinstance(run_var[0], int):
             Chain_type = Chain_steps
         # Run with lugsail batch means estimator
         elif isinstance(run_var[0], float):
@@ -93,44 +177,293 @@ class MCMC:
         else:
             assign = None
 
+        # Initial assignments: chains are distributed over the given ones
+        if isinstance(init_file, list) and not assign:
+            init_assign = init_file
+        elif init_file and not assign:
+            init_assign = io.load_init_assignments(init_file)
+        else:
+            init_assign = None
+
+        if resume_dir:
+            checkpoints = io.load_checkpoints(resume_dir)
+            n = len(checkpoints)
+            for checkpoint in checkpoints:
+                self._check_checkpoint(checkpoint, Chain_type)
+
         cores = min(n, mp.cpu_count())
+        # Split the target ESS between the chains
+        if Chain_type == Chain_ess:
+            run_var = (*run_var[:2], run_var[2] / cores)
+
         # Seed seed for reproducabilaty
-        if seed > 0:
-            np.random.seed(seed)
-        self.seeds = np.random.randint(0, 2 ** 32 - 1, cores)
+        if resume_dir:
+            self.seeds = np.array([i['seed'] for i in checkpoints[:cores]])
+        else:
+            if seed > 0:
+                np.random.seed(seed)
+            self.seeds = np.random.randint(0, 2 ** 32 - 1, cores)
+        self.init_states = self.get_init_states(cores)
+
+        if self.params['tempering'] > 1:
+            if debug or resume_dir or cutoff:
+                raise ValueError('Parallel tempering is not supported for '
+                    'debugging, resumed runs and the lugsail estimator')
+            self.run_tempered(
+                Chain_type, run_var, assign, cores, verbosity, init_assign
+            )
+            return
 
         if debug:
             np.random.seed(self.seeds[0])
             print(f'\nSeed set to: {self.seeds[0]}\n')
-            run = self.run_chain(Chain_type, run_var, assign, 0, 2)
+            if resume_dir:
+                run = self.resume_chain(run_var, checkpoints[0], 2)
+            else:
+                run = self.run_chain(
+                    Chain_type, run_var, assign, 0, 2, init_assign
+                )
             self.chains.append(run)
             return
 
+        # Errors of the workers are raised with their remote traceback
+        errors = []
         pool = mp.Pool(cores)
         for i in range(cores):
-            pool.apply_async(
-                self.run_chain, (Chain_type, run_var, assign, i, verbosity),
-                callback=self.chains.append
-            )
+            if resume_dir:
+                pool.apply_async(
+                    self.resume_chain, (run_var, checkpoints[i], verbosity),
+                    callback=self.chains.append, error_callback=errors.append
+                )
+            else:
+                pool.apply_async(
+                    self.run_chain,
+                    (Chain_type, run_var, assign, i, verbosity, init_assign),
+                    callback=self.chains.append, error_callback=errors.append
+                )
         pool.close()
         pool.join()
+        if errors:
+            raise errors[0]
 
         if cutoff:
             self.run_lugsail_chains(cutoff, cores, verbosity_ls)
 
 
-    def run_chain(self, Chain_type, run_var, assign, i, verbosity):
-        np.random.seed(self.seeds[i])
+    def run_chain(self, Chain_type, run_var, assign, i, verbosity,
+                init_assign=None, replica=None):
+        """ Run chain i. Tempered replicas are given as (replica number,
+        inverse temperature, connection to the exchanging thread); only the
+        cold replica (0) writes checkpoints.
+        """
+        mcmc = self.params
+        if replica:
+            np.random.seed((self.seeds[i] + replica[0]) % 2 ** 32)
+            if replica[0] > 0:
+                mcmc = dict(self.params, checkpoint_dir='')
+                verbosity = 0
+        else:
+            np.random.seed(self.seeds[i])
         model = deepcopy(self.model)
-        model.init(assign=assign)
+        if replica:
+            model.inv_temp = replica[1]
+        if init_assign:
+            # Warm start: assignments are still updated
+            model.init(assign=init_assign[i % len(init_assign)])
+        else:
+            mode, k = self.init_states[i]
+            model.init(mode, assign=assign, k=k)
         new_chain = Chain_type(
-            model, i + 1, *run_var, self.params, verbosity,
+            model, i + 1, *run_var, mcmc, verbosity,
             isinstance(assign, list)
         )
+        new_chain.seed = self.seeds[i]
+        if replica:
+            new_chain.replica = replica[2]
         new_chain.run()
+        new_chain.save_checkpoint()
         return new_chain
 
 
+    def get_inv_temps(self):
+        return np.geomspace(
+            1, self.params['tempering_min'], self.params['tempering']
+        )
+
+
+    def run_tempered(self, Chain_type, run_var, assign, cores, verbosity,
+                init_assign=None):
+        """ Parallel tempering: each chain is run as replicas with decreasing
+        inverse temperatures in separate processes. A thread per chain
+        exchanges the replica states every swap_every steps. Only the cold
+        replicas are returned.
+        """
+        inv_temps = self.get_inv_temps()
+        queue = mp.Queue()
+        processes = []
+        threads = []
+        replica_conns = []
+        # Proposed and accepted swaps per neighbouring temperatures
+        swaps = np.zeros((cores, inv_temps.size - 1, 2))
+        for i in range(cores):
+            conns = []
+            for j, inv_temp in enumerate(inv_temps):
+                conn, conn_replica = mp.Pipe()
+                conns.append(conn)
+                replica_conns.append(conn_replica)
+                processes.append(mp.Process(target=self._run_replica, args=(
+                    queue, Chain_type, run_var, assign, i, verbosity,
+                    init_assign, (j, inv_temp, conn_replica)
+                )))
+            threads.append(threading.Thread(
+                target=self.exchange_replicas,
+                args=(conns, inv_temps, self.seeds[i], swaps[i])
+            ))
+
+        for job in processes + threads:
+            job.start()
+        # Replicas that die close their pipe: the exchanging thread stops
+        for conn in replica_conns:
+            conn.close()
+        for thread in threads:
+            thread.join()
+
+        # One message per replica: (chain, replica, cold chain, traceback)
+        errors = []
+        received = 0
+        while received < len(processes):
+            try:
+                i, j, chain, error = queue.get(timeout=1)
+            except queue_mod.Empty:
+                if any(i.is_alive() for i in processes) or not queue.empty():
+                    continue
+                break
+            received += 1
+            if error is not None:
+                errors.append(f'Chain {i + 1}, replica {j}:\n{error}')
+            elif j == 0:
+                chain.results['swaps'] = swaps[i]
+                self.chains.append(chain)
+        for process in processes:
+            process.join()
+
+        if errors:
+            raise RuntimeError(
+                'Tempered replicas failed:\n' + '\n'.join(errors)
+            )
+        missing = set(range(1, cores + 1)) - {i.no for i in self.chains}
+        if missing:
+            raise RuntimeError('No result of the untempered replica of chain(s)'
+                f' {sorted(missing)}: replica process terminated')
+        self.chains.sort(key=lambda x: x.no)
+
+
+    def _run_replica(self, queue, *args):
+        # Only the cold replica returns its chain, all return their errors
+        chain_no = args[3]
+        replica_no, _, conn = args[-1]
+        try:
+            chain = self.run_chain(*args)
+        except Exception:
+            queue.put((chain_no, replica_no, None, traceback.format_exc()))
+        else:
+            queue.put((chain_no, replica_no,
+                chain if replica_no == 0 else None, None))
+        finally:
+            conn.send(None)
+
+
+    def exchange_replicas(self, conns, inv_temps, seed, swaps):
+        """ Collect the log likelihood and state of all replicas and propose
+        to swap the states of neighbouring temperatures (alternating even and
+        odd pairs). Replicas are stopped once the cold replica has finished.
+        """
+        rng = np.random.RandomState(seed)
+        active = list(range(len(conns)))
+        even = True
+        while active:
+            msgs = {i: self._recv_replica(conns[i]) for i in active}
+            active = [i for i in active if msgs[i] is not None]
+            if not 0 in active:
+                for i in active:
+                    conns[i].send(None)
+                    self._recv_replica(conns[i])
+                break
+
+            reply = {i: True for i in active}
+            for i in range(int(not even), len(conns) - 1, 2):
+                j = i + 1
+                if not (i in active and j in active):
+                    continue
+                swaps[i, 1] += 1
+                A = (inv_temps[i] - inv_temps[j]) * (msgs[j][0] - msgs[i][0])
+                if np.log(rng.random_sample()) < A:
+                    reply[i], reply[j] = msgs[j][1], msgs[i][1]
+                    swaps[i, 0] += 1
+            even = not even
+
+            for i in active:
+                conns[i].send(reply[i])
+
+
+    @staticmethod
+    def _recv_replica(conn):
+        # Message of a replica, None once it has finished or died
+        try:
+            return conn.recv()
+        except EOFError:
+            return None
+
+
+    def get_init_states(self, n):
+        """ Initialization mode and cluster number per chain. Data-driven
+        starts use cluster numbers spread around the CRP prior expectation
+        (and alternate the clustering for 'dispersed') so that the chains
+        start from different states.
+        """
+        if self.init not in ['kmedoids', 'hierarchical', 'dispersed']:
+            return [(self.init, None)] * n
+
+        k_exp = self.model.get_expected_clusters()
+        if n == 1:
+            k = [k_exp]
+        else:
+            k = np.geomspace(max(1, k_exp / 2),
+                min(2 * k_exp, self.model.cells_total), n)
+            k = np.round(k).astype(int).tolist()
+
+        if self.init == 'dispersed':
+            modes = [['kmedoids', 'hierarchical'][i % 2] for i in range(n)]
+        else:
+            modes = [self.init] * n
+        return list(zip(modes, k))
+
+
+    def _check_checkpoint(self, checkpoint, Chain_type):
+        chain = checkpoint['chain']
+        if type(chain) != Chain_type:
+            raise TypeError(f'Checkpoint of {chain} was run as '
+                f'{type(chain).__name__}, not as {Chain_type.__name__}')
+        if (chain.model.cells_total, chain.model.muts_total) \
+                != self.model.data.shape:
+            raise ValueError(f'Checkpoint of {chain} does not match the data '
+                f'shape: {self.model.data.shape}')
+
+
+    def resume_chain(self, run_var, checkpoint, verbosity):
+        chain = checkpoint['chain']
+        np.random.set_state(checkpoint['rng'])
+        chain.model.attach_data(self.model.get_data_attrs())
+        chain.set_run_args(self.params, verbosity)
+        # Keep the move schedule of a scheduled chain
+        if chain.move_stats is None:
+            chain.move_probs = {'sm_prob': self.params['sm_prob'],
+                'sm_ratios': list(self.params['sm_ratios'])}
+        chain.resume(run_var, checkpoint['step'])
+        chain.save_checkpoint()
+        return chain
+
+
     def run_lugsail_chains(self, cutoff, cores, verbosity, n=500):
         steps_run = self.chains[0].results['ML'].size
 
@@ -150,10 +483,12 @@ class MCMC:
                 break
 
             # Run next n steps
+            errors = []
             pool = mp.Pool(cores)
             for i in range(cores):
                 pool.apply_async(
-                    self.extend_chain, (i, n), callback=self.replace_chain
+                    self.extend_chain, (i, n), callback=self.replace_chain,
+                    error_callback=errors.append
                 )
             try:
                 pool.close()
@@ -163,6 +498,8 @@ class MCMC:
                 pool.terminate()
                 pool.join()
                 break
+            if errors:
+                raise errors[0]
 
             steps_run += n
 
@@ -182,6 +519,7 @@ class MCMC:
         chain._extend_results(add_steps, False)
         chain.set_steps(add_steps)
         chain.run(init_steps=old_steps - 1)
+        chain.save_checkpoint()
         return chain_no, chain
 
 
@@ -199,7 +537,7 @@ class Chain():
         self.mcmc = mcmc
         self.no = no
         # Model description
-        if self.model.__module__ == 'libs.CRP_learning_errors':
+        if hasattr(self.model, 'update_error_rates'):
             self.learning_errors = True
         else:
             self.learning_errors = False
@@ -207,17 +545,168 @@ class Chain():
         self.results = {}
         # MH counter
         self.MH_counter = np.zeros((5, 2))
+        # Online ESS estimates of the traces (after burn-in)
+        self.diagnostics = {i: ut.OnlineESS() for i in DIAGNOSTIC_TRACES}
+        # Calls and wall time per move
+        self.profile = mcmc.get('profile', False)
+        if self.profile:
+            self.timing = {i: np.zeros(2) for i in PROFILED_MOVES}
+        # Move probabilities (adapted if scheduling) and per move reassigned
+        #   cells and wall time
+        self.move_probs = {
+            'sm_prob': mcmc['sm_prob'], 'sm_ratios': list(mcmc['sm_ratios'])
+        }
+        if mcmc.get('schedule', False):
+            self.move_stats = {i: np.zeros(2) for i in SCHEDULED_MOVES}
+        else:
+            self.move_stats = None
 
         self.verbosity = verbosity
         self.fix_assign = fix_assign
+        self.seed = None
+        # Connection to the replica exchange (tempered runs only)
+        self.replica = None
 
 
     def __str__(self):
         return f'Chain: {self.no:0>2d}'
 
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['replica'] = None
+        return state
+
+
     def get_result(self):
-        return self.results
+        self.results['ESS'] = self.get_ess()
+        if self.profile:
+            self.results['timing'] = {i: j.copy() for i, j in self.timing.items()}
+            run_time = np.sum([i[1] for i in self.timing.values()])
+            self.results['ESS_per_sec'] = \
+                {i: j / run_time for i, j in self.results['ESS'].items()}
+        if self.move_stats is not None:
+            self.results['schedule'] = dict(self.move_probs)
+        # Collapsed cells/compressed mutations: results of the input data
+        result = dict(self.results)
+        if getattr(self.model, 'cell_rows', None) is not None:
+            result['assignments'] = \
+                self.model.expand_assignment(result['assignments'])
+        if getattr(self.model, 'mut_cols', None) is not None \
+                and 'params' in result:
+            result['params'] = self.model.expand_params(result['params'])
+        return result
+
+
+    def checkpoint(self, step):
+        every = self.mcmc.get('checkpoint_every', -1)
+        if every > 0 and step % every == 0:
+            self.save_checkpoint(step)
+
+
+    def save_checkpoint(self, step=None):
+        if not self.mcmc.get('checkpoint_dir', ''):
+            return
+        if step is None:
+            step = self.results['ML'].size - 1
+        out_file = os.path.join(
+            self.mcmc['checkpoint_dir'], f'chain_{self.no:0>2d}.pkl'
+        )
+        io.save_checkpoint(self, step, out_file)
+
+
+    def resume(self, run_var, step):
+        # Continue a checkpointed chain with the run length of the current run
+        self.set_run_var(run_var, step)
+        self.run(init_steps=step)
+
+
+    def set_run_var(self, run_var, step):
+        pass
+
+
+    def set_run_args(self, mcmc, verbosity):
+        # Settings of the current run, used for resumed chains
+        self.mcmc = mcmc
+        self.verbosity = verbosity
+        self.profile = mcmc.get('profile', False)
+        if self.profile and getattr(self, 'timing', None) is None:
+            self.timing = {i: np.zeros(2) for i in PROFILED_MOVES}
+
+
+    def _truncate_results(self, zeros):
+        if zeros == 0:
+            return
+        for key, values in self.results.items():
+            if isinstance(values, np.ndarray):
+                self.results[key] = values[:-zeros]
+
+
+    def exchange(self, step):
+        """ Send the log likelihood and state to the replica exchange and
+        continue with the returned state. Returns False if the run is stopped.
+        """
+        if self.replica is None or step % self.mcmc['swap_every'] != 0:
+            return True
+        self.replica.send((self.results['ML'][step], self.model.get_state()))
+        state = self.replica.recv()
+        if state is None:
+            return False
+        if state is not True:
+            self.model.set_state(state)
+        return True
+
+
+    def _tic(self):
+        if self.profile or self.move_stats is not None:
+            return perf_counter()
+
+
+    def _toc(self, move, start, moved=0):
+        if start is None:
+            return
+        duration = perf_counter() - start
+        if self.profile:
+            self.timing[move] += [1, duration]
+        if self.move_stats is not None and move in self.move_stats:
+            self.move_stats[move] += [moved, duration]
+
+
+    def update_schedule(self):
+        """ Set the move probabilities proportional to the reassigned cells per
+        second of each assignment move, bounded by SCHEDULE_MIN
+        """
+        calls = [self.move_stats[i][1] > 0 for i in SCHEDULED_MOVES]
+        if not all(calls):
+            return
+        for stats in self.move_stats.values():
+            stats *= SCHEDULE_DECAY
+        rates = {i: (j[0] + 1) / j[1] for i, j in self.move_stats.items()}
+        sm_rate = (self.move_stats['split'] + self.move_stats['merge'])
+        sm_rate = (sm_rate[0] + 2) / sm_rate[1]
+        self.move_probs['sm_prob'] = np.clip(
+            sm_rate / (sm_rate + rates['Gibbs']), SCHEDULE_MIN, 1 - SCHEDULE_MIN
+        )
+        split = np.clip(rates['split'] / (rates['split'] + rates['merge']),
+            SCHEDULE_MIN, 1 - SCHEDULE_MIN)
+        self.move_probs['sm_ratios'] = [split, 1 - split]
+
+
+    def get_ess(self):
+        return {i: j.get_ess() for i, j in self.diagnostics.items()}
+
+
+    def get_min_ess(self):
+        ess = np.array(list(self.get_ess().values()))
+        if np.isnan(ess).any():
+            return 0
+        return ess.min()
+
+
+    def update_diagnostics(self, step):
+        for trace in DIAGNOSTIC_TRACES[:-1]:
+            self.diagnostics[trace].update(self.results[trace][step])
+        self.diagnostics['clusters'].update(len(self.model.cells_per_cluster))
 
 
     def run(self, *args):
@@ -236,6 +725,7 @@ class Chain():
 
 
     def update_results(self, step, burn_in=True):
+        start = self._tic()
         step_diff = self.results['ML'].size - step
         # Extend sample array if run with runtime argument instead of steps
         if step_diff == 0:
@@ -254,6 +744,8 @@ class Chain():
         self.results['assignments'][step] = self.model.assignment
 
         if not burn_in:
+            self.update_diagnostics(step)
+
             clusters = np.sort(
                 np.fromiter(self.model.cells_per_cluster.keys(), dtype=int)
             )
@@ -277,6 +769,8 @@ class Chain():
             self.results['params'][step - burn_in_steps + 1][cluster_ids] = \
                 self.model.parameters[clusters]
 
+        self._toc('results', start)
+
 
     def _extend_results(self, add_size=None, burn_in=True):
         if not add_size:
@@ -313,29 +807,64 @@ class Chain():
         self.MH_counter = np.zeros((5, 2))
 
 
-    def do_step(self):
+    def do_step(self, burn_in=False):
         if not self.fix_assign:
-            if np.random.random() < self.mcmc['sm_prob']:
+            schedule = burn_in and self.move_stats is not None
+            if schedule:
+                old_assignment = self.model.assignment.copy()
+            start = self._tic()
+            if np.random.random() < self.move_probs['sm_prob']:
                 sm_declined, sm_move = self.model.update_assignments_split_merge(
-                    self.mcmc['sm_ratios'], self.mcmc['sm_steps'])
+                    self.move_probs['sm_ratios'], self.mcmc['sm_steps'],
+                    self.mcmc['sm_anchors'], self.mcmc['sm_partners'])
                 if sm_move == 0:
                     self.MH_counter[1] += sm_declined
+                    move = 'split'
                 else:
                     self.MH_counter[2] += sm_declined
+                    move = 'merge'
+            elif self.mcmc.get('grid', 0) > 0:
+                self.model.update_assignments_Gibbs_collapsed(self.mcmc['grid'])
+                move = 'Gibbs'
+            elif self.mcmc.get('gibbs_mh', 0) > 0:
+                self.model.update_assignments_Gibbs_MH(
+                    self.mcmc['gibbs_mh'], self.mcmc.get('minibatch', 1)
+                )
+                move = 'Gibbs'
+            elif self.mcmc.get('minibatch', 1) < 1:
+                self.model.update_assignments_Gibbs(self.mcmc['minibatch'])
+                move = 'Gibbs'
             else:
                 self.model.update_assignments_Gibbs()
+                move = 'Gibbs'
+            if schedule:
+                moved = (old_assignment != self.model.assignment).sum()
+                self._toc(move, start, moved)
+                self.update_schedule()
+            else:
+                self._toc(move, start)
 
             if np.random.random() < self.mcmc['dpa_prob']:
+                start = self._tic()
                 self.model.update_DP_alpha()
+                self._toc('DP_alpha', start)
 
-        par_declined, par_accepted = self.model.update_parameters()
+        start = self._tic()
+        adapt = burn_in and self.mcmc.get('adapt', False)
+        augment = self.mcmc.get('param_sampler', 'MH') == 'augmented'
+        par_declined, par_accepted = \
+            self.model.update_parameters(adapt=adapt, augment=augment)
         self.MH_counter[0][1] += par_declined
         self.MH_counter[0][0] += par_accepted
+        self._toc('parameters', start)
 
         if self.learning_errors and np.random.random() < self.mcmc['error_prob']:
-            FP_declined, FN_declined = self.model.update_error_rates()
+            start = self._tic()
+            FP_declined, FN_declined = \
+                self.model.update_error_rates(adapt, augment)
             self.MH_counter[3] += FP_declined
             self.MH_counter[4] += FN_declined
+            self._toc('errors', start)
 
 
 # ------------------------------------------------------------------------------
@@ -368,18 +897,29 @@ class Chain_steps(Chain):
         super().stdout_progress()
 
 
+    def set_run_var(self, run_var, step):
+        # Extend a finished chain without changing its burn-in
+        add_steps = run_var[0] + 1 - self.results['ML'].size
+        if add_steps > 0:
+            self._extend_results(add_steps, not 'params' in self.results)
+        self.set_steps(max(0, run_var[0] - step))
+
+
     def run(self, init_steps=0):
         # Run the MCMC - that's where all the work is done
         for step in range(1, self.steps, 1):
-            if step % (self.steps // 10) == 0 and self.verbosity > 1:
+            if step % max(1, self.steps // 10) == 0 and self.verbosity > 1:
                 self.stdout_progress(step + init_steps, self.steps + init_steps)
 
-            self.do_step()
             try:
-                burn_in = step < self.burn_in
+                burn_in = step + init_steps < self.burn_in
             except TypeError:
                 burn_in = False
+            self.do_step(burn_in)
             self.update_results(step + init_steps, burn_in)
+            self.checkpoint(step + init_steps)
+            if not self.exchange(step + init_steps):
+                break
 
         self.results['burn_in'] = self.burn_in
 
@@ -406,9 +946,13 @@ class Chain_time(Chain):
         super().stdout_progress()
 
 
-    def run(self):
+    def set_run_var(self, run_var, step):
+        self.end_time, self.burn_in = run_var
+
+
+    def run(self, init_steps=0):
         # Run the MCMC - that's where all the work is done
-        step = 0
+        step = init_steps
         while True:
             step_time = datetime.now()
             if step_time > self.end_time:
@@ -419,18 +963,71 @@ class Chain_time(Chain):
                 self.stdout_progress(step, remaining)
 
             step += 1
-            self.do_step()
             try:
                 burn_in = step_time < self.burn_in
             except TypeError:
                 burn_in = False
+            self.do_step(burn_in)
             self.update_results(step, burn_in)
+            self.checkpoint(step)
+            if not self.exchange(step):
+                break
 
         # Truncate empty steps
-        zeros = (self.results['ML'] == 0).sum()
-        if zeros != 0:
-            for key, values in self.results.items():
-                self.results[key] = values[:-zeros]
+        self._truncate_results((self.results['ML'] == 0).sum())
 
         self.results['burn_in'] = self.results['ML'].size \
             - self.results['params'].shape[0]
+
+
+# ------------------------------------------------------------------------------
+# RUN UNTIL TARGET EFFECTIVE SAMPLE SIZE
+# ------------------------------------------------------------------------------
+
+class Chain_ess(Chain):
+    def __init__(self, model, no, steps, burn_in, target_ess, mcmc, verbosity=1,
+                fix_assign=False, check_every=100):
+        super().__init__(model, mcmc, no, verbosity, fix_assign)
+
+        self.steps = steps + 1
+        self.burn_in = burn_in
+        self.target_ess = target_ess
+        self.check_every = check_every
+
+        self.init_results(min(self.steps, burn_in + 500))
+        self.update_results(0, burn_in != 0)
+
+
+    def stdout_progress(self, step_no, ess):
+        print(f'\t{self}\tstep:\t{step_no: >3}\t(min. ESS: {ess:.1f} / '
+            f'{self.target_ess:.1f})\n\t\tmean MH accept. ratio:')
+        super().stdout_progress()
+
+
+    def set_run_var(self, run_var, step):
+        self.steps = run_var[0] + 1
+        self.target_ess = run_var[2]
+
+
+    def run(self, init_steps=0):
+        # Run the MCMC - that's where all the work is done
+        steps_run = init_steps + 1
+        for step in range(init_steps + 1, self.steps, 1):
+            if step > self.burn_in and step % self.check_every == 0:
+                ess = self.get_min_ess()
+                if self.verbosity > 1:
+                    self.stdout_progress(step, ess)
+                if ess >= self.target_ess:
+                    break
+
+            self.do_step(step < self.burn_in)
+            self.update_results(step, step < self.burn_in)
+            self.checkpoint(step)
+            steps_run += 1
+            if not self.exchange(step):
+                break
+
+        # Truncate empty steps
+        self._truncate_results(self.results['ML'].size - steps_run)
+
+        self.results['burn_in'] = self.burn_in
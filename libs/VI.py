@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+from scipy.special import betaln, digamma, gammaln, logsumexp
+from scipy.optimize import minimize_scalar
+
+try:
+    import libs.utils as ut
+except ImportError:
+    import utils as ut
+
+
+# Maximum number of coordinate ascent iterations
+VI_MAX_ITER = 500
+# Convergence: relative change of the evidence lower bound
+VI_TOL = 1e-7
+
+
+# -----------------------------------------------------------------------------
+# MEAN-FIELD VARIATIONAL INFERENCE
+# -----------------------------------------------------------------------------
+
+class VI:
+    """ Mean-field variational inference of the DPMM with a truncated
+    stick-breaking representation of the DP.
+    Blei, D. M., Jordan, M. I. (2006). Variational inference for Dirichlet
+    process mixtures. Bayesian Analysis, 1, 121-143.
+
+    q(V_k) and q(theta_km) are Beta, q(alpha) is Gamma and q(z_i) is
+    categorical. The latent genotype of an observed entry is integrated out
+    given the cluster of its cell, so that all updates are matrix products of
+    the weighted counts of 1s and 0s. Learned error rates are MAP estimates.
+    """
+    def __init__(self, model, truncation=50, max_iter=VI_MAX_ITER, tol=VI_TOL):
+        self.model = model
+        self.K = int(min(truncation, model.cells_total))
+        self.max_iter = max_iter
+        self.tol = tol
+        self.learning_errors = hasattr(model, 'FP_prior')
+        self.w = model.cell_weights.astype(np.float64)
+        # Count matrices are kept in memory unless in out-of-core mode
+        if model.block_size:
+            self.counts = None
+        else:
+            self.counts = model._get_count_rows(slice(None))
+
+        self.elbo = -np.inf
+        self.iterations = 0
+
+
+    def __str__(self):
+        out_str = '\nVariational inference:\n' \
+            f'\tTruncation:\t{self.K}\n' \
+            f'\tMax. iterations:\t{self.max_iter}\n' \
+            f'\tTolerance:\t{self.tol}\n'
+        return out_str
+
+
+    def _iter_counts(self):
+        # Weighted 1s and 0s of consecutive row blocks
+        if self.counts is not None:
+            yield slice(None), *self.counts
+            return
+        step = max(1, self.model.block_size // self.model.muts_total)
+        for i in range(0, self.model.cells_total, step):
+            rows = slice(i, i + step)
+            yield rows, *self.model._get_count_rows(rows)
+
+
+    def _get_cluster_counts(self, phi):
+        # Expected weighted 1s and 0s per cluster and mutation (K x m)
+        N1 = np.zeros((self.K, self.model.muts_total))
+        N0 = np.zeros((self.K, self.model.muts_total))
+        for rows, ones, zeros in self._iter_counts():
+            N1 += np.asarray((ones.T @ phi[rows]).T)
+            N0 += np.asarray((zeros.T @ phi[rows]).T)
+        return N1, N0
+
+
+    @staticmethod
+    def _E_log_beta(a, b):
+        # Expected log(x) and log(1 - x) of x ~ Beta(a, b)
+        dg_ab = digamma(a + b)
+        return digamma(a) - dg_ab, digamma(b) - dg_ab
+
+
+    def _get_E_log_pi(self, gamma):
+        # Expected log stick-breaking weights, last stick takes the rest
+        E_lV, E_l1V = self._E_log_beta(*gamma)
+        return np.append(E_lV, 0) + np.append(0, np.cumsum(E_l1V))
+
+
+    def _get_E_log_lik(self, a, b, FP, FN):
+        """ Expected log probabilities of observing a 1 and a 0 (K x m), and
+        the probabilities of a mutated genotype given a 1 and a 0
+        """
+        E_lt, E_l1t = self._E_log_beta(a, b)
+        l1_mut, l1_wt = E_lt + np.log(1 - FN), E_l1t + np.log(FP)
+        l0_mut, l0_wt = E_lt + np.log(FN), E_l1t + np.log(1 - FP)
+        s1 = np.logaddexp(l1_mut, l1_wt)
+        s0 = np.logaddexp(l0_mut, l0_wt)
+        return s1, s0, np.exp(l1_mut - s1), np.exp(l0_mut - s0)
+
+
+    def _update_assignments(self, s1, s0, E_log_pi):
+        """ Update the cluster responsibilities of all rows. Collapsed rows
+        are a single unit of cell_weights cells. Returns the responsibilities
+        and their contribution to the lower bound.
+        """
+        phi = np.empty((self.model.cells_total, self.K))
+        bound = 0
+        for rows, ones, zeros in self._iter_counts():
+            L = np.asarray(ones @ s1.T + zeros @ s0.T) \
+                + self.w[rows, np.newaxis] * E_log_pi
+            log_norm = logsumexp(L, axis=1, keepdims=True)
+            phi[rows] = np.exp(L - log_norm)
+            bound += log_norm.sum()
+        return phi, bound
+
+
+    def _update_sticks(self, phi, E_a):
+        # Beta parameters of the K - 1 stick proportions
+        sizes = self.w @ phi
+        rest = np.cumsum(sizes[::-1])[::-1]
+        return np.stack([1 + sizes[:-1], E_a + rest[1:]])
+
+
+    def _update_error(self, prior, count_err, count_corr):
+        # MAP error rate given the expected error and correct counts
+        def neg_lpost(x):
+            return -(count_err * np.log(x) + count_corr * np.log1p(-x)
+                + prior.logpdf(x))
+
+        with np.errstate(all='ignore'):
+            res = minimize_scalar(neg_lpost, method='bounded',
+                bounds=(ut.EPSILON, 1 - ut.EPSILON))
+        return res.x
+
+
+    def _get_global_bound(self, a, b, gamma, shape, rate, FP, FN):
+        # Lower bound terms of the stick, parameter and concentration factors
+        p, q = self.model.p, self.model.q
+        E_lt, E_l1t = self._E_log_beta(a, b)
+        bound = np.sum(-betaln(p, q) + betaln(a, b) + (p - a) * E_lt
+            + (q - b) * E_l1t)
+
+        E_lV, E_l1V = self._E_log_beta(*gamma)
+        E_la, E_a = digamma(shape) - np.log(rate), shape / rate
+        bound += np.sum(E_la + (E_a - 1) * E_l1V + betaln(*gamma)
+            - (gamma[0] - 1) * E_lV - (gamma[1] - 1) * E_l1V)
+
+        s, r = self.model.DP_a_gamma
+        bound += s * np.log(r) - gammaln(s) + (s - 1) * E_la - r * E_a \
+            - shape * np.log(rate) + gammaln(shape) - (shape - 1) * E_la \
+            + shape
+
+        if self.learning_errors:
+            with np.errstate(all='ignore'):
+                bound += self.model.FP_prior.logpdf(FP) \
+                    + self.model.FN_prior.logpdf(FN)
+        return bound
+
+
+    def fit(self, restarts=1, verbosity=1):
+        """ Coordinate ascent from random responsibilities, the run with the
+        highest lower bound is kept
+        """
+        for i in range(restarts):
+            with np.errstate(under='ignore'):
+                run = self._fit_single()
+            if verbosity > 0:
+                print(f'\tRestart {i + 1}/{restarts}: ELBO {run["elbo"]:.2f} '
+                    f'after {run["iterations"]} iterations')
+            if run['elbo'] > self.elbo:
+                self.__dict__.update(run)
+
+
+    def _fit_single(self):
+        s, r = self.model.DP_a_gamma
+        FP, FN = self.model.FP, self.model.FN
+        p, q = self.model.p, self.model.q
+
+        phi = np.random.dirichlet(np.ones(self.K), size=self.model.cells_total)
+        shape = s + self.K - 1
+        rate = shape / self.model.DP_a
+        gamma = self._update_sticks(phi, shape / rate)
+        N1, N0 = self._get_cluster_counts(phi)
+        a, b = p + N1, q + N0
+
+        elbo = -np.inf
+        for it in range(1, self.max_iter + 1):
+            s1, s0, t1, t0 = self._get_E_log_lik(a, b, FP, FN)
+            phi, bound = self._update_assignments(
+                s1, s0, self._get_E_log_pi(gamma)
+            )
+            elbo_new = bound \
+                + self._get_global_bound(a, b, gamma, shape, rate, FP, FN)
+
+            N1, N0 = self._get_cluster_counts(phi)
+            # Expected genotype counts: true pos., false neg.
+            true_pos, false_neg = t1 * N1, t0 * N0
+            a = p + true_pos + false_neg
+            b = q + N1 - true_pos + N0 - false_neg
+
+            gamma = self._update_sticks(phi, shape / rate)
+            rate = r - self._E_log_beta(*gamma)[1].sum()
+
+            if self.learning_errors:
+                FP = self._update_error(self.model.FP_prior,
+                    (N1 - true_pos).sum(), (N0 - false_neg).sum())
+                FN = self._update_error(self.model.FN_prior,
+                    false_neg.sum(), true_pos.sum())
+
+            if abs(elbo_new - elbo) < self.tol * abs(elbo_new):
+                elbo = elbo_new
+                break
+            elbo = elbo_new
+
+        return {'phi': phi, 'a': a, 'b': b, 'gamma': gamma,
+            'DP_a': shape / rate, 'FP': FP, 'FN': FN, 'elbo': elbo,
+            'iterations': it}
+
+
+    def get_assignment(self):
+        # Most probable cluster of each row, relabelled to 0, 1, ...
+        return np.unique(np.argmax(self.phi, axis=1), return_inverse=True)
+
+
+    def get_inferred(self, data):
+        """ Point estimate in the format of the MCMC estimators: assignment of
+        the input cells, posterior mean parameters of the used clusters
+        """
+        cl_ids, assign_rows = self.get_assignment()
+        assignment = self.model.expand_assignment(assign_rows).tolist()
+
+        theta = self.a[cl_ids] / (self.a[cl_ids] + self.b[cl_ids])
+        geno_all = self.model.expand_params(theta)
+        geno = pd.DataFrame(
+            geno_all, index=np.arange(cl_ids.size)
+        ).T[assignment]
+        FN_geno, FP_geno = ut.get_geno_errors(geno, data)
+
+        return {'step': self.iterations, 'a': self.DP_a,
+            'assignment': assignment, 'genotypes': geno,
+            'FN': np.float64(self.FN), 'FP': np.float64(self.FP),
+            'FN_geno': FN_geno, 'FP_geno': FP_geno}
+
+
+if __name__ == '__main__':
+    print('Here be dragons...')
@@ -2,8 +2,14 @@
 
 import os
 import re
+import gzip
+import pickle
+import hashlib
+from itertools import islice
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy.io import mmread
 from scipy.spatial.distance import squareform
 from string import ascii_uppercase
 from datetime import timedelta
@@ -23,47 +29,236 @@ except ModuleNotFoundError:
 # INPUT - DATA
 # ------------------------------------------------------------------------------
 
-def load_data(in_file, transpose=True, get_names=False):
-    sep = '\t'
-    df = pd.read_csv(in_file, sep=sep, index_col=None, header=None)
+DATA_VALUES = ['0', '1', '2', '3', '']
+MISSING = ut.MISSING
+CACHE_SUFFIX = '.BnpC_cache.npz'
+
+
+def load_data(in_file, transpose=True, get_names=False, compact=False,
+            chunk_size=2 ** 24, cache=True):
+    """ Load a mutation matrix (0|1|2|3, 3 or empty = missing) from a (gzipped)
+    text file with optional row and column names, or from a binary numpy file
+    (.npy: matrix only, memory-mapped; .npz: 'data' and optional 'rows' and
+    'cols' names). Matrix Market files (.mtx) and scipy sparse matrices
+    (.npz) contain only the observed entries and are returned as sparse CSR
+    matrix.
+
+    Arguments:
+        in_file (str): Path to the data file
+        transpose (bool): If True, rows are mutations and columns are cells
+        get_names (bool): Return the cell and mutation names
+        compact (bool): Return an int8 matrix with 0|1|3 (3 = missing) instead
+            of a float matrix with 0|1|np.nan
+        chunk_size (int): Approximate number of matrix entries parsed at once
+        cache (bool): Store parsed text input next to the input file and reuse
+            it as long as the input file is unchanged
+
+    """
+    if in_file.endswith(('.mtx', '.mtx.gz')) or _is_sparse_npz(in_file):
+        data = _load_sparse(in_file)
+        if transpose:
+            data = data.T
+        data = data.tocsr()
+        if get_names:
+            return data, (np.arange(data.shape[0]), np.arange(data.shape[1]))
+        return data
+    elif in_file.endswith(('.npy', '.npz')):
+        data, row_names, col_names = _load_binary(in_file)
+    else:
+        loaded = _load_cache(in_file) if cache else None
+        if loaded:
+            data, row_names, col_names = loaded
+        else:
+            data, row_names, col_names = _load_text(in_file, chunk_size)
+            if cache:
+                _save_cache(in_file, data, row_names, col_names)
+
+    if transpose:
+        data = data.T
+        row_names, col_names = col_names, row_names
+
+    if not compact:
+        data = ut.compact_to_float(data)
+    # Memory-mapped data is kept on disk
+    elif not data.flags['C_CONTIGUOUS'] and not isinstance(data, np.memmap):
+        data = np.ascontiguousarray(data)
+
+    if get_names:
+        return data, (row_names, col_names)
+    else:
+        return data
+
+
+def _load_text(in_file, chunk_size=2 ** 24):
+    sep, header, index, col_no = _sniff_data_format(in_file)
+
+    data = []
+    row_names = []
+    reader = pd.read_csv(in_file, sep=sep, header=0 if header else None,
+        index_col=0 if index else None, compression='infer',
+        chunksize=max(1, chunk_size // col_no))
+    for chunk in reader:
+        data.append(_to_compact(chunk.values.astype(np.float32)))
+        row_names.append(chunk.index.values)
+    if sum(i.shape[0] for i in data) == 0:
+        raise ValueError(f'No data rows in: {in_file}')
+    col_names = chunk.columns.values
+
+    data = np.concatenate(data)
+    row_names = np.concatenate(row_names)
+    if not header:
+        col_names = np.arange(data.shape[1])
+    return data, row_names, col_names
+
+
+def _load_binary(in_file):
+    if in_file.endswith('.npy'):
+        data = np.load(in_file, mmap_mode='r')
+        row_names = np.arange(data.shape[0])
+        col_names = np.arange(data.shape[1])
+    else:
+        with np.load(in_file) as npz:
+            data = npz['data']
+            row_names = npz['rows'] if 'rows' in npz else np.arange(data.shape[0])
+            col_names = npz['cols'] if 'cols' in npz else np.arange(data.shape[1])
+
+    # Memory-mapped compact data is used as it is
+    if data.dtype != np.int8 or _contains(data, 2):
+        data = _to_compact(np.asarray(data, dtype=np.float32))
+    return data, row_names, col_names
+
+
+def _contains(data, val, chunk_size=2 ** 24):
+    # Check in row chunks: memory-mapped data is not loaded at once
+    step = max(1, chunk_size // max(1, data.shape[1]))
+    return any(np.any(data[i:i + step] == val) \
+        for i in range(0, data.shape[0], step))
+
+
+def save_memmap(data, out_file, chunk_size=2 ** 24):
+    """ Write compact (int8) data row-major to a .npy file and return it
+    memory-mapped, copying chunk_size matrix entries at once.
+    """
+    mmap = np.lib.format.open_memmap(
+        out_file, mode='w+', dtype=np.int8, shape=data.shape
+    )
+    # Copy along the contiguous axis of the source data
+    if data.flags['F_CONTIGUOUS'] and not data.flags['C_CONTIGUOUS']:
+        src, dest = data.T, mmap.T
+    else:
+        src, dest = data, mmap
+    step = max(1, chunk_size // max(1, src.shape[1]))
+    for i in range(0, src.shape[0], step):
+        dest[i:i + step] = src[i:i + step]
+    mmap.flush()
+    del mmap
+    return np.load(out_file, mmap_mode='r')
+
+
+def _is_sparse_npz(in_file):
+    if not in_file.endswith('.npz'):
+        return False
+    with np.load(in_file) as npz:
+        # scipy.sparse.save_npz: any format (csr, csc, coo, ...)
+        return 'format' in npz and 'shape' in npz
+
+
+def _load_sparse(in_file):
+    if in_file.endswith('.npz'):
+        data = sp.load_npz(in_file).tocoo()
+    else:
+        data = sp.coo_matrix(mmread(in_file))
+    # Stored entries are observations: drop missing values (3)
+    vals = np.where(data.data == 2, 1, data.data)
+    obs = vals != MISSING
+    return sp.csr_matrix(
+        (vals[obs].astype(np.int8), (data.row[obs], data.col[obs])),
+        shape=data.shape
+    )
+
+
+def _get_cache_key(in_file, head_size=2 ** 20):
+    # File size, modification time and hash of the first MiB
+    stat = os.stat(in_file)
+    with open(in_file, 'rb') as f:
+        head_hash = hashlib.sha1(f.read(head_size)).hexdigest()
+    return f'{stat.st_size}_{stat.st_mtime_ns}_{head_hash}'
 
-    # Wrong seperator
-    if df.shape[1] == 1:
-        sep = ' '
-        df = pd.read_csv(in_file, sep=sep, index_col=None, header=None)
 
+def _load_cache(in_file):
+    cache_file = in_file + CACHE_SUFFIX
+    if not os.path.exists(cache_file):
+        return None
     try:
-        index_col = ~df[df.columns[0]].iloc[1:].astype(int).isin([0,1,2,3]).all()
-    except ValueError:
-        index_col = True
+        with np.load(cache_file) as npz:
+            if str(npz['key']) != _get_cache_key(in_file):
+                return None
+            return npz['data'], npz['rows'], npz['cols']
+    except (OSError, KeyError, ValueError):
+        return None
+
 
+def _save_cache(in_file, data, row_names, col_names):
+    cache_file = in_file + CACHE_SUFFIX
     try:
-        header_col = ~df.iloc[0,1:].astype(int).isin([0,1,2,3]).all()
-    except ValueError:
-        header_col = True
+        with open(cache_file + '.tmp', 'wb') as f:
+            np.savez(f, data=data, rows=_get_name_array(row_names),
+                cols=_get_name_array(col_names), key=_get_cache_key(in_file))
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError:
+        pass
+
+
+def _get_name_array(names):
+    # Names without pickling: numbers as they are, everything else as strings
+    names = np.asarray(names)
+    if names.dtype == object:
+        names = names.astype(str)
+    return names
+
+
+def _open_text(in_file):
+    if in_file.endswith('.gz'):
+        return gzip.open(in_file, 'rt')
+    return open(in_file, 'r')
+
+
+def _sniff_data_format(in_file, lines=20):
+    # Separator, header and index column from the first lines of the file
+    with _open_text(in_file) as f:
+        head = [i.rstrip('\r\n') for i in islice(f, lines) if i.strip()]
+    if not head:
+        raise IOError(f'Empty data file: {in_file}')
+
+    if '\t' in head[0]:
+        sep = '\t'
+    elif ',' in head[0]:
+        sep = ','
+    else:
+        sep = r'\s+'
+    rows = [re.split(sep, i.strip()) if sep == r'\s+' else i.split(sep) \
+        for i in head]
 
-    if index_col and header_col:
-        df = pd.read_csv(in_file, sep=sep, index_col=0, header=0)
-    elif index_col:
-        df = pd.read_csv(in_file, sep=sep, index_col=0)
-    elif header_col:
-        df = pd.read_csv(in_file, sep=sep, header=0)
+    header = not all([_is_data_value(i) for i in rows[0][1:]])
+    index = not all([_is_data_value(i[0]) for i in rows[1:]])
+    return sep, header, index, len(rows[-1])
 
-    if transpose:
-        df = df.T
 
-    data = df.values.astype(float)
-    rows = df.index.values
-    cols = df.columns.values
+def _is_data_value(val):
+    val = val.strip()
+    if val in DATA_VALUES:
+        return True
+    try:
+        return float(val) in [0, 1, 2, 3]
+    except ValueError:
+        return val.lower() == 'nan'
+
 
-    data[data == 3] = np.nan
+def _to_compact(values):
+    data = np.where(np.isnan(values), MISSING, values).astype(np.int8)
     # replace homozygos mutations with heterozygos
     data[data == 2] = 1
-
-    if get_names:
-        return data, (rows, cols)
-    else:
-        return data
+    return data
 
 
 def load_txt(path):
@@ -80,6 +275,32 @@ def load_txt(path):
     return l[::-1]
 
 
+def load_checkpoints(in_dir):
+    files = sorted(
+        [i for i in os.listdir(in_dir) if re.match(r'chain_\d+\.pkl$', i)]
+    )
+    if not files:
+        raise IOError(f'No checkpoints found in: {in_dir}')
+
+    checkpoints = []
+    for file in files:
+        with open(os.path.join(in_dir, file), 'rb') as f:
+            checkpoints.append(pickle.load(f))
+    return checkpoints
+
+
+def load_init_assignments(path):
+    # Run directory: last assignment of each chain or the inferred assignment
+    if os.path.isdir(path):
+        cp_dir = os.path.join(path, 'checkpoints')
+        if os.path.isdir(cp_dir):
+            return [i['chain'].model.expand_assignment(
+                    i['chain'].model.assignment).tolist() \
+                for i in load_checkpoints(cp_dir)]
+        path = os.path.join(path, 'assignment.txt')
+    return [load_txt(path)]
+
+
 # ------------------------------------------------------------------------------
 # INPUT - Preprocessing
 # ------------------------------------------------------------------------------
@@ -122,6 +343,101 @@ def process_sim_folder(args, suffix=''):
     args.plot_dir = in_dir
 
 
+def collapse_cells(data, observed=False, min_overlap=0.9):
+    """ Collapse duplicate cells into weighted representatives
+
+    Arguments:
+        data (np.array): n x m matrix containing 0|1|np.nan
+        observed (bool): Collapse cells that are identical on all entries
+            observed in both as well (at least min_overlap of the observed
+            entries of a cell have to be observed in its representative)
+        min_overlap (float): Minimum overlap of observed entries
+
+    Returns:
+        np.array: k x m matrix of representatives
+        np.array: Number of cells represented by each row (k x 1) or by each
+            entry (k x m)
+        np.array: Representative row of each cell
+    """
+    key = np.where(np.isnan(data), 3, data).astype(np.int8)
+    _, first, cell_rows, counts = np.unique(key, axis=0, return_index=True,
+        return_inverse=True, return_counts=True)
+    cell_rows = cell_rows.flatten()
+    data_rep = data[first]
+    weights = counts[:, np.newaxis].astype(np.float32)
+
+    if observed:
+        data_rep, weights, groups = _collapse_observed(
+            data_rep, weights, min_overlap
+        )
+        cell_rows = groups[cell_rows]
+
+    return data_rep, weights, cell_rows
+
+
+def _collapse_observed(data, weights, min_overlap=0.9):
+    # Greedy grouping: most complete cells first, each representative holds
+    #   the observed values of all its cells
+    obs = ~np.isnan(data)
+    rep = np.full(data.shape, np.nan)
+    rep_weights = np.zeros(data.shape, dtype=np.float32)
+    groups = np.zeros(data.shape[0], dtype=int)
+    k = 0
+    for row in np.argsort(-obs.sum(axis=1), kind='stable'):
+        x = data[row]
+        if k > 0:
+            conflict = ((rep[:k] == 1) & (x == 0)) | ((rep[:k] == 0) & (x == 1))
+            overlap = (~np.isnan(rep[:k]) & obs[row]).sum(axis=1)
+            fits = np.argwhere(~conflict.any(axis=1) \
+                & (overlap >= min_overlap * obs[row].sum())).flatten()
+        else:
+            fits = []
+        if len(fits) > 0:
+            group = fits[0]
+            rep[group] = np.where(obs[row], x, rep[group])
+        else:
+            group = k
+            rep[group] = x
+            k += 1
+        rep_weights[group] += weights[row] * obs[row]
+        groups[row] = group
+
+    return rep[:k], rep_weights[:k], groups
+
+
+def compress_mutations(data, weights=None):
+    """ Drop mutations without any observation and merge identical mutations
+    into weighted mutations (sharing one cluster parameter)
+
+    Arguments:
+        data (np.array): n x m matrix containing 0|1|np.nan
+        weights (np.array): Weights of the rows (n x 1) or entries (n x m)
+
+    Returns:
+        np.array: n x k matrix of the remaining, unique mutations
+        np.array: n x k weights of the entries
+        np.array: Column of each input mutation (-1 if dropped)
+    """
+    if weights is None:
+        weights = np.ones((data.shape[0], 1), dtype=np.float32)
+
+    cols = np.argwhere(~np.isnan(data).all(axis=0)).flatten()
+    key = np.where(np.isnan(data[:, cols]), 3, data[:, cols]).astype(np.int8)
+    _, first, col_ids = np.unique(key, axis=1, return_index=True,
+        return_inverse=True)
+    col_ids = col_ids.flatten()
+
+    # Sum the weights of merged mutations
+    order = np.argsort(col_ids, kind='stable')
+    starts = np.searchsorted(col_ids[order], np.arange(first.size))
+    weights_full = np.broadcast_to(weights, data.shape)[:, cols]
+    weights_new = np.add.reduceat(weights_full[:, order], starts, axis=1)
+
+    mut_cols = np.full(data.shape[1], -1, dtype=int)
+    mut_cols[cols] = col_ids
+    return data[:, cols[first]], weights_new.astype(np.float32), mut_cols
+
+
 def _get_mcmc_termination(args):
     if args.runtime > 0:
         run_var = (args.time[0] + timedelta(minutes=args.runtime),
@@ -131,6 +447,9 @@ def _get_mcmc_termination(args):
         cutoff = ut.get_cutoff_lugsail(args.lugsail)
         run_var = (cutoff, 0)
         run_str = f'until PSRF < {run_var[0]:f}'
+    elif args.target_ess > 0:
+        run_var = (args.steps, int(args.steps * args.burn_in), args.target_ess)
+        run_str = f'until ESS >= {args.target_ess} (max. {args.steps} steps)'
     else:
         run_var = (args.steps, int(args.steps * args.burn_in))
         run_str = f'for {args.steps} steps'
@@ -262,8 +581,63 @@ def show_MCMC_summary(args, results):
     total_time = args.time[1] - args.time[0]
     step_time = total_time / results[0]['ML'].size
     print(f'\nClustering time:\t{total_time}\t'
-        f'({step_time.total_seconds():.2f} secs. per MCMC step)'
-        f'Lugsail PSRF:\t\t{args.PSRF:.5f}\n')
+        f'({step_time.total_seconds():.2f} secs. per MCMC step)\n'
+        f'Lugsail PSRF:\t\t{args.PSRF:.5f}')
+    show_ESS(results)
+    show_timing(results)
+    show_schedule(results)
+    show_swaps(results)
+
+
+def show_ESS(results):
+    if not 'ESS' in results[0]:
+        return
+    print('Effective sample size (all chains):')
+    for trace in results[0]['ESS']:
+        ess = np.sum([i['ESS'][trace] for i in results])
+        if 'ESS_per_sec' in results[0]:
+            ess_sec = np.sum([i['ESS_per_sec'][trace] for i in results])
+            print(f'\t{trace}:\t{ess:.1f}\t({ess_sec:.2f} per sec.)')
+        else:
+            print(f'\t{trace}:\t{ess:.1f}')
+    print('')
+
+
+def show_timing(results):
+    if not 'timing' in results[0]:
+        return
+    timing = _get_timing_df(results).groupby('move', sort=False).sum()
+    total = timing['time'].sum()
+    print('Time per move (all chains):')
+    for move, (calls, time) in timing[['calls', 'time']].iterrows():
+        if calls == 0:
+            continue
+        print(f'\t{move: <10}\t{int(calls): >7} calls\t{time: >9.2f} secs.\t'
+            f'({time / calls * 1000:.2f} ms/call, {time / total:.1%})')
+    print('')
+
+
+def show_swaps(results):
+    if not 'swaps' in results[0]:
+        return
+    swaps = np.sum([i['swaps'] for i in results], axis=0)
+    print('Replica swap acceptance (all chains):')
+    for i, (accepted, proposed) in enumerate(swaps):
+        print(f'\tReplicas {i} <-> {i + 1}:\t{accepted / max(1, proposed):.2f}'
+            f'\t({int(proposed)} proposed)')
+    print('')
+
+
+def show_schedule(results):
+    if not 'schedule' in results[0]:
+        return
+    print('Move schedule after burn-in:')
+    for i, result in enumerate(results):
+        split, merge = result['schedule']['sm_ratios']
+        print(f'\tChain {i + 1:0>2d}:\tsplit/merge: '
+            f'{result["schedule"]["sm_prob"]:.2f}\t'
+            f'(split: {split:.2f}, merge: {merge:.2f})')
+    print('')
 
     
 def show_model_parameters(data, args, fixed_errors_flag):
@@ -461,6 +835,44 @@ def save_geno(data, out_dir, names=np.array([])):
                 geno.round().astype(int).to_csv(out_file_rnd, sep='\t')
 
 
+def _get_timing_df(results):
+    rows = []
+    for chain, result in enumerate(results):
+        for move, (calls, time) in result['timing'].items():
+            rows.append([chain, move, int(calls), time])
+    return pd.DataFrame(rows, columns=['chain', 'move', 'calls', 'time'])
+
+
+def save_timing(results, out_dir):
+    df = _get_timing_df(results)
+    df['ms_per_call'] = (df['time'] / df['calls'].replace(0, np.nan) * 1000) \
+        .round(4)
+    df.to_csv(os.path.join(out_dir, 'timing.txt'), index=False, sep='\t')
+
+    rows = []
+    for chain, result in enumerate(results):
+        for trace, ess in result['ESS'].items():
+            rows.append([chain, trace, ess, result['ESS_per_sec'][trace]])
+    df_ess = pd.DataFrame(rows, columns=['chain', 'trace', 'ESS', 'ESS_per_sec'])
+    df_ess.to_csv(os.path.join(out_dir, 'ESS.txt'), index=False, sep='\t')
+
+
+def save_checkpoint(chain, step, out_file):
+    # Data is not stored: it is reloaded from the input on resume
+    data = chain.model.detach_data()
+    state = {'chain': chain, 'step': step, 'seed': chain.seed,
+        'rng': np.random.get_state()}
+
+    if not os.path.exists(os.path.dirname(out_file)):
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    try:
+        with open(f'{out_file}.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{out_file}.tmp', out_file)
+    finally:
+        chain.model.attach_data(data)
+
+
 def save_v_measure(data, true_cl, out_dir):
     Vmes = _get_cl_metric_df(data, true_cl, 'V-measure', ut.get_v_measure)
     Vmes.to_csv(os.path.join(out_dir, 'V_measure.txt'), index=False, sep='\t')
@@ -5,15 +5,19 @@ import re
 import numpy as np
 import bottleneck as bn
 import pandas as pd
+import scipy.sparse as sp
 from scipy.special import gamma, binom
 from scipy.stats import chi2
 from scipy.spatial.distance import pdist, squareform
+from scipy.cluster.hierarchy import linkage, fcluster
 from sklearn.metrics import adjusted_rand_score
 from sklearn.metrics.cluster import v_measure_score
 from sklearn.cluster import AgglomerativeClustering
 
 EPSILON = np.finfo(np.float64).resolution
 log_EPSILON = np.log(EPSILON)
+# Missing value in compact (int8) data
+MISSING = 3
 
 DOT_HEADER = 'digraph G {\n' \
     'node [width=0.75 fillcolor="#a6cee3", style=filled, fontcolor=black, ' \
@@ -220,13 +224,19 @@ def _get_latents_posterior_chain(result, data):
     FN = _get_posterior_avg(result['FN'][burn_in:])
     FP = _get_posterior_avg(result['FP'][burn_in:])
 
+    FN_geno, FP_geno = get_geno_errors(geno, data)
+
+    return {'a': a, 'assignment': assign, 'genotypes': geno, 'FN': FN, 'FP': FP,
+        'FN_geno': FN_geno, 'FP_geno': FP_geno}
+
+
+def get_geno_errors(geno, data):
+    # Error rates of the data given the rounded genotypes (mutations x cells)
     FN_geno = ((geno.T.values.round() == 1) & (data == 0)).sum() \
         / geno.values.round().sum()
     FP_geno = ((geno.T.values.round() == 0) & (data == 1)).sum() \
         / (1 - geno.values.round()).sum()
-
-    return {'a': a, 'assignment': assign, 'genotypes': geno, 'FN': FN, 'FP': FP,
-        'FN_geno': FN_geno, 'FP_geno': FP_geno}
+    return FN_geno, FP_geno
 
 
 def _get_posterior_avg(data):
@@ -261,10 +271,7 @@ def _get_latents_point_chain(result, est, data):
     geno_all = result['params'][step_no_bi][np.arange(cl_names.size)] # step_no_bi + 1
     geno = pd.DataFrame(geno_all, index=cl_names).T[assignment]
 
-    FN_geno = ((geno.T.values.round() == 1) & (data == 0)).sum() \
-        / geno.values.round().sum()
-    FP_geno = ((geno.T.values.round() == 0) & (data == 1)).sum() \
-        / (1 - geno.values.round()).sum()
+    FN_geno, FP_geno = get_geno_errors(geno, data)
 
     return {'step': step, 'a': a, 'assignment': assignment, 'genotypes': geno,
         'FN': FN, 'FP': FP, 'FN_geno': FN_geno, 'FP_geno': FP_geno}
@@ -458,5 +465,241 @@ def get_cutoff_lugsail(e, a=0.05):
     return np.sqrt(1 + 1 / M)
 
 
+# ------------------------------------------------------------------------------
+# Data clustering (chain initialization)
+# ------------------------------------------------------------------------------
+
+def sparse_to_dense(data):
+    """ Dense float matrix (not stored entries: np.nan) of sparse data """
+    if not sp.issparse(data):
+        return data
+    coo = data.tocoo()
+    data_dense = np.full(coo.shape, np.nan)
+    data_dense[coo.row, coo.col] = coo.data
+    return data_dense
+
+
+def compact_to_float(data):
+    """ Float matrix (missing: np.nan) of compact int8 data (missing: 3) """
+    data_float = data.astype(float)
+    data_float[data == MISSING] = np.nan
+    return data_float
+
+
+def get_cell_dist(x, y=None, rows=None, block_size=2 ** 22):
+    """ Hamming distance between the rows of x (or the given rows of x) and
+    the rows of y, normalized by the number of mutations observed in both
+    rows. Missing values: np.nan, or 3 in compact data. The rows of x are
+    converted in blocks of block_size matrix entries, such that
+    memory-mapped data is not loaded at once.
+    """
+    if y is None:
+        y = x
+    if rows is None:
+        rows = np.arange(x.shape[0])
+    y1 = (y == 1).astype(np.float32)
+    y0 = (y == 0).astype(np.float32)
+    dist = np.empty((rows.size, y.shape[0]), dtype=np.float32)
+    step = max(1, block_size // max(1, x.shape[1]))
+    for i in range(0, rows.size, step):
+        x_block = x[rows[i:i + step]]
+        x1 = (x_block == 1).astype(np.float32)
+        x0 = (x_block == 0).astype(np.float32)
+        diff = x1 @ y0.T + x0 @ y1.T
+        obs = (x1 + x0) @ (y1 + y0).T
+        dist[i:i + step] = diff / np.maximum(obs, 1)
+    return dist
+
+
+def get_kmedoids_assignment(data, k, max_iter=20, max_candidates=500):
+    """ k-medoids clustering of the cells (Hamming distance, k-medoids++ init).
+    Only distances to the medoids and within subsampled clusters are computed.
+    """
+    n = data.shape[0]
+    k = max(1, min(k, n))
+
+    medoids = [np.random.randint(n)]
+    min_dist = get_cell_dist(data, data[medoids])[:, 0]
+    for _ in range(1, k):
+        if min_dist.sum() == 0:
+            break
+        medoids.append(np.random.choice(n, p=min_dist / min_dist.sum()))
+        min_dist = np.minimum(
+            min_dist, get_cell_dist(data, data[[medoids[-1]]])[:, 0]
+        )
+    medoids = np.array(medoids)
+
+    for _ in range(max_iter):
+        assign = np.argmin(get_cell_dist(data, data[medoids]), axis=1)
+        new_medoids = medoids.copy()
+        for cl in range(medoids.size):
+            cells = np.argwhere(assign == cl).flatten()
+            if cells.size == 0:
+                continue
+            if cells.size > max_candidates:
+                cand = np.random.choice(cells, max_candidates, replace=False)
+            else:
+                cand = cells
+            dist = get_cell_dist(data, data[cand], cells).sum(axis=0)
+            new_medoids[cl] = cand[np.argmin(dist)]
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+
+    return np.argmin(get_cell_dist(data, data[medoids]), axis=1)
+
+
+def get_hierarchical_assignment(data, k, method='average', max_cells=2000):
+    """ Hierarchical clustering of the cells (Hamming distance), cut at k
+    clusters. For more than max_cells cells, only a random subset is
+    clustered and the remaining cells are set to -1 (unassigned).
+    """
+    n = data.shape[0]
+    if n < 2:
+        return np.zeros(n, dtype=int)
+    if n > max_cells:
+        cells = np.sort(np.random.choice(n, max_cells, replace=False))
+    else:
+        cells = np.arange(n)
+
+    dist = get_cell_dist(data[cells]).astype(np.float64)
+    np.fill_diagonal(dist, 0)
+    Z = linkage(squareform(dist, checks=False), method=method)
+
+    assign = np.full(n, -1, dtype=int)
+    assign[cells] = fcluster(Z, max(1, min(k, cells.size)), 'maxclust') - 1
+    return assign
+
+
+# ------------------------------------------------------------------------------
+# Online convergence diagnostics
+# ------------------------------------------------------------------------------
+
+class OnlineESS:
+    """ Running effective sample size estimate of a scalar MCMC trace
+
+    Keeps batch means with a doubling batch size [Flegal and Jones, 2010] and
+    lagged autocovariance sums [Geyer, 1992], both updated in O(1) per sample.
+
+    Arguments:
+        batch_no (int): Number of batches kept before merging neighbours
+        max_lag (int): Maximum lag of the autocorrelation estimate
+    """
+    def __init__(self, batch_no=32, max_lag=50):
+        self.batch_no = batch_no
+        self.max_lag = max_lag
+
+        self.n = 0
+        # Shift by the first value to avoid cancellation in the lag products
+        self.shift = None
+        self.total = 0.
+        self.total_sq = 0.
+        # Batch means
+        self.batch_size = 1
+        self.batch_sums = []
+        self.batch_cur = 0.
+        self.batch_cur_n = 0
+        # Autocorrelation: first/last max_lag values and lagged products
+        self.head = np.zeros(max_lag)
+        self.tail = np.zeros(max_lag)
+        self.lag_prod = np.zeros(max_lag + 1)
+
+
+    def update(self, x):
+        if self.shift is None:
+            self.shift = x
+        y = x - self.shift
+
+        # Lagged products with the last max_lag values (newest first)
+        lags = min(self.n, self.max_lag)
+        self.lag_prod[0] += y * y
+        self.lag_prod[1:lags + 1] += y * self.tail[:lags]
+        self.tail[1:] = self.tail[:-1]
+        self.tail[0] = y
+        if self.n < self.max_lag:
+            self.head[self.n] = y
+
+        self.n += 1
+        self.total += y
+        self.total_sq += y * y
+
+        self.batch_cur += y
+        self.batch_cur_n += 1
+        if self.batch_cur_n == self.batch_size:
+            self.batch_sums.append(self.batch_cur)
+            self.batch_cur = 0.
+            self.batch_cur_n = 0
+            # Merge neighbouring batches: batch size doubles
+            if len(self.batch_sums) == 2 * self.batch_no:
+                sums = np.array(self.batch_sums)
+                self.batch_sums = list(sums[::2] + sums[1::2])
+                self.batch_size *= 2
+
+
+    def get_mean(self):
+        if self.n == 0:
+            return np.nan
+        return self.shift + self.total / self.n
+
+
+    def get_var(self):
+        if self.n < 2:
+            return np.nan
+        mean = self.total / self.n
+        return max(0, (self.total_sq - self.n * mean ** 2) / (self.n - 1))
+
+
+    def get_ess_batch_means(self):
+        a = len(self.batch_sums)
+        var = self.get_var()
+        if a < 2 or not var > 0:
+            return np.nan
+        batch_means = np.array(self.batch_sums) / self.batch_size
+        sigma_bm = self.batch_size * np.var(batch_means, ddof=1)
+        if sigma_bm <= 0:
+            return float(self.n)
+        return self.n * var / sigma_bm
+
+
+    def get_ess_autocorr(self):
+        lags = min(self.n - 1, self.max_lag)
+        if lags < 2:
+            return np.nan
+        n = self.n
+        mean = self.total / n
+        k = np.arange(lags + 1)
+        # Sums over y_k..y_{n-1} and y_0..y_{n-1-k}
+        head_sum = np.append(0, np.cumsum(self.head[:lags]))
+        tail_sum = np.append(0, np.cumsum(self.tail[:lags]))
+        auto_cov = (self.lag_prod[:lags + 1]
+            - mean * (2 * self.total - head_sum - tail_sum)
+            + (n - k) * mean ** 2) / n
+        if auto_cov[0] <= 0:
+            return np.nan
+        rho = auto_cov / auto_cov[0]
+
+        # Initial positive sequence estimator [Geyer, 1992]
+        tau = -1
+        for t in range(0, lags - 1, 2):
+            pair = rho[t] + rho[t + 1]
+            if pair < 0:
+                break
+            tau += 2 * pair
+        return n / max(tau, 1 / n)
+
+
+    def get_ess(self):
+        """ Conservative ESS: minimum of the batch means and autocorrelation
+        estimates. Traces without variance (e.g. fixed errors) return inf.
+        """
+        if self.n > 1 and self.get_var() == 0:
+            return np.inf
+        ess = [self.get_ess_batch_means(), self.get_ess_autocorr()]
+        ess = [i for i in ess if not np.isnan(i)]
+        if not ess:
+            return np.nan
+        return min(min(ess), self.n)
+
+
 if __name__ == '__main__':
     print('Here be dragons...')
\ No newline at end of file
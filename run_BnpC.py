@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 
+import os
 import argparse
+import tempfile
 from datetime import datetime
+import numpy as np
+import scipy.sparse as sp
 
 from libs.MCMC import MCMC as MCMC
+from libs.VI import VI
+
 import libs.dpmmIO as io
+import libs.utils as ut
 
 # ------------------------------------------------------------------------------
 # ARGPARSER
 # ------------------------------------------------------------------------------
 
-def parse_args():
+def parse_args(argv=None):
 
     def check_ratio(val):
         val = float(val)
@@ -43,6 +50,31 @@ def parse_args():
         '-t', '--transpose', action='store_false',
         help='Transpose the input matrix. Default = True.'
     )
+    parser.add_argument(
+        '--no_cache', action='store_true', default=False,
+        help='Do not store/reuse the parsed input matrix next to the input '
+            'file. Default = False.'
+    )
+    parser.add_argument(
+        '-cc', '--collapse_cells', type=str, nargs='?', const='exact',
+        default='', choices=['exact', 'observed'],
+        help='Collapse duplicate cells into weighted cells that are moved as '
+            'units: identical cells (exact) or cells identical on all entries '
+            'observed in both (observed). Default = no collapsing.'
+    )
+    parser.add_argument(
+        '-cm', '--compress_mutations', action='store_true', default=False,
+        help='Drop mutations without observations and merge identical '
+            'mutations into weighted mutations sharing one cluster parameter. '
+            'Default = False.'
+    )
+    parser.add_argument(
+        '-ooc', '--out_of_core', type=int, nargs='?', const=2 ** 22,
+        default=-1,
+        help='Keep the data matrix in a memory-mapped file (shared by all '
+            'chains) and process it in blocks of <int> matrix entries. '
+            'Default = in memory (2^22 if set without value).'
+    )
     parser.add_argument(
         '--debug', action='store_true', default=False,
         help='Run single chain in main python thread for debugging with pdb.'
@@ -88,6 +120,22 @@ def parse_args():
         help='Path to file containing a cluster assignment. If set, this '
             'assignment is used and not updated. Default = "".'
     )
+    model.add_argument(
+        '-ia', '--init_assignment', type=str, default='',
+        help='Path to an assignment file or to the output directory of a '
+            'previous run. The chains are initialized with this assignment '
+            '(or with the last state of the checkpointed chains), which is '
+            'still updated. Default = "".'
+    )
+    model.add_argument(
+        '-in', '--init', type=str, default='random',
+        choices=['random', 'separate', 'together', 'kmedoids', 'hierarchical',
+            'dispersed'],
+        help='Initialization of the chains: random assignment, data-driven '
+            'clustering (Hamming distance k-medoids or hierarchical) at '
+            'cluster numbers spread around the prior expectation, or both '
+            'alternating between chains (dispersed). Default = random.'
+    )
 
     mcmc = parser.add_argument_group('MCMC')
     mcmc.add_argument(
@@ -113,6 +161,14 @@ def parse_args():
             'of the confidence interval in sample size calculation for a '
             'one sample t-test. Default = -1; Reasonal values = 0.1|0.2|0.3 .'
     )
+    mcmc.add_argument(
+        '-ess', '--target_ess', type=float, default=-1,
+        help='Run until the effective sample size (summed over all chains) of '
+            'the likelihood, CRP a_0, error rates and cluster number reaches '
+            'the given target. The burn-in is defined by the steps and burn-in '
+            'arguments, the steps argument is used as upper limit. '
+            'Default = -1.'
+    )
     mcmc.add_argument(
         '-b', '--burn_in', type=check_percent, default=0.33,
         help='Ratio of MCMC steps treated as burn-in. These steps are discarded.'\
@@ -142,7 +198,108 @@ def parse_args():
         '-smr', '--split_merge_ratios', type=check_percent, nargs=2,
         default=[0.8, 0.2], help='Ratio of splits/merges. Default = 0.75:0.25'
     )
+    mcmc.add_argument(
+        '-sma', '--split_merge_anchors', type=str, default='random',
+        choices=['random', 'disagreement'],
+        help='Choice of the two anchor cells of a split: uniformly (random) '
+            'or the second one proportional to its disagreement with the '
+            'cluster parameters (disagreement). Default = random.'
+    )
+    mcmc.add_argument(
+        '-smm', '--split_merge_partners', type=str, default='size',
+        choices=['size', 'similarity'],
+        help='Choice of the second cluster of a merge: proportional to its '
+            'inverse size (size) or decaying with the distance of its '
+            'parameters to the first cluster (similarity). Default = size.'
+    )
+
+    mcmc.add_argument(
+        '-bg', '--blocked', type=int, nargs='?', const=50, default=0,
+        help='Blocked Gibbs sampling: all cells are assigned at once, given '
+            'the weights of a stick-breaking representation truncated at '
+            '<int> clusters (Default if set = 50). Default = 0 (sequential '
+            'Gibbs sampling).'
+    )
+
+    mcmc.add_argument(
+        '-gc', '--grid_collapsed', type=int, nargs='?', const=100, default=0,
+        help='Gibbs sampling with the cluster parameters integrated out over '
+            'a grid of <int> points (Default if set = 100). Default = 0 '
+            '(Gibbs sampling given the cluster parameters).'
+    )
+
+    mcmc.add_argument(
+        '-mb', '--minibatch', type=check_ratio, default=1,
+        help='Fraction of the cells updated per Gibbs sweep. The cells of a '
+            'random permutation are split into batches, such that every cell '
+            'is updated once per 1 / <float> sweeps. Not supported with -bg '
+            'and -gc. Default = 1 (all cells).'
+    )
+
+    mcmc.add_argument(
+        '-gmh', '--gibbs_mh', type=int, nargs='?', const=8, default=0,
+        help='MH Gibbs sweep: the exact likelihood of a cell is evaluated '
+            'only for the <int> clusters (Default if set = 8) with the '
+            'highest approximate posteriors, comparing the bit-packed '
+            'observations with the rounded cluster genotypes. Not supported '
+            'with -bg and -gc. Default = 0 (all clusters).'
+    )
+
+    mcmc.add_argument(
+        '-ps', '--param_sampler', type=str, default='MH',
+        choices=['MH', 'augmented'],
+        help='Update of the cluster parameters and error rates. "augmented" '
+            'draws the latent genotypes of the observations and the '
+            'parameters from their Beta posterior (no MH proposals). '
+            'Default = MH.'
+    )
+
+    mcmc.add_argument(
+        '-apr', '--adapt_proposals', action='store_true', default=False,
+        help='Adapt the proposal scales of the cluster parameters (per '
+            'mutation) and error rates toward an acceptance rate of 0.44 '
+            'during burn-in. Default = False.'
+    )
+
+    mcmc.add_argument(
+        '-sch', '--schedule_moves', action='store_true', default=False,
+        help='Adapt the probabilities of Gibbs, split and merge moves to the '
+            'cells they reassign per second during burn-in. The -smp and -smr '
+            'values are used as start. Default = False.'
+    )
+
+    mcmc.add_argument(
+        '-pt', '--tempering', type=int, default=1,
+        help='Number of tempered replicas per chain (parallel tempering). '
+            'Each replica runs in its own process, with inverse temperatures '
+            'geometrically spaced from 1 (returned chain) to -ptm. Not '
+            'supported with -ls, --resume and --debug. Default = 1 (no '
+            'tempering).'
+    )
+
+    mcmc.add_argument(
+        '-ptm', '--tempering_min', type=float, default=0.1,
+        help='Inverse temperature of the hottest tempered replica. '
+            'Default = 0.1.'
+    )
 
+    mcmc.add_argument(
+        '-pts', '--swap_every', type=int, default=10,
+        help='Steps between two state swaps of tempered replicas. Default = 10.'
+    )
+
+    mcmc.add_argument(
+        '-cp', '--checkpoint', type=int, default=-1,
+        help='Write a checkpoint of each chain every <int> steps to '
+            '<OUTPUT_DIR>/checkpoints. Default = -1 (no checkpoints).'
+    )
+    mcmc.add_argument(
+        '--resume', type=str, default='',
+        help='Output directory of a previous run. All chains are restarted '
+            'from their last checkpoint and run until the termination '
+            'criterion is met. Finished runs are extended by the additional '
+            'steps, keeping their burn-in. Default = "".'
+    )
     mcmc.add_argument(
         '-e', '--estimator', type=str, default='posterior', nargs='+',
         choices=['posterior', 'ML', 'MAP'],
@@ -158,6 +315,21 @@ def parse_args():
         help='Seed used for random number generation. Default = random.'
     )
 
+    vi = parser.add_argument_group('variational inference')
+    vi.add_argument(
+        '-vi', '--variational', type=int, nargs='?', const=50, default=0,
+        help='Mean-field variational inference with <int> stick-breaking '
+            'components (Default if set = 50) instead of MCMC. The result is '
+            'reported as estimator "VI", -n sets the number of random '
+            'restarts. Default = 0 (MCMC).'
+    )
+    vi.add_argument(
+        '-vii', '--vi_init', action='store_true', default=False,
+        help='Initialize the MCMC chains with the assignment of the '
+            'variational inference (-vi) instead of reporting it. '
+            'Default = False.'
+    )
+
     output = parser.add_argument_group('output')
     output.add_argument(
         '-o', '--output', type=str, default='',
@@ -171,6 +343,11 @@ def parse_args():
         '-np', '--no_plots', action='store_true', default=False,
         help='Generate result plots. Default = False.'
     )
+    output.add_argument(
+        '-pr', '--profile', action='store_true', default=False,
+        help='Record calls and wall time per MCMC move and write them to the '
+            'output directory. Default = False.'
+    )
     output.add_argument(
         '-tr', '--tree', type=str, default='',
         help='Absolute or relative path to the tree file (.gv) used for data ' \
@@ -188,7 +365,7 @@ def parse_args():
             'Default = "".'
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
@@ -196,74 +373,123 @@ def parse_args():
 # INIT AND OUTPUT FUNCTIONS
 # ------------------------------------------------------------------------------
 
-def generate_output(args, results, data_raw, names):
-    out_dir = io._get_out_dir(args)
-    inferred = io._infer_results(args, results, data_raw)
-    
-    if args.verbosity > 0:
-        io.show_MCMC_summary(args, results)
-        io.show_assignments(inferred, names[0])
-        io.show_latents(inferred)
-        print(f'\nWriting output to: {out_dir}\n')
-
-    io.save_run(inferred, args, out_dir, names)
-
-    if args.true_clusters:
-        true_assign = io.load_txt(args.true_clusters)
-        io.save_v_measure(inferred, true_assign, out_dir)
-        io.save_ARI(inferred, true_assign, out_dir)
-
-    if args.true_data:
-        data_true = io.load_data(args.true_data, transpose=args.transpose)
-        io.save_hamming_dist(inferred, data_true, out_dir)
-
-    if args.no_plots:
-        exit()
-
-    # Generate plots
-    io.save_trace_plots(results, out_dir)
-    if data_raw.shape[0] < 300:
-        if args.tree:
-            io.save_tree_plots(
-                args.tree, inferred, out_dir, args.transpose
-            )
-        io.save_similarity(args, results, out_dir)
-        if args.true_data:
-            io.save_geno_plots(inferred, data_true, out_dir, names)
-        else:
-            io.save_geno_plots(inferred, data_raw, out_dir, names)
+def load_input(args):
+    io.process_sim_folder(args, suffix='')
+    return io.load_data(args.input, transpose=args.transpose, get_names=True,
+        compact=args.out_of_core > 0, cache=not args.no_cache)
+
+
+def get_memmap_data(args, data):
+    if sp.issparse(data):
+        raise ValueError('Out-of-core mode is not supported for sparse input')
+    # Row-major memory-mapped int8 data: used as it is, otherwise copied
+    if isinstance(data, np.memmap) and data.flags['C_CONTIGUOUS']:
+        return data, ''
+    fd, mmap_file = tempfile.mkstemp(suffix='.npy',
+        prefix=os.path.basename(args.input) + '.',
+        dir=os.path.dirname(os.path.abspath(args.input)))
+    os.close(fd)
+    return io.save_memmap(data, mmap_file), mmap_file
+
+
+def get_model(args, data):
+    if (sp.issparse(data) or args.out_of_core > 0) \
+            and (args.collapse_cells or args.compress_mutations):
+        raise ValueError('Collapsing cells or mutations is not supported for '
+            'sparse input or out-of-core mode')
+
+    if args.collapse_cells:
+        data, weights, cell_rows = io.collapse_cells(
+            data, observed=args.collapse_cells == 'observed'
+        )
     else:
-        print('Too many cells to plot genotypes/clusters')
+        weights, cell_rows = None, None
 
+    if args.compress_mutations:
+        data, weights, mut_cols = io.compress_mutations(data, weights)
+    else:
+        mut_cols = None
 
-def main(args):
-    io.process_sim_folder(args, suffix='')
-    data, data_names = io.load_data(
-        args.input, transpose=args.transpose, get_names=True
-    )
+    if args.out_of_core > 0:
+        block_size = args.out_of_core
+    else:
+        block_size = None
+
+    if (args.minibatch < 1 or args.gibbs_mh > 0) \
+            and (args.blocked > 0 or args.grid_collapsed > 0):
+        raise ValueError('Minibatch and MH Gibbs sweeps are not supported for '
+            'blocked and grid-collapsed Gibbs sampling')
+
+    # Blocked Gibbs sampler with truncated stick-breaking weights
+    if args.blocked > 0:
+        if args.grid_collapsed > 0:
+            raise ValueError('Blocked and grid-collapsed Gibbs sampling can '
+                'not be combined')
+        import libs.CRP_blocked as CRP_blocked
+        blocked = {'truncation': args.blocked}
+        # Label-dependent target: no split-merge moves
+        args.split_merge_prob = 0
+    else:
+        blocked = {}
 
     if args.falsePositive > 0 and args.falseNegative > 0:
         args.error_update_prob = 0
-        import libs.CRP as CRP
-        BnpC = CRP.CRP(
+        if blocked:
+            model = CRP_blocked.CRP_blocked
+        else:
+            import libs.CRP as CRP
+            model = CRP.CRP
+        BnpC = model(
             data, DP_alpha=args.DPa_prior, param_beta=args.param_prior,
             FN_error=args.falseNegative, FP_error=args.falsePositive,
+            weights=weights, cell_rows=cell_rows, mut_cols=mut_cols,
+            block_size=block_size, **blocked
         )
     else:
-        import libs.CRP_learning_errors as CRP
-        BnpC = CRP.CRP_errors_learning(
+        if blocked:
+            model = CRP_blocked.CRP_blocked_errors
+        else:
+            import libs.CRP_learning_errors as CRP
+            model = CRP.CRP_errors_learning
+        BnpC = model(
             data, DP_alpha=args.DPa_prior, param_beta=args.param_prior,
             FP_mean=args.falsePositive_mean, FP_sd=args.falsePositive_std,
-            FN_mean=args.falseNegative_mean, FN_sd=args.falseNegative_std
+            FN_mean=args.falseNegative_mean, FN_sd=args.falseNegative_std,
+            weights=weights, cell_rows=cell_rows, mut_cols=mut_cols,
+            block_size=block_size, **blocked
         )
+    return BnpC
+
 
+def run_MCMC(args, BnpC, init_assign=''):
     args.time = [datetime.now()]
     run_var, run_str = io._get_mcmc_termination(args)
 
+    if args.resume:
+        resume_dir = os.path.join(args.resume, 'checkpoints')
+        if not args.output:
+            args.output = args.resume
+    else:
+        resume_dir = ''
+
+    if args.checkpoint > 0 or args.resume:
+        checkpoint_dir = os.path.join(io._get_out_dir(args), 'checkpoints')
+    else:
+        checkpoint_dir = ''
+
     mcmc = MCMC(
         BnpC, sm_prob=args.split_merge_prob, dpa_prob=args.conc_update_prob,
         error_prob=args.error_update_prob, sm_ratios=args.split_merge_ratios,
-        sm_steps=args.split_merge_steps
+        sm_steps=args.split_merge_steps,
+        sm_anchors=args.split_merge_anchors,
+        sm_partners=args.split_merge_partners, grid=args.grid_collapsed,
+        minibatch=args.minibatch, gibbs_mh=args.gibbs_mh,
+        param_sampler=args.param_sampler, adapt=args.adapt_proposals,
+        schedule=args.schedule_moves, tempering=args.tempering,
+        tempering_min=args.tempering_min, swap_every=args.swap_every,
+        profile=args.profile,
+        checkpoint_dir=checkpoint_dir, checkpoint_every=args.checkpoint,
+        init=args.init
     )
 
     if args.verbosity > 0:
@@ -276,16 +502,121 @@ def main(args):
 
     mcmc.run(
         run_var, args.seed, args.chains, args.verbosity, args.fixed_assignment,
-        args.debug
+        args.debug, resume_dir, init_assign
     )
+    if args.resume:
+        args.chains = len(mcmc.chains)
 
     args.chain_seeds = mcmc.get_seeds()
     results = mcmc.get_results()
     args.time.append(datetime.now())
+    return results
+
+
+def run_VI(args, BnpC):
+    args.time = [datetime.now()]
+    if args.seed > 0:
+        np.random.seed(args.seed)
+
+    vi = VI(BnpC, truncation=args.variational)
+    if args.verbosity > 0:
+        print(BnpC)
+        print(vi)
+        print(f'Run variational inference ({args.chains} restarts):')
+    vi.fit(args.chains, args.verbosity)
+    args.time.append(datetime.now())
+    return vi
 
-    generate_output(args, results, data, data_names)
+
+def save_output(args, results, inferred, out_dir, names):
+    if args.verbosity > 0:
+        if results is not None:
+            io.show_MCMC_summary(args, results)
+        io.show_assignments(inferred, names[0])
+        io.show_latents(inferred)
+        print(f'\nWriting output to: {out_dir}\n')
+
+    io.save_run(inferred, args, out_dir, names)
+    if args.profile and results is not None:
+        io.save_timing(results, out_dir)
+
+    if args.true_clusters:
+        true_assign = io.load_txt(args.true_clusters)
+        io.save_v_measure(inferred, true_assign, out_dir)
+        io.save_ARI(inferred, true_assign, out_dir)
+
+    if args.true_data:
+        data_true = io.load_data(args.true_data, transpose=args.transpose,
+            cache=not args.no_cache)
+        io.save_hamming_dist(inferred, data_true, out_dir)
+    else:
+        data_true = None
+
+    return data_true
+
+
+def generate_plots(args, results, inferred, data_raw, data_true, out_dir,
+            names):
+    if results is not None:
+        io.save_trace_plots(results, out_dir)
+    if data_raw.shape[0] < 300:
+        if data_raw.dtype == np.int8:
+            data_raw = ut.compact_to_float(data_raw)
+        if args.tree:
+            io.save_tree_plots(
+                args.tree, inferred, out_dir, args.transpose
+            )
+        if results is not None:
+            io.save_similarity(args, results, out_dir)
+        if data_true is not None:
+            io.save_geno_plots(inferred, data_true, out_dir, names)
+        else:
+            io.save_geno_plots(inferred, data_raw, out_dir, names)
+    else:
+        print('Too many cells to plot genotypes/clusters')
+
+
+def generate_output(args, results, data_raw, names, vi=None):
+    out_dir = io._get_out_dir(args)
+    if vi is None:
+        inferred = io._infer_results(args, results, data_raw)
+    else:
+        args.estimator = ['VI']
+        args.chains = 1
+        inferred = {'mean': {'VI': vi.get_inferred(data_raw)}}
+    data_true = save_output(args, results, inferred, out_dir, names)
+
+    if not args.no_plots:
+        generate_plots(
+            args, results, inferred, data_raw, data_true, out_dir, names
+        )
+
+
+def main(args):
+    data, data_names = load_input(args)
+    mmap_file = ''
+    if args.out_of_core > 0:
+        data, mmap_file = get_memmap_data(args, data)
+    try:
+        BnpC = get_model(args, data)
+        if args.variational > 0:
+            vi = run_VI(args, BnpC)
+            if not args.vi_init:
+                generate_output(args, None, ut.sparse_to_dense(data),
+                    data_names, vi)
+                return
+            init_assign = [
+                BnpC.expand_assignment(vi.get_assignment()[1]).tolist()
+            ]
+        else:
+            init_assign = args.init_assignment
+        results = run_MCMC(args, BnpC, init_assign)
+        generate_output(args, results, ut.sparse_to_dense(data), data_names)
+    finally:
+        if mmap_file:
+            os.remove(mmap_file)
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+import os
+import pytest
+
+import libs.dpmmIO as io
+
+EXAMPLE_FILE = os.path.join(
+    os.path.dirname(__file__), '..', 'example_data', 'data.csv'
+)
+
+
+@pytest.fixture
+def example_file():
+    return EXAMPLE_FILE
+
+
+@pytest.fixture
+def example_data():
+    # Cells x mutations, without writing a cache next to the example data
+    return io.load_data(EXAMPLE_FILE, transpose=True, cache=False)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from libs.CRP import ADAPT_SCALE, ADAPT_TARGET, CRP
+from run_BnpC import parse_args, main
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3, 4, 5])
+def test_adapt_proposals_run(tmp_path, example_file, seed):
+    # Adapted proposal scales must not underflow the truncated normal
+    args = parse_args([example_file, '-apr', '-s', '80', '-e', 'ML', '-np',
+        '-v', '0', '--no_cache', '--seed', str(seed), '-o', str(tmp_path)])
+    main(args)
+    assert (tmp_path / 'assignment.txt').exists()
+
+
+def test_adapt_scale():
+    # Scales grow above and shrink below the target acceptance rate, within
+    # the bounds
+    scale = np.ones(4)
+    rate = np.array([0, ADAPT_TARGET - 0.1, ADAPT_TARGET + 0.1, 1])
+    new = CRP._adapt_scale(scale, rate, 1)
+    assert (new[:2] < 1).all() and (new[2:] > 1).all()
+    assert np.allclose(CRP._adapt_scale(scale, rate, 10 ** 6), 1, atol=1e-3)
+    assert (CRP._adapt_scale(np.array([1e3, 1e-3]), np.array([1, 0]), 1) \
+        == ADAPT_SCALE[::-1]).all()
+
+
+def test_adapted_acceptance(example_data):
+    # Adapting the parameter proposals moves the acceptance rates of the
+    # mutations toward the target
+    np.random.seed(0)
+    model = CRP(example_data, DP_alpha=[1, 1], param_beta=[.5, .5],
+        FN_error=0.3, FP_error=0.1)
+    model.init(assign=(np.arange(example_data.shape[0]) % 4).tolist())
+
+    def get_acceptance(steps, adapt):
+        accepted = 0
+        for _ in range(steps):
+            declined, accepted_step = model.update_parameters(adapt=adapt)
+            accepted += accepted_step / (declined + accepted_step)
+        return accepted / steps
+
+    before = get_acceptance(20, False)
+    get_acceptance(100, True)
+    after = get_acceptance(20, False)
+    assert abs(after - ADAPT_TARGET) < abs(before - ADAPT_TARGET)
+    assert (model.param_proposal_scale >= ADAPT_SCALE[0]).all()
+    assert (model.param_proposal_scale <= ADAPT_SCALE[1]).all()
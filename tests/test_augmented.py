@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from scipy.stats import beta
+
+from libs.CRP import CRP
+from libs.CRP_learning_errors import CRP_errors_learning
+
+
+def test_augmented_parameter_posterior(example_data):
+    # Augmented Gibbs updates sample the posterior of the cluster parameters
+    np.random.seed(0)
+    data = example_data[:12, :6]
+    model = CRP(data, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+        FP_error=0.1)
+    model.init(assign=[0] * data.shape[0])
+    samples = np.empty((4000, data.shape[1]))
+    for step in range(samples.shape[0]):
+        model.update_parameters(augment=True)
+        samples[step] = model.parameters[0]
+    obs = ~np.isnan(data)
+    assert model.latent_counts.sum() == obs.sum()
+
+    # Posterior mean on a grid
+    theta = np.linspace(0.0005, 0.9995, 1000)[:, np.newaxis]
+    ones, zeros = model._get_counts(np.arange(data.shape[0]))
+    l1, l0 = model._log_Bernoulli(theta)
+    lpost = beta.logpdf(theta, .5, .5) + ones * l1 + zeros * l0
+    with np.errstate(under='ignore'):
+        post = np.exp(lpost - lpost.max(axis=0))
+    mean = (theta * post).sum(axis=0) / post.sum(axis=0)
+    assert np.abs(samples[500:].mean(axis=0) - mean).max() < 0.03
+
+
+def test_augmented_error_posterior(example_data):
+    # Given the latent genotype counts, the error rate updates sample the
+    # prior times the count likelihood
+    np.random.seed(0)
+    model = CRP_errors_learning(example_data, DP_alpha=[1, 1], FP_mean=0.05,
+        FP_sd=0.02, FN_mean=0.25, FN_sd=0.05)
+    model.latent_counts = np.array([40, 20, 3, 60])
+    samples = np.empty((5000, 2))
+    for step in range(samples.shape[0]):
+        model.FP, _ = model.augmented_error_rates('FP')
+        model.FN, _ = model.augmented_error_rates('FN')
+        samples[step] = model.FP, model.FN
+
+    err = np.linspace(0.0005, 0.9995, 1000)
+    for i, (prior, (k, n)) in enumerate([(model.FP_prior, (3, 60)),
+            (model.FN_prior, (20, 40))]):
+        with np.errstate(under='ignore'):
+            lpost = prior.logpdf(err) + k * np.log(err) + n * np.log(1 - err)
+            post = np.exp(lpost - lpost.max())
+            mean = (err * post).sum() / post.sum()
+        assert abs(samples[500:, i].mean() - mean) < 0.01
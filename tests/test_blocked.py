@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from libs.CRP_blocked import CRP_blocked
+
+
+def test_truncation(monkeypatch, example_data):
+    # A random init with more clusters than sticks is truncated before the
+    # first sweep: the likelihood matrix has one column per stick
+    np.random.seed(0)
+    model = CRP_blocked(example_data, DP_alpha=[1, 1], param_beta=[.5, .5],
+        FN_error=0.2, FP_error=0.01, truncation=10)
+    model.init()
+    assert len(model.cells_per_cluster) > model.truncation
+
+    ks = []
+    calc_ll_matrix = CRP_blocked._calc_ll_matrix
+
+    def calc_ll_matrix_rec(self, theta):
+        ks.append(theta.shape[0])
+        return calc_ll_matrix(self, theta)
+
+    monkeypatch.setattr(CRP_blocked, '_calc_ll_matrix', calc_ll_matrix_rec)
+    for _ in range(5):
+        model.update_assignments_Gibbs()
+        model.update_parameters()
+        assert model.assignment.max() < model.truncation
+        cl, sizes = np.unique(model.assignment, return_counts=True)
+        assert dict(zip(cl, sizes)) == model.cells_per_cluster
+    assert set(ks) == {model.truncation}
+
+
+def test_truncated_init_keeps_largest(example_data):
+    np.random.seed(0)
+    model = CRP_blocked(example_data, DP_alpha=[1, 1], param_beta=[.5, .5],
+        FN_error=0.2, FP_error=0.01, truncation=3)
+    model.init(assign=(np.arange(example_data.shape[0]) % 5).tolist())
+    model.cells_per_cluster[4] -= 10
+    model.assignment[np.flatnonzero(model.assignment == 4)[:10]] = 0
+    model.cells_per_cluster[0] += 10
+    params = model.parameters[[0, 1, 2]].copy()
+    model._truncate_clusters()
+    assert model.assignment.max() < 3
+    assert np.array_equal(model.parameters[:3], params)
+    assert sum(model.cells_per_cluster.values()) == example_data.shape[0]
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+import libs.dpmmIO as io
+from libs.CRP import CRP
+
+
+def get_model(data, assign, theta, **kwargs):
+    model = CRP(data, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+        FP_error=0.1, **kwargs)
+    model.init(assign=assign.tolist())
+    model.parameters[:theta.shape[0]] = theta
+    return model
+
+
+@pytest.mark.parametrize('mode', ['exact', 'observed'])
+def test_collapsed_likelihood(example_data, mode):
+    # Weighted representatives give the likelihood and the CRP prior of the
+    # uncollapsed cells
+    np.random.seed(0)
+    data = np.concatenate([example_data, example_data[:40]])
+    data[100:120, ::7] = np.nan
+    rows, weights, cell_rows = io.collapse_cells(data,
+        observed=mode == 'observed')
+    assert rows.shape[0] < data.shape[0]
+
+    assign = cell_rows % 4
+    theta = np.random.uniform(0.05, 0.95, (4, data.shape[1]))
+    full = get_model(data, assign, theta)
+    collapsed = get_model(rows, assign, theta, weights=weights,
+        cell_rows=cell_rows)
+    assert (collapsed.expand_assignment(collapsed.assignment) == assign).all()
+    assert collapsed.cells_per_cluster == full.cells_per_cluster
+    assert np.isclose(collapsed.get_ll_full(), full.get_ll_full())
+    assert np.isclose(collapsed.get_lprior_full(), full.get_lprior_full())
+
+
+def test_compressed_mutations(example_data):
+    # Merged mutations share one parameter and dropped mutations carry no
+    # observation: the likelihood equals the one of the input mutations
+    np.random.seed(0)
+    data = np.concatenate([example_data, example_data[:, :30]], axis=1)
+    data[:, 50] = np.nan
+    cols, weights, mut_cols = io.compress_mutations(data)
+    assert cols.shape[1] < data.shape[1] - 30
+    assert mut_cols[50] == -1
+    assert (mut_cols[100:] == mut_cols[:30]).all()
+
+    assign = np.arange(data.shape[0]) % 4
+    theta = np.random.uniform(0.05, 0.95, (4, cols.shape[1]))
+    compressed = get_model(cols, assign, theta, weights=weights,
+        mut_cols=mut_cols)
+    theta_full = compressed.expand_params(theta)
+    assert np.allclose(theta_full[:, 50], compressed.p \
+        / (compressed.p + compressed.q))
+    full = get_model(data, assign, theta_full)
+    assert np.isclose(compressed.get_ll_full(), full.get_ll_full())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from libs.CRP import CRP
+
+
+def get_model(data, muts=100, k=None):
+    np.random.seed(0)
+    data = data[:, :muts]
+    model = CRP(data, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+        FP_error=0.1)
+    if k:
+        model.init(assign=(np.arange(data.shape[0]) % k).tolist())
+    else:
+        model.init()
+    return model
+
+
+def test_proposal_matches_acceptance(monkeypatch, example_data):
+    # The proposal used in the acceptance ratio is the one sampled from
+    model = get_model(example_data)
+    sampled = []
+    choice = np.random.choice
+    accept = CRP._accept_MH
+
+    def choice_rec(a, *args, p=None, **kwargs):
+        sampled.append(p)
+        return choice(a, *args, p=p, **kwargs)
+
+    def accept_rec(lpost, probs, new, cur):
+        assert probs is sampled[-1]
+        assert np.isfinite(lpost[[new, cur]]).all()
+        return accept(lpost, probs, new, cur)
+
+    monkeypatch.setattr(np.random, 'choice', choice_rec)
+    monkeypatch.setattr(CRP, '_accept_MH', staticmethod(accept_rec))
+    for _ in range(5):
+        model.update_assignments_Gibbs_MH(candidates=2)
+        model.update_parameters()
+
+
+def test_candidate_proposal():
+    lpost = np.array([-1., -3., -2.])
+    cand = np.array([4, 0, 2])
+    probs = CRP._get_candidate_proposal(lpost, cand, 6)
+    assert np.isclose(probs.sum(), 1)
+    assert (probs > 0).all()
+    cand_probs = probs[cand] - probs[1]
+    assert np.allclose(cand_probs / cand_probs.sum(),
+        np.exp(lpost) / np.exp(lpost).sum())
+
+
+def test_conditional_distribution(example_data):
+    # Updating a single cell samples its exact Gibbs conditional
+    model = get_model(example_data, muts=6, k=5)
+    cell_id = 0
+    w = model.cell_weights[cell_id]
+    old = model.assignment[cell_id]
+    if model.cells_per_cluster[old] == w:
+        del model.cells_per_cluster[old]
+    else:
+        model.cells_per_cluster[old] -= w
+    cl_ids = np.fromiter(model.cells_per_cluster.keys(), dtype=int)
+    lpost = np.append(model.get_lpost_single(cell_id, cl_ids),
+        model.get_lpost_single_new_cluster([cell_id])[0])
+    target = model._normalize_log_probs(lpost)
+    model.cells_per_cluster[old] = model.cells_per_cluster.get(old, 0) + w
+
+    counts = np.zeros(target.size)
+    for _ in range(40000):
+        model.gibbs_queue = [np.array([cell_id])]
+        model.update_assignments_Gibbs_MH(candidates=2, fraction=0.5)
+        cl = np.flatnonzero(cl_ids == model.assignment[cell_id])
+        counts[cl[0] if cl.size else -1] += 1
+    assert np.abs(counts / counts.sum() - target).max() < 0.025
+
+
+def test_cached_candidates(monkeypatch, example_data):
+    # Candidates from the per-sweep cache equal the clusters with the highest
+    # approximate likelihoods among all alive clusters
+    model = get_model(example_data, k=20)
+    model.DP_a = 50
+    model.init_DP_prior()
+    get_candidates = CRP._get_candidates
+    fallbacks = []
+
+    def get_candidates_rec(self, cell_id, cl_ids, cached, cached_ll,
+                survivors, born, n):
+        cand = get_candidates(self, cell_id, cl_ids, cached, cached_ll,
+            survivors, born, n)
+        ll = self._calc_ll_bits([cell_id], cl_ids)[0]
+        assert (cand == cl_ids[np.lexsort((cl_ids, -ll))[:n]]).all()
+        fallbacks.append(survivors[cached].sum() < n)
+        return cand
+
+    monkeypatch.setattr(CRP, '_get_candidates', get_candidates_rec)
+    for _ in range(5):
+        model.update_assignments_Gibbs_MH(candidates=2)
+        model.update_parameters()
+    assert len(fallbacks) > 0 and not all(fallbacks)
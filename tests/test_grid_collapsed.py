@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from libs.CRP import CRP
+
+
+def test_cluster_births_and_deaths(example_data):
+    # Cluster sizes and parameters stay consistent with the assignment when
+    # clusters are opened and closed
+    np.random.seed(0)
+    data = example_data
+    model = CRP(data, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+        FP_error=0.1)
+    # Start from a single cluster with a large concentration parameter
+    model.init(assign=[0] * data.shape[0])
+    model.DP_a = 1e6
+    model.init_DP_prior()
+    ks = [1]
+    for _ in range(5):
+        model.update_assignments_Gibbs_collapsed(grid_size=50)
+        cl, sizes = np.unique(model.assignment, return_counts=True)
+        assert dict(zip(cl, sizes)) == model.cells_per_cluster
+        assert ((model.parameters[cl] > 0) & (model.parameters[cl] < 1)).all()
+        ks.append(cl.size)
+    assert max(ks) > 4 and (np.diff(ks) < 0).any()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from libs.CRP import CRP
+
+
+def test_unassigned_cells(example_data):
+    # Unassigned cells join the most likely cluster given the assigned cells
+    np.random.seed(0)
+    data = example_data
+    model = CRP(data, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+        FP_error=0.1)
+    assign = np.arange(data.shape[0]) % 4
+    assign[::3] = -1
+    model.init(assign=assign.tolist())
+
+    theta = np.empty((4, data.shape[1]))
+    for cl in range(4):
+        ones, zeros = model._get_counts(np.where(assign == cl)[0])
+        theta[cl] = (model.p + ones) / (model.p + model.q + ones + zeros)
+    for cell_id in np.flatnonzero(assign < 0):
+        ll = model._calc_ll_rows([cell_id], theta)
+        assert model.assignment[cell_id] == np.argmax(ll)
+    assert (model.assignment[assign >= 0] == assign[assign >= 0]).all()
+
+    cl, sizes = np.unique(model.assignment, return_counts=True)
+    assert dict(zip(cl, sizes)) == model.cells_per_cluster
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+import libs.dpmmIO as io
+
+
+def test_streaming_chunks(example_file):
+    # Parsing in small chunks gives the matrix of a single full read
+    expected = np.loadtxt(example_file)
+    expected[expected == 2] = 1
+    expected[expected == 3] = np.nan
+    data, (rows, cols) = io.load_data(example_file, transpose=False,
+        get_names=True, chunk_size=250, cache=False)
+    assert np.array_equal(data, expected, equal_nan=True)
+    assert (rows == np.arange(expected.shape[0])).all()
+    assert (cols == np.arange(expected.shape[1])).all()
+
+
+def test_compact_matrix(example_file):
+    data = io.load_data(example_file, compact=True, cache=False)
+    assert data.dtype == np.int8
+    assert set(np.unique(data)) <= {0, 1, io.MISSING}
+
+
+def test_header_only(tmp_path):
+    in_file = tmp_path / 'data.csv'
+    in_file.write_text('cell1,cell2,cell3\n')
+    with pytest.raises(ValueError, match='No data rows'):
+        io.load_data(str(in_file), cache=False)
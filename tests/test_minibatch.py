@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from libs.CRP import CRP
+
+
+def get_model(data):
+    np.random.seed(0)
+    model = CRP(data, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+        FP_error=0.1)
+    model.init(assign=(np.arange(data.shape[0]) % 4).tolist())
+    return model
+
+
+@pytest.mark.parametrize('fraction', [0.1, 0.3, 0.5])
+def test_systematic_scan(example_data, fraction):
+    # Each pass updates every row exactly once, in ceil(1 / fraction) batches
+    model = get_model(example_data)
+    batch_no = int(np.ceil(1 / fraction))
+    for _ in range(3):
+        batches = [model._get_minibatch(fraction) for _ in range(batch_no)]
+        assert not model.gibbs_queue
+        rows = np.concatenate(batches)
+        assert np.array_equal(np.sort(rows), np.arange(model.cells_total))
+        assert max(i.size for i in batches) - min(i.size for i in batches) <= 1
+
+
+@pytest.mark.parametrize('move', ['Gibbs', 'Gibbs_MH'])
+def test_minibatch_sweep(example_data, move):
+    # A minibatch sweep only moves the cells of the batch
+    model = get_model(example_data)
+    for _ in range(6):
+        batch = model.gibbs_queue[-1].copy() if model.gibbs_queue \
+            else None
+        old = model.assignment.copy()
+        getattr(model, f'update_assignments_{move}')(fraction=0.25)
+        model.update_parameters()
+        if batch is not None:
+            rest = np.setdiff1d(np.arange(model.cells_total), batch)
+            assert (model.assignment[rest] == old[rest]).all()
+        cl, sizes = np.unique(model.assignment, return_counts=True)
+        assert dict(zip(cl, sizes)) == model.cells_per_cluster
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+import libs.dpmmIO as io
+from libs.CRP import CRP
+
+
+def get_models(example_file, tmp_path):
+    # In-memory and memory-mapped model of the same data
+    data = io.load_data(example_file, cache=False)
+    compact = io.load_data(example_file, compact=True, cache=False)
+    mmap = io.save_memmap(compact, str(tmp_path / 'data.npy'))
+    return [CRP(i, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.2,
+            FP_error=0.01, block_size=j) \
+        for i, j in [(data, None), (mmap, 1000)]]
+
+
+@pytest.mark.parametrize('mode', ['random', 'kmedoids', 'hierarchical'])
+def test_memmap_sweeps(example_file, tmp_path, mode):
+    # Sweeps over memory-mapped blocks equal the in-memory sweeps
+    states = []
+    for model in get_models(example_file, tmp_path):
+        np.random.seed(3)
+        model.init(mode=mode, k=4)
+        for _ in range(3):
+            model.update_assignments_Gibbs()
+            model.update_parameters()
+            model.update_assignments_split_merge()
+        states.append((model.assignment.copy(), model.get_ll_full()))
+    assert np.array_equal(states[0][0], states[1][0])
+    assert np.isclose(states[0][1], states[1][1])
+
+
+def test_parameter_rows(example_file, tmp_path):
+    # One parameter row per cluster, grown when clusters are opened
+    model = get_models(example_file, tmp_path)[1]
+    np.random.seed(3)
+    model.init(mode='kmedoids', k=4)
+    assert model.parameters.shape == (4, model.muts_total)
+    cl_id = model.init_new_cluster(0)
+    assert cl_id == 4
+    assert model.parameters.shape[0] > 4
+    assert (model.parameters[cl_id] > 0).all()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import scipy.sparse as sp
+
+import libs.dpmmIO as io
+from libs.CRP import CRP
+
+
+def get_models(example_data, tmp_path):
+    # Dense model and model of the sparse observations of the same data
+    obs = ~np.isnan(example_data)
+    rows, cols = np.nonzero(obs)
+    in_file = str(tmp_path / 'data.npz')
+    sp.save_npz(in_file, sp.coo_matrix(
+        (example_data[obs].astype(np.int8), (rows, cols)),
+        shape=example_data.shape
+    ))
+    sparse = io.load_data(in_file, transpose=False, cache=False)
+    assert sp.issparse(sparse) and sparse.nnz == obs.sum()
+    return [CRP(i, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+            FP_error=0.1) for i in [example_data, sparse]]
+
+
+def test_sparse_likelihood(example_data, tmp_path):
+    # Likelihoods over the observed entries equal the dense likelihoods
+    np.random.seed(0)
+    theta = np.random.uniform(0.05, 0.95, (4, example_data.shape[1]))
+    assign = np.arange(example_data.shape[0]) % 4
+    dense, sparse = get_models(example_data, tmp_path)
+    for model in [dense, sparse]:
+        model.init(assign=assign.tolist())
+        model.parameters[:4] = theta
+    assert np.isclose(sparse.get_ll_full(), dense.get_ll_full())
+    assert np.allclose(sparse._calc_ll_rows([3], theta),
+        dense._calc_ll_rows([3], theta))
+    assert np.allclose(sparse.get_lpost_single_new_cluster(),
+        dense.get_lpost_single_new_cluster())
+    for x, y in zip(sparse._get_counts(assign == 1),
+            dense._get_counts(assign == 1)):
+        assert np.allclose(x, y)
+
+
+def test_sparse_sweeps(example_data, tmp_path):
+    # Gibbs and split-merge sweeps sample the same states
+    states = []
+    for model in get_models(example_data, tmp_path):
+        np.random.seed(3)
+        model.init(mode='random')
+        for _ in range(3):
+            model.update_assignments_Gibbs()
+            model.update_parameters()
+            model.update_assignments_split_merge()
+        states.append((model.assignment.copy(), model.get_ll_full()))
+    assert np.array_equal(states[0][0], states[1][0])
+    assert np.isclose(states[0][1], states[1][1])
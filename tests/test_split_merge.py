@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from libs.CRP import CRP
+
+
+def get_model(data):
+    np.random.seed(0)
+    model = CRP(data, DP_alpha=[1, 1], param_beta=[.5, .5], FN_error=0.3,
+        FP_error=0.1)
+    model.init(assign=(np.arange(data.shape[0]) % 4).tolist())
+    return model
+
+
+def test_restricted_scan(example_data):
+    # The vectorized scan samples the sequential restricted Gibbs conditionals
+    # and keeps the launch cluster counts of the moved cells
+    model = get_model(example_data)
+    cells = np.random.choice(example_data.shape[0], 30, replace=False)
+    S = cells[1:-1]
+    model._rg_init_split(cells, random=True)
+    moved = []
+    for _ in range(3):
+        params = model.rg_params_split.copy()
+        old = model.rg_assignment.copy()
+        state = np.random.get_state()
+        prob = model._rg_scan_assign(cells, trans_prob=True)
+
+        np.random.set_state(state)
+        order = np.random.permutation(S.size)
+        rand = np.random.random(S.size)
+        assign = old.copy()
+        prob_exp = 0
+        for cell in order:
+            others = np.delete(assign, cell)
+            sizes = 1 + np.array([(others == 0).sum(), (others == 1).sum()])
+            lpost = model._calc_ll_rows([S[cell]], params) + np.log(sizes)
+            lprobs = lpost - np.logaddexp(*lpost)
+            assign[cell] = int(rand[cell] < np.exp(lprobs[1]))
+            prob_exp += lprobs[assign[cell]]
+        moved.append((assign != old).sum())
+        assert (model.rg_assignment == assign).all()
+        assert np.isclose(prob, prob_exp)
+
+        counts_j = model._get_counts(np.append(S[assign == 1], cells[-1]))
+        counts_i = model._get_counts(np.append(S[assign == 0], cells[0]))
+        assert np.allclose(model._rg_get_counts(1), counts_j)
+        assert np.allclose(model._rg_get_counts(0), counts_i)
+        model._rg_scan_params(cells)
+    assert sum(moved) > 0
+
+
+def record_moves(monkeypatch, model, move, n):
+    # Proposed cells and proposal log probabilities of n rejected moves
+    moves = []
+
+    def run_rg_nc(self, move, cells, size_data, scan_no):
+        moves.append((cells.copy(), size_data))
+        return (False, [], []) if move == 'split' else (False, [])
+
+    monkeypatch.setattr(CRP, 'run_rg_nc', run_rg_nc)
+    for _ in range(n):
+        getattr(model, f'do_{move}_move')(anchors='disagreement',
+            partners='similarity')
+    monkeypatch.undo()
+    return moves
+
+
+def test_disagreement_anchors(monkeypatch, example_data):
+    # Anchor pairs are drawn with the probabilities of the proposal ratio,
+    # which the reverse merge move recomputes
+    model = get_model(example_data[:8])
+    model.init(assign=[0] * 8)
+    moves = record_moves(monkeypatch, model, 'split', 5000)
+
+    pairs = {}
+    for cells, size_data in moves:
+        pairs.setdefault((cells[0], cells[-1]), size_data[0][0])
+        model.rg_params_merge = model.parameters[0]
+        ratio = model._get_ltrans_prob_size_ratio_merge(cells, 0,
+            'disagreement')
+        assert np.isclose(ratio, size_data[0][0])
+    lprobs = np.array(list(pairs.values()))
+    assert np.isclose(np.exp(lprobs).sum(), 1)
+    drawn = [(cells[0], cells[-1]) for cells, _ in moves]
+    freq = np.array([drawn.count(pair) for pair in pairs]) / len(moves)
+    assert np.abs(freq - np.exp(lprobs)).max() < 0.01
+
+
+def test_similarity_partners(monkeypatch, example_data):
+    # Cluster pairs are drawn with the probabilities of the proposal ratio,
+    # which the reverse split move recomputes
+    model = get_model(example_data[:20])
+    model.init(assign=(np.arange(20) % 5).tolist())
+    moves = record_moves(monkeypatch, model, 'merge', 5000)
+
+    pairs = {}
+    for cells, size_data in moves:
+        cl_i, cl_j = model.assignment[[cells[0], cells[-1]]]
+        n_i, n_j = [model.cells_per_cluster[i] for i in (cl_i, cl_j)]
+        lprob = size_data[0] + np.log(n_i) + np.log(n_j)
+        pairs.setdefault((cl_i, cl_j), lprob)
+
+        others = [i for i in model.cells_per_cluster if i not in (cl_i, cl_j)]
+        model.rg_params_split = model.parameters[[cl_i, cl_j]]
+        model.rg_assignment = np.repeat([0, 1], [n_i - 1, n_j - 1])
+        ratio = model._get_ltrans_prob_size_ratio_split(cells, np.zeros(1),
+            np.array([model.cells_per_cluster[i] for i in others]),
+            'similarity', model.parameters[others])
+        assert np.isclose(ratio, lprob)
+    lprobs = np.array(list(pairs.values()))
+    assert np.isclose(np.exp(lprobs).sum(), 1)
+    drawn = [tuple(model.assignment[[cells[0], cells[-1]]]) \
+        for cells, _ in moves]
+    freq = np.array([drawn.count(pair) for pair in pairs]) / len(moves)
+    assert np.abs(freq - np.exp(lprobs)).max() < 0.02
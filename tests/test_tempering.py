@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from libs.CRP import CRP
+from libs.MCMC import MCMC
+
+
+class CRP_failing(CRP):
+    # Fails in the Gibbs sweep of the replicas with the given temperature
+    fail_inv_temp = None
+
+    def update_assignments_Gibbs(self, *args):
+        if self.fail_inv_temp is None or self.inv_temp == self.fail_inv_temp:
+            raise ValueError('Gibbs sweep failed')
+        super().update_assignments_Gibbs(*args)
+
+
+def get_model(data, fail_inv_temp):
+    model = CRP_failing(data, DP_alpha=[-1, -1], FN_error=0.2, FP_error=0.01)
+    model.fail_inv_temp = fail_inv_temp
+    return model
+
+
+@pytest.mark.parametrize('fail_inv_temp', [1.0, 0.1])
+def test_tempered_replica_error(example_data, fail_inv_temp):
+    # Errors of cold and hot replicas are raised with their traceback
+    mcmc = MCMC(get_model(example_data, fail_inv_temp), sm_prob=0, tempering=2)
+    with pytest.raises(RuntimeError, match='Gibbs sweep failed'):
+        mcmc.run((20, 5), seed=1, n=1, verbosity=0)
+
+
+def test_chain_error(example_data):
+    mcmc = MCMC(get_model(example_data, None), sm_prob=0)
+    with pytest.raises(ValueError, match='Gibbs sweep failed'):
+        mcmc.run((20, 5), seed=1, n=1, verbosity=0)
+    with pytest.raises(RuntimeError, match='No MCMC chain'):
+        mcmc.get_results()
+
+
+SMALL_DATA = np.array([[1, 1, 0, 0], [1, 1, 0, np.nan], [1, 0, 1, 1],
+    [0, 0, 1, 1], [0, np.nan, 1, 1]])
+
+
+def get_co_clustering(inv_temps, steps, seed):
+    # Co-clustering of the cold replica, with a swap after each Gibbs sweep
+    np.random.seed(seed)
+    models = []
+    for inv_temp in inv_temps:
+        model = CRP(SMALL_DATA, DP_alpha=[1, 1], param_beta=[1, 1],
+            FN_error=0.2, FP_error=0.1)
+        model.inv_temp = inv_temp
+        model.init()
+        models.append(model)
+    co_cl = np.zeros((SMALL_DATA.shape[0], SMALL_DATA.shape[0]))
+    for _ in range(steps):
+        for model in models:
+            model.update_assignments_Gibbs()
+            model.update_parameters()
+        for cold, hot in zip(models[:-1], models[1:]):
+            A = (cold.inv_temp - hot.inv_temp) \
+                * (hot.get_ll_full() - cold.get_ll_full())
+            if np.log(np.random.random()) < A:
+                state = cold.get_state()
+                cold.set_state(hot.get_state())
+                hot.set_state(state)
+        assign = models[0].assignment
+        co_cl += assign[:, None] == assign[None, :]
+    return co_cl / steps
+
+
+def test_cold_chain_posterior():
+    # The cold replica samples the untempered posterior
+    untempered = get_co_clustering([1], 800, 1)
+    tempered = get_co_clustering([1, 0.2], 800, 2)
+    assert np.abs(untempered - tempered).max() < 0.1
+
+
+@pytest.mark.parametrize('move', ['Gibbs', 'Gibbs_MH'])
+def test_hot_replica_clusters(example_data, move):
+    # Gibbs moves of tempered replicas neither open nor close clusters
+    np.random.seed(0)
+    model = CRP(example_data, DP_alpha=[1, 1], param_beta=[.5, .5],
+        FN_error=0.3, FP_error=0.1)
+    model.inv_temp = 0.2
+    assign = np.arange(example_data.shape[0]) % 6
+    assign[:3] = [6, 7, 8]
+    model.init(assign=assign.tolist())
+    for _ in range(3):
+        getattr(model, f'update_assignments_{move}')()
+        model.update_parameters()
+        cl, sizes = np.unique(model.assignment, return_counts=True)
+        assert dict(zip(cl, sizes)) == model.cells_per_cluster
+        assert set(cl) == set(range(9))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+from sklearn.metrics import adjusted_rand_score
+
+from benchmarks.simulate import simulate_data
+from libs.CRP import CRP
+from libs.VI import VI
+
+
+def fit_VI(data, seed):
+    np.random.seed(seed)
+    model = CRP(data, DP_alpha=[1, 1], FN_error=0.1, FP_error=0.001)
+    vi = VI(model, truncation=20)
+    vi.fit(restarts=3, verbosity=0)
+    return model, vi.get_assignment()[1]
+
+
+def test_example_clusters(example_data):
+    # The 5 clones of the example data, as sampled by Gibbs and split-merge
+    model, assignment = fit_VI(example_data, 1)
+    assert np.unique(assignment).size == 5
+    model.init(mode='random')
+    for _ in range(30):
+        model.update_assignments_Gibbs()
+        model.update_parameters()
+        model.update_assignments_split_merge()
+    assert adjusted_rand_score(assignment, model.assignment) > 0.95
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_simulated_clusters(seed):
+    # Clones of data simulated with the parameters of the example data
+    data, _, true_assignment, _ = simulate_data(seed=seed)
+    data = np.where(data == 3, np.nan, data)
+    _, assignment = fit_VI(data, seed)
+    assert adjusted_rand_score(true_assignment, assignment) > 0.95